@@ -0,0 +1,167 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+TILE_PATHS = ("/api/v1/tiles/", "/api/v1/tileset_info/")
+
+MAX_WORKERS = 16
+
+MAX_TILE_WORKERS = 16
+
+
+def get_environ(scope: dict, body: bytes) -> dict:
+    """Translate an ASGI HTTP scope into a WSGI environ"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+
+        if name == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        elif name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        else:
+            key = "HTTP_{}".format(name)
+            environ[key] = "{},{}".format(environ[key], value) if key in environ else value
+
+    return environ
+
+
+def run_wsgi(wsgi_app, environ: dict):
+    """Run a WSGI app and collect the entire response"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (name.lower().encode("latin1"), value.encode("latin1"))
+            for name, value in headers
+        ]
+
+    iterable = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(iterable)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+    return response["status"], response["headers"], body
+
+
+class WsgiToAsgi:
+    """Serve a WSGI app, i.e., the Flask app, as an ASGI app
+
+    The event loop accepts and reads requests asynchronously while the blocking
+    request handlers run on bounded thread pools. Tile requests are handled by a
+    separate pool such that bursts of tile requests from HiGlass do not delay the
+    UI's periodic requests, e.g., to `/progress/` or `/seeds/`.
+
+    Arguments:
+        wsgi_app {callable} -- WSGI app
+
+    Keyword Arguments:
+        max_workers {int} -- Number of threads for non-tile requests
+            (default: {MAX_WORKERS})
+        max_tile_workers {int} -- Number of threads for tile requests
+            (default: {MAX_TILE_WORKERS})
+    """
+
+    def __init__(
+        self,
+        wsgi_app,
+        max_workers: int = MAX_WORKERS,
+        max_tile_workers: int = MAX_TILE_WORKERS,
+    ):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.tile_executor = ThreadPoolExecutor(max_workers=max_tile_workers)
+
+    def get_executor(self, path: str):
+        if path.startswith(TILE_PATHS):
+            return self.tile_executor
+        return self.executor
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                self.tile_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] == "websocket":
+            # Peax does not serve websockets, hence, the connection is rejected
+            await receive()
+            await send({"type": "websocket.close"})
+            return
+
+        if scope["type"] != "http":
+            return
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        environ = get_environ(scope, b"".join(body))
+
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(
+            self.get_executor(scope["path"]), run_wsgi, self.wsgi_app, environ
+        )
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def create(
+    app, max_workers: int = MAX_WORKERS, max_tile_workers: int = MAX_TILE_WORKERS
+):
+    """Wrap the Flask app created by `server.create()` as an ASGI app"""
+    return WsgiToAsgi(app, max_workers, max_tile_workers)
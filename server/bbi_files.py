@@ -0,0 +1,129 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import bbi
+import cooler
+import numpy as np
+import pandas as pd
+import threading
+
+from server.defaults import TILE_SIZE
+
+
+class BBIFile:
+    """A bigWig or bigBed file with cached metadata and per-thread read handles
+
+    The chromosome sizes and everything derived from them are read only once. Recent
+    versions of pybbi can keep a file open via `bbi.open()`. Since such a handle
+    holds a single file pointer, every thread gets its own handle. With older
+    versions of pybbi the file is opened by pybbi on every request.
+
+    Arguments:
+        filepath {str} -- Path or URL to the bigWig or bigBed file
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+
+        chromsizes = bbi.chromsizes(filepath)
+        chromosomes = cooler.util.natsorted(chromsizes.keys())
+        self.chromsizes = pd.Series(chromsizes)[chromosomes]
+
+        min_tile_cover = np.ceil(np.sum(self.chromsizes) / TILE_SIZE)
+        self.quadtree_depth = int(np.ceil(np.log2(min_tile_cover)))
+        self.zoom_resolutions = [2 ** x for x in range(self.quadtree_depth + 1)][::-1]
+        self.chrom_offsets = np.r_[0, np.cumsum(self.chromsizes.values)]
+
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    @property
+    def handle(self):
+        """Read handle of the current thread or `None` if pybbi can't keep files open"""
+        if not hasattr(bbi, "open"):
+            return None
+
+        try:
+            return self._local.handle
+        except AttributeError:
+            handle = bbi.open(self.filepath)
+            self._local.handle = handle
+            with self._lock:
+                self._handles.append(handle)
+            return handle
+
+    def fetch(self, chrom: str, start: int, end: int, **kwargs):
+        handle = self.handle
+        if handle is None:
+            return bbi.fetch(self.filepath, chrom, start, end, **kwargs)
+        return handle.fetch(chrom, start, end, **kwargs)
+
+    def stackup(self, chroms, starts, ends, **kwargs):
+        handle = self.handle
+        if handle is None:
+            return bbi.stackup(self.filepath, chroms, starts, ends, **kwargs)
+        return handle.stackup(chroms, starts, ends, **kwargs)
+
+    def fetch_intervals(self, chrom: str, start: int, end: int):
+        """Fetch the intervals of a bigBed file
+
+        Returns:
+            {iterable} -- Intervals as `[chrom, start, end, *fields]` lists
+        """
+        handle = self.handle
+        if handle is None:
+            return bbi.fetch_intervals(self.filepath, chrom, start, end)
+        return handle.fetch_intervals(chrom, start, end, iterator=True)
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles = []
+        self._local = threading.local()
+
+
+class BBIFiles:
+    """Process-wide registry of opened bigWig and bigBed files"""
+
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def get(self, filepath: str) -> BBIFile:
+        try:
+            return self.files[filepath]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if filepath not in self.files:
+                self.files[filepath] = BBIFile(filepath)
+            return self.files[filepath]
+
+    def close(self, filepath: str = None):
+        with self._lock:
+            filepaths = list(self.files.keys()) if filepath is None else [filepath]
+            for path in filepaths:
+                bbi_file = self.files.pop(path, None)
+                if bbi_file is not None:
+                    bbi_file.close()
+
+
+FILES = BBIFiles()
+
+
+def get(filepath: str) -> BBIFile:
+    """Get the opened bigWig or bigBed file from the process-wide registry"""
+    return FILES.get(filepath)
@@ -11,12 +11,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import base64
-import bbi
-import cooler
 import numpy as np
 import os
-import pandas as pd
+import threading
+
+from server import bbi_files, bigwig, tile_encoding
 
 
 TILE_SIZE = 1024
@@ -30,11 +29,18 @@ TILESET_INFO = {
 
 FILE_EXT = {"bigbed", "bb"}
 
+# Tiles of zoom levels at which any tile would hold more intervals are served as
+# dense interval counts
+MAX_TILE_INTERVALS = 1024
+
 
-def is_bigwig(filepath=None, filetype=None):
+def is_bigbed(filepath=None, filetype=None):
     if filetype == "bigbed":
         return True
 
+    if filepath is None:
+        return False
+
     filename, file_ext = os.path.splitext(filepath)
 
     if file_ext[1:].lower() in FILE_EXT:
@@ -43,16 +49,6 @@ def is_bigwig(filepath=None, filetype=None):
     return False
 
 
-def get_quadtree_depth(chromsizes):
-    tile_size_bp = TILE_SIZE
-    min_tile_cover = np.ceil(sum(chromsizes) / tile_size_bp)
-    return int(np.ceil(np.log2(min_tile_cover)))
-
-
-def get_zoom_resolutions(chromsizes):
-    return [2 ** x for x in range(get_quadtree_depth(chromsizes) + 1)][::-1]
-
-
 def get_chromsizes(bwpath):
     """
     TODO: replace this with negspy
@@ -60,84 +56,215 @@ def get_chromsizes(bwpath):
     Also, return NaNs from any missing chromosomes in bbi.fetch
 
     """
-    chromsizes = bbi.chromsizes(bwpath)
-    chromosomes = cooler.util.natsorted(chromsizes.keys())
-    return pd.Series(chromsizes)[chromosomes]
-
-
-def abs2genomic(chromsizes, start_pos, end_pos):
-    abs_chrom_offsets = np.r_[0, np.cumsum(chromsizes.values)]
-    cid_lo, cid_hi = (
-        np.searchsorted(abs_chrom_offsets, [start_pos, end_pos], side="right")
-        - 1
-    )
-    rel_pos_lo = start_pos - abs_chrom_offsets[cid_lo]
-    rel_pos_hi = end_pos - abs_chrom_offsets[cid_hi]
-    start = rel_pos_lo
-    for cid in range(cid_lo, cid_hi):
-        yield cid, start, chromsizes[cid]
-        start = 0
-    yield cid_hi, start, rel_pos_hi
-
-
-def get_tile(bwpath, zoom_level, start_pos, end_pos):
-    chromsizes = get_chromsizes(bwpath)
-    resolutions = get_zoom_resolutions(chromsizes)
-    binsize = resolutions[zoom_level]
-
-    arrays = []
-    for cid, start, end in abs2genomic(chromsizes, start_pos, end_pos):
-        n_bins = int(np.ceil((end - start) / binsize))
-        try:
-            chrom = chromsizes.index[cid]
-            clen = chromsizes.values[cid]
-
-            x = bbi.fetch(
-                bwpath, chrom, start, end, bins=n_bins, missing=np.nan
+    return bbi_files.get(bwpath).chromsizes.copy()
+
+
+class IntervalIndex:
+    """Sorted interval index of a bigBed file
+
+    All intervals are loaded once and sorted by their start per chromosome. Tiles of
+    fine zoom levels are answered with the overlapping intervals, which are found by
+    binary search. Since no interval is longer than the chromosome's longest
+    interval, only intervals starting within that distance before the tile can
+    overlap it. Tiles of coarse zoom levels, where a tile would contain more than
+    `max_tile_intervals` intervals, are answered with the number of intervals
+    overlapping each bin. These counts are the number of intervals starting before
+    the bin's end minus the number of intervals ending before the bin's start and
+    are derived from the sorted starts and ends for any bin size.
+
+    Arguments:
+        filepath {str} -- Path to the bigBed file
+
+    Keyword Arguments:
+        max_tile_intervals {int} -- Maximum number of intervals per tile
+            (default: {MAX_TILE_INTERVALS})
+    """
+
+    def __init__(self, filepath: str, max_tile_intervals: int = MAX_TILE_INTERVALS):
+        bbi_file = bbi_files.get(filepath)
+
+        self.filepath = filepath
+        self.chromsizes = bbi_file.chromsizes
+        self.chrom_offsets = bbi_file.chrom_offsets
+        self.quadtree_depth = bbi_file.quadtree_depth
+        self.zoom_resolutions = bbi_file.zoom_resolutions
+
+        self.starts = []
+        self.ends = []
+        self.sorted_ends = []
+        self.max_lengths = []
+        self.fields = []
+
+        for chrom, chromsize in self.chromsizes.items():
+            intervals = list(bbi_file.fetch_intervals(chrom, 0, int(chromsize)))
+
+            starts = np.array([int(interval[1]) for interval in intervals], dtype=int)
+            ends = np.array([int(interval[2]) for interval in intervals], dtype=int)
+            order = np.argsort(starts, kind="stable")
+
+            self.starts.append(starts[order])
+            self.ends.append(ends[order])
+            self.sorted_ends.append(np.sort(ends))
+            self.max_lengths.append(int(np.max(ends - starts)) if ends.size else 0)
+            self.fields.append([list(map(str, intervals[k][3:])) for k in order])
+
+        self.max_tile_intervals = max_tile_intervals
+        self._min_interval_zoom = None
+
+    @property
+    def min_interval_zoom(self):
+        """Coarsest zoom level whose tiles are served as intervals"""
+        if self._min_interval_zoom is None:
+            self._min_interval_zoom = self.get_min_interval_zoom(
+                self.max_tile_intervals
             )
+        return self._min_interval_zoom
+
+    @property
+    def num_intervals(self):
+        return sum(starts.size for starts in self.starts)
+
+    def query(self, cid: int, start: int, end: int) -> np.ndarray:
+        """Get the indices of the intervals overlapping `[start, end)`"""
+        starts = self.starts[cid]
+        lo = np.searchsorted(starts, start - self.max_lengths[cid], side="right")
+        hi = np.searchsorted(starts, end, side="left")
+        return np.arange(lo, hi)[self.ends[cid][lo:hi] > start]
+
+    def count(self, cid: int, bin_starts: np.ndarray, bin_ends: np.ndarray):
+        """Count the intervals overlapping each bin"""
+        return np.searchsorted(
+            self.starts[cid], bin_ends, side="left"
+        ) - np.searchsorted(self.sorted_ends[cid], bin_starts, side="right")
+
+    def get_min_interval_zoom(self, max_tile_intervals: int) -> int:
+        """Get the coarsest zoom level at which no tile has too many intervals"""
+        for zoom_level in range(self.quadtree_depth + 1):
+            tile_size = TILE_SIZE * self.zoom_resolutions[zoom_level]
+            num_tiles = int(np.ceil(self.chrom_offsets[-1] / tile_size))
+            counts = np.zeros(num_tiles, dtype=int)
+
+            for cid in range(len(self.starts)):
+                chrom_start = self.chrom_offsets[cid]
+                chrom_end = self.chrom_offsets[cid + 1]
+                first_tile = chrom_start // tile_size
+                tiles = np.arange(first_tile, int(np.ceil(chrom_end / tile_size)))
+                bin_starts = np.maximum(tiles * tile_size, chrom_start) - chrom_start
+                bin_ends = np.minimum((tiles + 1) * tile_size, chrom_end) - chrom_start
+                counts[tiles] += self.count(cid, bin_starts, bin_ends)
+
+            if counts.size == 0 or counts.max() <= max_tile_intervals:
+                return zoom_level
+
+        return self.quadtree_depth + 1
+
+    def get_intervals(self, start_pos: int, end_pos: int) -> list:
+        """Get the intervals overlapping an absolute range as HiGlass bedlike items"""
+        intervals = []
+        for cid, start, end in bigwig.abs2chr(self.chromsizes, start_pos, end_pos):
+            if cid >= len(self.starts):
+                # beyond the range of the available chromosomes
+                continue
+
+            chrom = self.chromsizes.index[cid]
+            offset = int(self.chrom_offsets[cid])
+            starts = self.starts[cid]
+            ends = self.ends[cid]
+
+            for k in self.query(cid, start, end):
+                interval_start = int(starts[k])
+                interval_end = int(ends[k])
+                intervals.append(
+                    {
+                        "xStart": offset + interval_start,
+                        "xEnd": offset + interval_end,
+                        "chrOffset": offset,
+                        "importance": interval_end - interval_start,
+                        "uid": "{}-{}".format(cid, k),
+                        "fields": [
+                            chrom,
+                            str(interval_start),
+                            str(interval_end),
+                            *self.fields[cid][k],
+                        ],
+                    }
+                )
+
+        return intervals
+
+    def get_counts(self, zoom_level: int, start_pos: int, end_pos: int):
+        """Get the number of intervals per bin like `bigwig.get_tile()`"""
+        binsize = self.zoom_resolutions[zoom_level]
+
+        arrays = []
+        for cid, start, end in bigwig.abs2chr(self.chromsizes, start_pos, end_pos):
+            n_bins = int(np.ceil((end - start) / binsize))
+
+            if cid >= len(self.starts):
+                # beyond the range of the available chromosomes
+                arrays.append(np.zeros(n_bins))
+                continue
+
+            clen = self.chromsizes.values[cid]
+            bin_starts = start + np.arange(n_bins) * binsize
+            bin_ends = np.minimum(bin_starts + binsize, end)
+            x = self.count(cid, bin_starts, bin_ends).astype(float)
 
             # drop the very last bin if it is smaller than the binsize
             if end == clen and clen % binsize != 0:
                 x = x[:-1]
-        except IndexError:
-            # beyond the range of the available chromosomes
-            # probably means we've requested a range of absolute
-            # coordinates that stretch beyond the end of the genome
-            x = np.zeros(n_bins)
 
-        arrays.append(x)
+            arrays.append(x)
 
-    return np.concatenate(arrays)
+        return np.concatenate(arrays)
 
+    def tiles(self, tile_ids):
+        generated_tiles = []
+        for tile_id in tile_ids:
+            _, zoom_level, tile_pos = bigwig.parse_tile_id(tile_id)
+            tile_size = TILE_SIZE * 2 ** (self.quadtree_depth - zoom_level)
+            start_pos = tile_pos * tile_size
+            end_pos = start_pos + tile_size
+
+            if zoom_level >= self.min_interval_zoom:
+                tile_value = self.get_intervals(start_pos, end_pos)
+            else:
+                tile_value = tile_encoding.get_tile_value(
+                    self.get_counts(zoom_level, start_pos, end_pos)
+                )
+
+            generated_tiles += [(tile_id, tile_value)]
+
+        return generated_tiles
 
-def get_tile_by_id(bwpath, zoom_level, tile_pos):
-    """
-    Get the data for a bigWig tile given a tile id.
-    Parameters
-    ----------
-    bwpath: string
-        The path to the bigWig file (can be remote)
-    zoom_level: int
-        The zoom level to get the data for
-    tile_pos: int
-        The position of the tile
-    """
-    max_depth = get_quadtree_depth(get_chromsizes(bwpath))
-    tile_size = TILE_SIZE * 2 ** (max_depth - zoom_level)
 
-    start_pos = tile_pos * tile_size
-    end_pos = start_pos + tile_size
+_indices = {}
+_indices_lock = threading.Lock()
 
-    return get_tile(bwpath, zoom_level, start_pos, end_pos)
 
+def get_index(bbpath: str) -> IntervalIndex:
+    """Get the interval index of a bigBed file. The index is only built once."""
+    try:
+        return _indices[bbpath]
+    except KeyError:
+        pass
 
-def tiles(bwpath, tile_ids):
-    """Generate tiles from a bigwig file.
+    with _indices_lock:
+        if bbpath not in _indices:
+            _indices[bbpath] = IntervalIndex(bbpath)
+        return _indices[bbpath]
+
+
+def tiles(bbpath, tile_ids):
+    """Generate tiles from a bigBed file.
+
+    Tiles of fine zoom levels are lists of intervals and tiles of coarse zoom levels
+    are dense interval counts. See `IntervalIndex`.
 
     Parameters
     ----------
-    tileset: tilesets.models.Tileset object
-        The tileset that the tile ids should be retrieved from
+    bbpath: string
+        Path to the bigBed file
     tile_ids: [str,...]
         A list of tile_ids (e.g. xyx.0.0) identifying the tiles
         to be retrieved
@@ -147,66 +274,18 @@ def tiles(bwpath, tile_ids):
     tile_list: [(tile_id, tile_data),...]
         A list of tile_id, tile_data tuples
     """
-    TILE_SIZE = 1024
-    generated_tiles = []
-    for tile_id in tile_ids:
-        tile_id_parts = tile_id.split(".")
-        tile_position = list(map(int, tile_id_parts[1:3]))
-        zoom_level = tile_position[0]
-        tile_pos = tile_position[1]
-
-        # this doesn't combine multiple consequetive ids, which
-        # would speed things up
-        max_depth = get_quadtree_depth(get_chromsizes(bwpath))
-        tile_size = TILE_SIZE * 2 ** (max_depth - zoom_level)
-        start_pos = tile_pos * tile_size
-        end_pos = start_pos + tile_size
-        dense = get_tile(bwpath, zoom_level, start_pos, end_pos)
-
-        if len(dense):
-            max_dense = max(dense)
-            min_dense = min(dense)
-        else:
-            max_dense = 0
-            min_dense = 0
-
-        min_f16 = np.finfo("float16").min
-        max_f16 = np.finfo("float16").max
-
-        has_nan = len([d for d in dense if np.isnan(d)]) > 0
-
-        if (
-            not has_nan
-            and max_dense > min_f16
-            and max_dense < max_f16
-            and min_dense > min_f16
-            and min_dense < max_f16
-        ):
-            tile_value = {
-                "dense": base64.b64encode(dense.astype("float16")).decode(
-                    "utf-8"
-                ),
-                "dtype": "float16",
-            }
-        else:
-            tile_value = {
-                "dense": base64.b64encode(dense.astype("float32")).decode(
-                    "utf-8"
-                ),
-                "dtype": "float32",
-            }
-
-        generated_tiles += [(tile_id, tile_value)]
-    return generated_tiles
-
-
-def tileset_info(bwpath):
-    """Get the tileset info for a bigWig file
+    return get_index(bbpath).tiles(tile_ids)
+
+
+def tileset_info(bbpath):
+    """Get the tileset info for a bigBed file
+
+    Only the file's header is read, i.e., the interval index is not built.
 
     Parameters
     ----------
-    bwpath: string
-        Path to the bigwig file
+    bbpath: string
+        Path to the bigBed file
 
     Returns
     -------
@@ -218,12 +297,7 @@ def tileset_info(bwpath):
         'max_zoom': 7
     }
     """
-    TILE_SIZE = 1024
-    chromsizes = bbi.chromsizes(bwpath)
-    chromosomes = cooler.util.natsorted(chromsizes.keys())
-    chromsizes = pd.Series(chromsizes)[chromosomes]
-    min_tile_cover = np.ceil(sum(chromsizes) / TILE_SIZE)
-    max_zoom = int(np.ceil(np.log2(min_tile_cover)))
+    max_zoom = bbi_files.get(bbpath).quadtree_depth
     tileset_info = {
         "min_pos": [0],
         "max_pos": [TILE_SIZE * 2 ** max_zoom],
@@ -11,14 +11,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import base64
-import bbi
-import cooler
 import numpy as np
 import os
-import pandas as pd
 
-from server import utils
+from numpy.lib.stride_tricks import sliding_window_view
+
+from server import bbi_files, tile_encoding, utils
 
 
 TILE_SIZE = 1024
@@ -27,6 +25,9 @@ TILESET_INFO = {"filetype": "bigwig", "datatype": "vector"}
 
 FILE_EXT = {"bigwig", "bw"}
 
+# Number of windows extracted at once by `chunk_batches()`
+BATCH_SIZE = 4096
+
 
 def is_bigwig(filepath=None, filetype=None):
     if filepath is None:
@@ -57,10 +58,10 @@ def get_chromsizes(bwpath):
     """TODO: replace this with negspy.
 
     Also, return NaNs from any missing chromosomes in bbi.fetch
+
+    The chromosome sizes are only read once per file. See `bbi_files`.
     """
-    chromsizes = bbi.chromsizes(bwpath)
-    chromosomes = cooler.util.natsorted(chromsizes.keys())
-    return pd.Series(chromsizes)[chromosomes]
+    return bbi_files.get(bwpath).chromsizes.copy()
 
 
 def chr2abs(chromsizes, chr: str, start: int, end: int):
@@ -121,7 +122,9 @@ def get_tile(bwpath, zoom_level, start_pos, end_pos, chromsizes=None):
             chrom = chromsizes.index[cid]
             clen = chromsizes.values[cid]
 
-            x = bbi.fetch(bwpath, chrom, start, end, bins=n_bins, missing=np.nan)
+            x = bbi_files.get(bwpath).fetch(
+                chrom, start, end, bins=n_bins, missing=np.nan
+            )
 
             # drop the very last bin if it is smaller than the binsize
             if end == clen and clen % binsize != 0:
@@ -137,9 +140,149 @@ def get_tile(bwpath, zoom_level, start_pos, end_pos, chromsizes=None):
     return np.concatenate(arrays)
 
 
-def tiles(bwpath, tile_ids, chromsizes=None):
+def parse_tile_id(tile_id: str):
+    """Split a tile id (e.g., `uuid.5.12`) into its uuid, zoom level, and position."""
+    tile_id_parts = tile_id.split(".")
+    zoom_level, tile_pos = map(int, tile_id_parts[1:3])
+    return tile_id_parts[0], zoom_level, tile_pos
+
+
+def get_tile_runs(tile_ids):
+    """Group tile ids by tileset and zoom level and merge adjacent positions.
+
+    HiGlass requests several horizontally adjacent tiles of the same zoom level at
+    once. Each run consists of tiles with consecutive positions, which can be
+    fetched from the bigWig file in one go.
+
+    Arguments:
+        tile_ids {list} -- List of tile ids, e.g., `["uuid.5.12", "uuid.5.13"]`
+
+    Returns:
+        {list} -- List of `(zoom_level, [(tile_pos, tile_id), ...])` tuples where the
+            tile positions within a run are consecutive
+    """
+    groups = {}
+    for tile_id in tile_ids:
+        uuid, zoom_level, tile_pos = parse_tile_id(tile_id)
+        groups.setdefault((uuid, zoom_level), []).append((tile_pos, tile_id))
+
+    runs = []
+    for (_, zoom_level), positions in groups.items():
+        positions.sort()
+        run = [positions[0]]
+        for position in positions[1:]:
+            if position[0] == run[-1][0] + 1:
+                run.append(position)
+            else:
+                runs.append((zoom_level, run))
+                run = [position]
+        runs.append((zoom_level, run))
+
+    return runs
+
+
+def get_tile_run(bwpath, zoom_level, tile_positions, chromsizes=None):
+    """Get the dense data of a run of adjacent tiles.
+
+    Instead of fetching every tile separately, the whole run is fetched once per
+    chromosome and sliced back into tiles. Only the pieces of a tile where a
+    chromosome starts or ends are fetched separately to ensure that the binning is
+    exactly the same as in `get_tile()`.
+
+    Arguments:
+        bwpath {str} -- Path to the bigWig file
+        zoom_level {int} -- Zoom level of the tiles
+        tile_positions {list} -- Consecutive tile positions
+
+    Keyword Arguments:
+        chromsizes {pd.Series} -- Chromosome sizes (default: {None})
+
+    Returns:
+        {list} -- List of dense arrays in the order of `tile_positions`
+    """
+    if chromsizes is None:
+        chromsizes = get_chromsizes(bwpath)
+
+    binsize = get_zoom_resolutions(chromsizes)[zoom_level]
+    tile_size = TILE_SIZE * binsize
+    abs_chrom_offsets = np.r_[0, np.cumsum(chromsizes.values)]
+
+    run_start = tile_positions[0] * tile_size
+    run_end = (tile_positions[-1] + 1) * tile_size
+
+    arrays = {tile_pos: [] for tile_pos in tile_positions}
+    bbi_file = bbi_files.get(bwpath)
+
+    def is_full(piece):
+        return piece[2] - piece[1] == tile_size
+
+    for cid, start, end in abs2chr(chromsizes, run_start, run_end):
+        offset = abs_chrom_offsets[min(cid, abs_chrom_offsets.size - 1)]
+
+        # Split the chromosome's part of the run into per-tile pieces
+        pieces = []
+        piece_start = start
+        while piece_start < end:
+            tile_pos = int((offset + piece_start) // tile_size)
+            piece_end = min(end, (tile_pos + 1) * tile_size - offset)
+            pieces.append((tile_pos, piece_start, piece_end))
+            piece_start = piece_end
+
+        try:
+            chrom = chromsizes.index[cid]
+            clen = chromsizes.values[cid]
+        except IndexError:
+            # beyond the range of the available chromosomes
+            # probably means we've requested a range of absolute
+            # coordinates that stretch beyond the end of the genome
+            for tile_pos, piece_start, piece_end in pieces:
+                n_bins = int(np.ceil((piece_end - piece_start) / binsize))
+                arrays[tile_pos].append(np.zeros(n_bins))
+            continue
+
+        i = 0
+        while i < len(pieces):
+            j = i + 1
+            if is_full(pieces[i]):
+                # Merge consecutive full tiles into one fetch
+                while j < len(pieces) and is_full(pieces[j]):
+                    j += 1
+
+            fetch_start = pieces[i][1]
+            fetch_end = pieces[j - 1][2]
+            n_bins = int(np.ceil((fetch_end - fetch_start) / binsize))
+
+            x = bbi_file.fetch(
+                chrom, fetch_start, fetch_end, bins=n_bins, missing=np.nan
+            )
+
+            for k, (tile_pos, piece_start, piece_end) in enumerate(pieces[i:j]):
+                if j - i > 1:
+                    y = x[k * TILE_SIZE : (k + 1) * TILE_SIZE]
+                else:
+                    y = x
+
+                # drop the very last bin if it is smaller than the binsize
+                if piece_end == clen and clen % binsize != 0:
+                    y = y[:-1]
+
+                arrays[tile_pos].append(y)
+
+            i = j
+
+    return [
+        np.concatenate(arrays[tile_pos]) if arrays[tile_pos] else np.zeros(0)
+        for tile_pos in tile_positions
+    ]
+
+
+def tiles(bwpath, tile_ids, chromsizes=None, executor=None):
     """Generate tiles from a bigwig file.
 
+    Adjacent tiles of the same zoom level are fetched together. See
+    `get_tile_runs()` and `get_tile_run()`. If an executor is given, the runs
+    are fetched concurrently.
+
     Parameters
     ----------
     tileset: tilesets.models.Tileset object
@@ -147,58 +290,40 @@ def tiles(bwpath, tile_ids, chromsizes=None):
     tile_ids: [str,...]
         A list of tile_ids (e.g. xyx.0.0) identifying the tiles
         to be retrieved
+    executor: concurrent.futures.Executor
+        Optional executor for fetching the runs of tiles concurrently
 
     Returns
     -------
     tile_list: [(tile_id, tile_data),...]
-        A list of tile_id, tile_data tuples
+        A list of tile_id, tile_data tuples. The dense tile data is not
+        serialized yet. See `tile_encoding.to_json()`.
     """
+    if chromsizes is None:
+        chromsizes = get_chromsizes(bwpath)
+
+    def run_tiles(tile_run):
+        zoom_level, run = tile_run
+        denses = get_tile_run(
+            bwpath, zoom_level, [tile_pos for tile_pos, _ in run], chromsizes=chromsizes
+        )
+
+        return [
+            (tile_id, tile_encoding.get_tile_value(dense))
+            for (_, tile_id), dense in zip(run, denses)
+        ]
+
+    tile_runs = get_tile_runs(tile_ids)
+
+    if executor is None or len(tile_runs) < 2:
+        run_results = map(run_tiles, tile_runs)
+    else:
+        run_results = executor.map(run_tiles, tile_runs)
+
     generated_tiles = []
-    for tile_id in tile_ids:
-        tile_id_parts = tile_id.split(".")
-        tile_position = list(map(int, tile_id_parts[1:3]))
-        zoom_level = tile_position[0]
-        tile_pos = tile_position[1]
-
-        if chromsizes is None:
-            chromsizes = get_chromsizes(bwpath)
-
-        max_depth = get_quadtree_depth(chromsizes)
-        tile_size = TILE_SIZE * 2 ** (max_depth - zoom_level)
-        start_pos = tile_pos * tile_size
-        end_pos = start_pos + tile_size
-        dense = get_tile(bwpath, zoom_level, start_pos, end_pos, chromsizes=chromsizes)
-
-        if len(dense):
-            max_dense = max(dense)
-            min_dense = min(dense)
-        else:
-            max_dense = 0
-            min_dense = 0
-
-        min_f16 = np.finfo("float16").min
-        max_f16 = np.finfo("float16").max
-
-        has_nan = len([d for d in dense if np.isnan(d)]) > 0
-
-        if (
-            not has_nan
-            and max_dense > min_f16
-            and max_dense < max_f16
-            and min_dense > min_f16
-            and min_dense < max_f16
-        ):
-            tile_value = {
-                "dense": base64.b64encode(dense.astype("float16")).decode("utf-8"),
-                "dtype": "float16",
-            }
-        else:
-            tile_value = {
-                "dense": base64.b64encode(dense.astype("float32")).decode("utf-8"),
-                "dtype": "float32",
-            }
-
-        generated_tiles += [(tile_id, tile_value)]
+    for run_result in run_results:
+        generated_tiles += run_result
+
     return generated_tiles
 
 
@@ -220,10 +345,7 @@ def tileset_info(bwpath):
         'max_zoom': 7
     }
     """
-    TILE_SIZE = 1024
-    chromsizes = get_chromsizes(bwpath)
-    min_tile_cover = np.ceil(np.sum(chromsizes) / TILE_SIZE)
-    max_zoom = int(np.ceil(np.log2(min_tile_cover)))
+    max_zoom = bbi_files.get(bwpath).quadtree_depth
     tileset_info = {
         "min_pos": [0],
         "max_pos": [TILE_SIZE * 2 ** max_zoom],
@@ -247,7 +369,7 @@ def chunk(
     print_per_chrom: callable = None,
 ):
     if chromsizes is None:
-        chromsizes = bbi.chromsizes(bigwig)
+        chromsizes = get_chromsizes(bigwig)
 
     base_bins = np.ceil(window_size / resolution).astype(int)
 
@@ -271,21 +393,26 @@ def chunk(
         chromsize = chromsizes[chrom]
         num_windows = np.ceil((chromsize - window_size) / step_size).astype(int) + 1
 
-        start_bps = np.arange(0, chromsize - window_size + step_size, step_size)
-        end_bps = np.arange(window_size, chromsize + step_size, step_size)
+        start_bps, end_bps = get_window_positions(chromsize, window_size, step_size)
 
         end = start + num_windows
 
-        values[start:end] = bbi.stackup(
-            bigwig,
-            [chrom] * start_bps.size,
-            start_bps,
-            end_bps,
-            bins=bins,
-            missing=0.0,
-            oob=0.0,
+        windows = fetch_windows(
+            bigwig, chrom, chromsize, window_size, resolution, step_size
         )
 
+        if windows is None:
+            windows = bbi_files.get(bigwig).stackup(
+                [chrom] * start_bps.size,
+                start_bps,
+                end_bps,
+                bins=bins,
+                missing=0.0,
+                oob=0.0,
+            )
+
+        values[start:end] = windows
+
         if normalize:
             values[start:end] = utils.normalize(
                 values[start:end], percentile=percentile
@@ -307,7 +434,243 @@ def chunk(
     return values
 
 
+def get_window_positions(chromsize: int, window_size: int, step_size: int):
+    """Get the start and end positions of the windows of a chromosome"""
+    start_bps = np.arange(0, chromsize - window_size + step_size, step_size)
+    end_bps = np.arange(window_size, chromsize + step_size, step_size)
+    return start_bps, end_bps
+
+
+def fetch_windows(
+    bigwig: str,
+    chrom: str,
+    chromsize: int,
+    window_size: int,
+    resolution: int,
+    step_size: int,
+):
+    """Fetch all windows of a chromosome from a single binned signal
+
+    The chromosome is binned once at `resolution` and the overlapping windows are
+    a strided view of that signal, i.e., every base is only read once instead of
+    `window_size / step_size` times. The windows are identical to stacking up the
+    windows individually.
+
+    Returns:
+        {np.ndarray} -- Read-only view of shape `(num_windows, bins)` or `None` if
+            the window or step size is not a multiple of the resolution, in which
+            case the bins of the windows do not line up.
+    """
+    if window_size % resolution or step_size % resolution:
+        return None
+
+    bins = window_size // resolution
+    step = step_size // resolution
+    num_windows = np.ceil((chromsize - window_size) / step_size).astype(int) + 1
+
+    # The last window might extend beyond the end of the chromosome
+    num_bins = (num_windows - 1) * step + bins
+
+    signal = bbi_files.get(bigwig).fetch(
+        chrom, 0, num_bins * resolution, bins=num_bins, missing=0.0, oob=0.0
+    )
+
+    return sliding_window_view(signal, bins)[::step]
+
+
+def iter_window_batches(
+    bigwig: str,
+    chrom: str,
+    chromsize: int,
+    window_size: int,
+    resolution: int,
+    step_size: int,
+    batch_size: int = BATCH_SIZE,
+):
+    """Iterate over the raw windows of a chromosome in batches
+
+    Unless the windows do not line up with the bins, the chromosome is only read
+    once and the batches are slices of the strided windows from `fetch_windows()`.
+    """
+    num_windows = np.ceil((chromsize - window_size) / step_size).astype(int) + 1
+
+    windows = fetch_windows(
+        bigwig, chrom, chromsize, window_size, resolution, step_size
+    )
+
+    if windows is not None:
+        for start in range(0, num_windows, batch_size):
+            yield windows[start : start + batch_size]
+        return
+
+    bins = np.ceil(window_size / resolution).astype(int)
+    start_bps, end_bps = get_window_positions(chromsize, window_size, step_size)
+
+    for start in range(0, num_windows, batch_size):
+        end = min(start + batch_size, num_windows)
+        yield bbi_files.get(bigwig).stackup(
+            [chrom] * (end - start),
+            start_bps[start:end],
+            end_bps[start:end],
+            bins=bins,
+            missing=0.0,
+            oob=0.0,
+        )
+
+
+def get_normalizer(
+    bigwig: str,
+    window_size: int,
+    resolution: int,
+    step_size: int,
+    chroms: list,
+    percentile: float = 99.9,
+    batch_size: int = BATCH_SIZE,
+    chromsizes=None,
+):
+    """Collect the normalization statistics of the windows in one streaming pass
+
+    The returned normalizer is not fitted yet, such that the normalizers of
+    different chromosomes can be merged first.
+
+    Returns:
+        {utils.Normalizer} -- Normalizer updated with all windows of `chroms`
+    """
+    if chromsizes is None:
+        chromsizes = get_chromsizes(bigwig)
+
+    normalizer = utils.Normalizer(percentile)
+
+    for chrom in chroms:
+        for batch in iter_window_batches(
+            bigwig,
+            chrom,
+            chromsizes[chrom],
+            window_size,
+            resolution,
+            step_size,
+            batch_size=batch_size,
+        ):
+            normalizer.update(batch)
+
+    return normalizer
+
+
+def chunk_batches(
+    bigwig: str,
+    window_size: int,
+    resolution: int,
+    step_size: int,
+    chroms: list,
+    normalize: bool = True,
+    normalizer=None,
+    percentile: float = 99.9,
+    batch_size: int = BATCH_SIZE,
+    verbose: bool = False,
+    chromsizes=None,
+):
+    """Extract windows in batches with bounded memory
+
+    This is the streaming equivalent of `chunk()`. Batches never span two
+    chromosomes. Unlike `chunk()`, the windows are normalized with the same
+    genome-wide clip bounds and scaling across all chromosomes.
+
+    Arguments:
+        bigwig {str} -- Path to the bigWig file
+        window_size {int} -- Window size in base pairs
+        resolution {int} -- Bin size in base pairs
+        step_size {int} -- Step size in base pairs
+        chroms {list} -- Chromosomes
+
+    Keyword Arguments:
+        normalize {bool} -- If `True` clip and min-max scale the windows
+            (default: {True})
+        normalizer {utils.Normalizer} -- Fitted normalizer. If `None` it is
+            computed from all windows of `chroms` in an extra pass. (default: {None})
+        percentile {float} -- Upper percentile for clipping (default: {99.9})
+        batch_size {int} -- Maximum number of windows per batch
+            (default: {BATCH_SIZE})
+
+    Yields:
+        {tuple} -- Index of the first window of the batch across all chromosomes
+            and the float32 windows of shape `(num_windows, bins)`
+    """
+    if chromsizes is None:
+        chromsizes = get_chromsizes(bigwig)
+
+    if normalize and normalizer is None:
+        normalizer = get_normalizer(
+            bigwig,
+            window_size,
+            resolution,
+            step_size,
+            chroms,
+            percentile=percentile,
+            batch_size=batch_size,
+            chromsizes=chromsizes,
+        )
+        normalizer.fit()
+
+    offset = 0
+    for chrom in chroms:
+        num_windows = 0
+        max_value = -np.inf
+
+        for batch in iter_window_batches(
+            bigwig,
+            chrom,
+            chromsizes[chrom],
+            window_size,
+            resolution,
+            step_size,
+            batch_size=batch_size,
+        ):
+            batch = np.array(batch, dtype=np.float32)
+
+            if normalize:
+                normalizer.transform(batch)
+
+            if verbose:
+                max_value = np.fmax(max_value, np.nanmax(batch))
+
+            yield offset + num_windows, batch
+
+            num_windows += batch.shape[0]
+
+        if verbose:
+            print(
+                "Extracted",
+                "{} windows".format(num_windows),
+                "from {}".format(chrom),
+                "with a max value of {}.".format(max_value),
+            )
+
+        offset += num_windows
+
+
+def fetch_chrom(
+    bwpath: str, chrom: str, chromsize: int, binsize: int, summary: str = "mean"
+):
+    """Fetch an entire chromosome in bins of exactly `binsize` base pairs.
+
+    The last bin extends beyond the end of the chromosome and only summarizes the
+    remaining base pairs.
+    """
+    n_bins = int(np.ceil(chromsize / binsize))
+    return bbi_files.get(bwpath).fetch(
+        chrom,
+        0,
+        n_bins * binsize,
+        bins=n_bins,
+        missing=np.nan,
+        oob=np.nan,
+        summary=summary,
+    )
+
+
 def get(
     bw_path: str, chrom: str, start: int, end: int, bins: int, missing: float = 0.0
 ):
-    return bbi.fetch(bw_path, chrom, start, end, bins=bins, missing=missing)
+    return bbi_files.get(bw_path).fetch(
+        chrom, start, end, bins=bins, missing=missing
+    )
@@ -13,6 +13,7 @@ limitations under the License.
 
 import _thread
 import joblib
+import numpy as np
 
 from io import BytesIO
 
@@ -20,6 +21,10 @@ from sklearn.utils import all_estimators
 
 estimators = all_estimators()
 
+# Number of windows predicted at once. Large inputs, e.g., quantized encodings, are
+# only decoded block by block.
+PREDICT_BLOCK_SIZE = 2 ** 18
+
 from server.utils import (
     unpredictability,
     prediction_proba_change,
@@ -84,6 +89,7 @@ class Classifier:
     ):
         self.search_id = search_id
         self.classifier_id = classifier_id
+        self.created = kwargs.get("created")
 
         if isinstance(classifier_class, str):
             if get_classifier(classifier_class) is not None:
@@ -159,10 +165,18 @@ class Classifier:
         if not self.is_trained:
             return None, None
 
-        fit_y = self.model.predict(X)
-        p_y = self.model.predict_proba(X)
+        if X.shape[0] <= PREDICT_BLOCK_SIZE:
+            X = X[:]
+            return self.model.predict(X), self.model.predict_proba(X)
+
+        fit_y = []
+        p_y = []
+        for start in range(0, X.shape[0], PREDICT_BLOCK_SIZE):
+            X_block = X[start : start + PREDICT_BLOCK_SIZE]
+            fit_y.append(self.model.predict(X_block))
+            p_y.append(self.model.predict_proba(X_block))
 
-        return fit_y, p_y
+        return np.concatenate(fit_y), np.concatenate(p_y)
 
     def train(
         self, train_X, train_y, n_estimators: int = 100, callback: callable = None
@@ -43,8 +43,11 @@ class Classifiers:
         window_size: int,
         abs_offset: int,
         min_classifications: int = MIN_CLASSIFICATIONS,
+        on_trained: callable = None,
     ):
         self.classifiers = {}
+        # Latest classifier per search to avoid hitting the database, e.g., for tiles
+        self.latest = {}
         self.db = db
         self.data = data
         self.classifier_class = classifier_class
@@ -52,12 +55,17 @@ class Classifiers:
         self.window_size = window_size
         self.abs_offset = abs_offset
         self.min_classifications = min_classifications
+        self.on_trained = on_trained
 
     def delete(self, search_id: int, classifier_id: int = None):
         self.db.delete_classifier(search_id, classifier_id)
         self.classifiers.pop(search_id, None)
+        self.latest.pop(str(search_id), None)
 
     def get(self, search_id: int, classifier_id: int = None, **kwargs):
+        if classifier_id is None and str(search_id) in self.latest:
+            return self.latest[str(search_id)]
+
         classifier_info = self.db.get_classifier(search_id, classifier_id)
 
         if classifier_info is None:
@@ -73,13 +81,19 @@ class Classifiers:
                 )
             )
 
+        requested_id = classifier_id
         classifier_id = classifier_info["classifier_id"]
 
         if (
             search_id in self.classifiers
             and classifier_id in self.classifiers[search_id]
         ):
-            return self.classifiers[search_id][classifier_id]
+            classifier = self.classifiers[search_id][classifier_id]
+
+            if requested_id is None:
+                self.latest[str(search_id)] = classifier
+
+            return classifier
 
         classifier = Classifier(
             classifier_class=self.classifier_class,
@@ -99,6 +113,9 @@ class Classifiers:
         else:
             self.classifiers[search_id][classifier.classifier_id] = classifier
 
+        if requested_id is None:
+            self.latest[str(search_id)] = classifier
+
         return classifier
 
     def evaluate(
@@ -285,6 +302,7 @@ class Classifiers:
 
         classifier = self.get(search_id, classifier_id)
         classifier.serialized_classifications = new_classif
+        self.latest[str(search_id)] = classifier
 
         if search_id not in self.classifiers:
             self.classifiers[search_id] = {classifier.classifier_id: classifier}
@@ -296,6 +314,9 @@ class Classifiers:
             dumped_model = classifier.dump()
             self.db.set_classifier(search_id, classifier_id, model=dumped_model)
 
+            if self.on_trained is not None:
+                self.on_trained(classifier)
+
             # Evaluate classifier
             self.evaluate(search_id, classifier_id)
 
@@ -7,7 +7,7 @@ from typing import Dict, List, TypeVar
 from server.chromsizes import all as all_chromsizes, SUPPORTED_CHROMOSOMES
 from server.dataset import Dataset
 from server.datasets import Datasets
-from server.defaults import CLASSIFIER, CLASSIFIER_PARAMS, CACHE_DIR, CACHING, COORDS, DB_PATH, STEP_FREQ, MIN_CLASSIFICATIONS
+from server.defaults import CLASSIFIER, CLASSIFIER_PARAMS, CACHE_DIR, CACHING, COORDS, DB_PATH, STEP_FREQ, MIN_CLASSIFICATIONS, TILE_PYRAMID, TILE_CACHE_SIZE, TILE_WORKERS, PREPARE_WORKERS, CACHE_COMPRESSION, QUANTIZE_ENCODINGS
 from server.encoder import Autoencoder, Encoder
 from server.encoders import Encoders
 from server.exceptions import InvalidConfig
@@ -35,6 +35,12 @@ class Config:
         self.db_path = DB_PATH
         self.cache_dir = CACHE_DIR
         self.caching = CACHING
+        self.tile_pyramid = TILE_PYRAMID
+        self.tile_cache_size = TILE_CACHE_SIZE
+        self.tile_workers = TILE_WORKERS
+        self.prepare_workers = PREPARE_WORKERS
+        self.cache_compression = CACHE_COMPRESSION
+        self.quantize_encodings = QUANTIZE_ENCODINGS
         self.variable_target = False
         self.normalize_tracks = False
 
@@ -271,6 +277,85 @@ class Config:
     def caching(self, value: bool):
         self._caching = bool(value)
 
+    @property
+    def tile_pyramid(self):
+        return self._tile_pyramid
+
+    @tile_pyramid.setter
+    def tile_pyramid(self, value: bool):
+        self._tile_pyramid = bool(value)
+
+    @property
+    def tile_cache_size(self):
+        return self._tile_cache_size
+
+    @tile_cache_size.setter
+    def tile_cache_size(self, value: int):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise InvalidConfig("The tile cache size needs to be an integer")
+
+        if value < 0:
+            raise InvalidConfig("The tile cache size must not be negative")
+
+        self._tile_cache_size = value
+
+    @property
+    def tile_workers(self):
+        return self._tile_workers
+
+    @tile_workers.setter
+    def tile_workers(self, value: int):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise InvalidConfig("The number of tile workers needs to be an integer")
+
+        if value < 1:
+            raise InvalidConfig("The number of tile workers must be larger than zero")
+
+        self._tile_workers = value
+
+    @property
+    def prepare_workers(self):
+        return self._prepare_workers
+
+    @prepare_workers.setter
+    def prepare_workers(self, value: int):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise InvalidConfig("The number of prepare workers needs to be an integer")
+
+        if value < 1:
+            raise InvalidConfig(
+                "The number of prepare workers must be larger than zero"
+            )
+
+        self._prepare_workers = value
+
+    @property
+    def cache_compression(self):
+        return self._cache_compression
+
+    @cache_compression.setter
+    def cache_compression(self, value: str):
+        if value not in (None, "lzf", "gzip"):
+            raise InvalidConfig(
+                "The cache compression must either be `null`, `lzf`, or `gzip`"
+            )
+
+        self._cache_compression = value
+
+    @property
+    def quantize_encodings(self):
+        return self._quantize_encodings
+
+    @quantize_encodings.setter
+    def quantize_encodings(self, value: bool):
+        self._quantize_encodings = bool(value)
+
     def set(self, key, value):
         if key == "chroms":
             self.chroms = value
@@ -299,6 +384,24 @@ class Config:
         elif key == "caching":
             self.caching = value
 
+        elif key == "tile_pyramid":
+            self.tile_pyramid = value
+
+        elif key == "tile_cache_size":
+            self.tile_cache_size = value
+
+        elif key == "tile_workers":
+            self.tile_workers = value
+
+        elif key == "prepare_workers":
+            self.prepare_workers = value
+
+        elif key == "cache_compression":
+            self.cache_compression = value
+
+        elif key == "quantize_encodings":
+            self.quantize_encodings = value
+
         elif key == "variable_target":
             self.variable_target = value
 
@@ -11,6 +11,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import hashlib
 import json
 import sqlite3
 from server.defaults import DB_PATH
@@ -420,6 +421,28 @@ class DB:
     def get_classifications(self, search_id):
         return self.get_classification(search_id)
 
+    def get_classifications_version(self, search_id):
+        """Get a version of the classifications of a search
+
+        The version is a hash of all classifications, hence, it changes whenever a
+        classification is added, changed, or removed.
+        """
+        md5 = hashlib.md5()
+
+        with self.connect() as conn:
+            for window_id, is_positive in conn.execute(
+                """
+                SELECT window_id, is_positive
+                FROM classification
+                WHERE search_id = ?
+                ORDER BY window_id
+                """,
+                (search_id,),
+            ):
+                md5.update("{}:{};".format(window_id, is_positive).encode("ascii"))
+
+        return md5.hexdigest()
+
     def set_classification(self, search_id, window_id, is_positive):
         with self.connect() as conn:
             conn.execute(
@@ -16,14 +16,295 @@ import h5py
 import hashlib
 import numpy as np
 import pandas as pd
+import pickle
 import re
 
+from collections import deque
 from contextlib import contextmanager, suppress
 
 from server import bigwig
+from server import features
+from server import http_cache
+from server import pyramid
+from server import tile_encoding
 from server import utils
+from server import vector
 from server.chromsizes import get as get_chromsizes
 
+# Number of values to be copied at once when exporting the autoencodings
+EXPORT_CHUNK_SIZE = 2 ** 24
+
+# Number of window batches buffered between the extraction, encoding, and writing
+# stages
+PIPELINE_QUEUE_SIZE = 2
+
+# Number of chromosomes per worker process that are prepared ahead of writing
+CHROMOSOMES_IN_FLIGHT = 2
+
+# Upper percentile of the window values at which the windows are clipped
+NORMALIZATION_PERCENTILE = 99.9
+
+# Encoders of a worker process by their model path. See `init_worker()`.
+_worker_encoders = {}
+
+
+def init_worker(encoders):
+    """Initialize a worker process of the process pool used by `Dataset.prepare()`
+
+    The encoders are kept for the life of the worker, such that every encoder's
+    model is loaded at most once per worker instead of once per chromosome.
+
+    Arguments:
+        encoders {list} -- Encoders
+    """
+    for encoder in encoders:
+        _worker_encoders[encoder.model_filepath] = encoder
+
+
+def extract_windows(
+    chromosome: str,
+    filepath: str,
+    chromsizes,
+    encoder,
+    step_size: int,
+    normalizer,
+    verbose: bool = False,
+):
+    """Extract the windows of one chromosome in batches in the encoder's input shape
+
+    Yields:
+        {tuple} -- Index of the batch's first window within the chromosome and the
+            windows of the batch
+    """
+    if verbose:
+        print("Extract windows of {}...".format(chromosome), flush=True)
+
+    for start, windows in bigwig.chunk_batches(
+        filepath,
+        encoder.window_size,
+        encoder.resolution,
+        step_size,
+        [chromosome],
+        normalizer=normalizer,
+        chromsizes=chromsizes,
+        verbose=verbose,
+    ):
+        if encoder.input_dim == 3 and windows.ndim == 2:
+            # Keras expects 3 input dimensions:
+            # 1. number of samples (== number of windows)
+            # 2. sample size (== number of bins per window)
+            # 3. sample dim  (== 1 because each window just has 1 dim)
+            windows = windows.reshape(*windows.shape, encoder.channels)
+
+        yield start, windows
+
+
+def encode_windows(windows, encoder):
+    """Encode and autoencode a batch of windows
+
+    Returns:
+        {tuple} -- Encodings and reconstructed windows, which are `None` if the
+            encoder does not support decoding
+    """
+    encoding = encoder.encode(windows)
+
+    autoencoding = None
+
+    if hasattr(encoder, "decode"):
+        autoencoding = encoder.decode(encoding)
+
+    return encoding, autoencoding
+
+
+def prepare_chromosome(
+    chromosome: str,
+    filepath: str,
+    chromsizes,
+    encoder_filepath: str,
+    step_size: int,
+    normalizer,
+    batches_filepath: str,
+    verbose: bool = False,
+):
+    """Extract, encode, and autoencode the windows of one chromosome
+
+    This is a module-level function such that it can be run in a process pool
+    initialized with `init_worker()`. Only the encoder's model path is passed to
+    avoid pickling the encoder for every chromosome. The batches are streamed to a
+    temporary file instead of being returned, such that neither the worker nor the
+    parent process hold all batches of a chromosome in memory. See
+    `read_batches()`.
+
+    Returns:
+        {str} -- Path of the file with the pickled
+            `(start, windows, encodings, reconstructions)` tuple per batch
+    """
+    encoder = _worker_encoders[encoder_filepath]
+
+    try:
+        with open(batches_filepath, "wb") as f:
+            for start, windows in extract_windows(
+                chromosome,
+                filepath,
+                chromsizes,
+                encoder,
+                step_size,
+                normalizer,
+                verbose=verbose,
+            ):
+                pickle.dump(
+                    (start, windows) + encode_windows(windows, encoder),
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(batches_filepath)
+        raise
+
+    return batches_filepath
+
+
+def read_batches(batches_filepath: str):
+    """Read the batches written by `prepare_chromosome()` one at a time"""
+    with open(batches_filepath, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class CacheWriter:
+    """Create the datasets of a dataset's cache and write prepared batches to it
+
+    Arguments:
+        f {h5py.File} -- Opened cache file
+        encoder {Encoder} -- Encoder of the windows
+        config {Config} -- Config
+        step_size {int} -- Step size of the windows in base pairs
+        chrom_num_windows {pd.Series} -- Number of windows per chromosome
+        chrom_res_sizes {pd.Series} -- Number of bins per chromosome
+        normalizer {Normalizer} -- Normalization of the windows
+        file_version {str} -- Version of the dataset's file the normalization was
+            fitted to. See `http_cache.get_file_version()`.
+    """
+
+    def __init__(
+        self,
+        f,
+        encoder,
+        config,
+        step_size: int,
+        chrom_num_windows,
+        chrom_res_sizes,
+        normalizer,
+        file_version: str,
+    ):
+        self.f = f
+        self.encoder = encoder
+        self.step_freq = config.step_freq
+        self.chrom_num_windows = chrom_num_windows
+        self.chrom_res_sizes = chrom_res_sizes
+        self.num_bins = None
+
+        total_num_windows = int(chrom_num_windows.sum())
+        ascii_chroms = [n.encode("ascii", "ignore") for n in config.chroms]
+
+        self.w = f.create_dataset(
+            "windows", (total_num_windows, encoder.window_num_bins), dtype=np.float32
+        )
+        self.e = f.create_dataset(
+            "encodings", (total_num_windows, encoder.latent_dim), dtype=np.float32
+        )
+
+        self.ft = f.create_dataset(
+            "features", (len(features.FEATURES), total_num_windows), dtype=np.float32
+        )
+        self.ft.attrs["names"] = features.FEATURES
+
+        # Metadata
+        self.w.attrs["window_size"] = encoder.window_size
+        self.w.attrs["resolution"] = encoder.resolution
+        self.w.attrs["step_size"] = step_size
+        self.w.attrs["step_freq"] = config.step_freq
+        self.w.attrs["chrom_order"] = ascii_chroms
+        self.w.attrs["chrom_num_windows"] = chrom_num_windows
+        for key, value in normalizer.get_params().items():
+            self.w.attrs["normalization_{}".format(key)] = value
+        self.w.attrs["normalization_file_version"] = file_version or ""
+        self.w.attrs["normalization_chroms"] = ":".join(config.chroms)
+        self.e.attrs["file_name"] = encoder.encoder_filename
+        self.e.attrs["chrom_num_windows"] = chrom_num_windows
+        self.e.attrs["chrom_order"] = ascii_chroms
+
+        self.a = None
+        if hasattr(encoder, "autoencode"):
+            self.a = f.create_dataset(
+                "autoencodings", (int(chrom_res_sizes.sum()),), dtype=np.float32
+            )
+            self.a.attrs["chrom_num_windows"] = chrom_num_windows
+            self.a.attrs["chrom_res_sizes"] = chrom_res_sizes
+            self.a.attrs["chrom_order"] = ascii_chroms
+            self.a.attrs["file_name"] = encoder.encoder_filename
+
+        self.chrom_window_offsets = np.cumsum(chrom_num_windows) - chrom_num_windows
+        self.chrom_res_offsets = np.cumsum(chrom_res_sizes) - chrom_res_sizes
+        self.kernel = utils.get_norm_sym_norm_kernel(
+            encoder.window_size // encoder.resolution
+        )
+        self.mergers = {}
+
+    def write(self, chromosome, start, windows, encoding, autoencoding):
+        chr_str = str(chromosome)
+        num_windows, num_bins = windows.shape[:2]
+
+        if self.num_bins is None:
+            self.num_bins = num_bins
+
+        assert (
+            self.num_bins == num_bins
+        ), "Changing number of bins between chromosomes is not allowed"
+
+        assert (
+            self.encoder.window_num_bins == self.num_bins
+        ), "Encoder should have the same number of bins as the final data"
+
+        # Data is organized by chromosomes. Currently interchromosomal
+        # patterns are not allowed
+        pos = self.chrom_window_offsets[chr_str] + start
+        self.w[pos : pos + num_windows] = windows.reshape(num_windows, num_bins)
+        self.e[pos : pos + num_windows] = encoding
+        self.ft[:, pos : pos + num_windows] = features.compute(windows)
+
+        if autoencoding is not None:
+            self.write_autoencoding(chr_str, autoencoding.reshape(num_windows, -1))
+
+        # Lets write to disk
+        self.f.flush()
+
+    def write_autoencoding(self, chr_str, autoencoding):
+        if chr_str not in self.mergers:
+            # Merge interleaved autoencoded windows to one continuous track as the
+            # batches come in
+            self.mergers[chr_str] = utils.InterleavedMerger(
+                self.chrom_num_windows[chr_str],
+                autoencoding.shape[1],
+                self.step_freq,
+                self.kernel,
+            )
+
+        merger = self.mergers[chr_str]
+        merged_from = merger.pos
+        merged = merger.add(autoencoding)
+        merged_to = min(self.chrom_res_sizes[chr_str], merged_from + merged.size)
+
+        if merged_to > merged_from:
+            pos_ae = self.chrom_res_offsets[chr_str]
+            self.a[pos_ae + merged_from : pos_ae + merged_to] = merged[
+                : merged_to - merged_from
+            ]
+
 
 class Dataset:
     def __init__(
@@ -55,6 +336,10 @@ class Dataset:
         self.coords = coords
 
         self._cache = None
+        self._tile_pyramid = None
+        self._tile_pyramid_filepath = None
+        self._autoencodings = None
+        self._autoencodings_pyramid = None
 
         if self.chromsizes is None:
             self.chromsizes = get_chromsizes(self.coords, self.filepath)
@@ -71,6 +356,52 @@ class Dataset:
     def cache_filepath(self):
         return self._cache_filepath
 
+    @property
+    def tile_pyramid_filepath(self):
+        return self._tile_pyramid_filepath
+
+    @property
+    def tile_pyramid(self):
+        if self._tile_pyramid is None and self.tile_pyramid_filepath is not None:
+            self._tile_pyramid = pyramid.Pyramid(self.tile_pyramid_filepath)
+        return self._tile_pyramid
+
+    @property
+    def autoencodings_filepath(self):
+        return "{}_autoencodings.f32".format(os.path.splitext(self.cache_filepath)[0])
+
+    @property
+    def autoencodings_pyramid_filepath(self):
+        return "{}_autoencodings_pyramid.hdf5".format(
+            os.path.splitext(self.cache_filepath)[0]
+        )
+
+    @property
+    def autoencodings_pyramid(self):
+        if self._autoencodings_pyramid is None and os.path.exists(
+            self.autoencodings_pyramid_filepath
+        ):
+            self._autoencodings_pyramid = pyramid.Pyramid(
+                self.autoencodings_pyramid_filepath
+            )
+        return self._autoencodings_pyramid
+
+    @property
+    def autoencodings(self):
+        """Memory-mapped autoencodings, i.e., the reconstructed genome-wide track"""
+        if self._autoencodings is None:
+            if not os.path.exists(self.autoencodings_filepath):
+                self.export_autoencodings()
+
+            if os.path.getsize(self.autoencodings_filepath) == 0:
+                self._autoencodings = np.zeros(0, dtype=np.float32)
+            else:
+                self._autoencodings = np.memmap(
+                    self.autoencodings_filepath, dtype=np.float32, mode="r"
+                )
+
+        return self._autoencodings
+
     def get_cache_filename(self, window_size: int, step_freq: int, chroms: list):
         md5 = hashlib.md5()
         md5.update(":".join(chroms).encode())
@@ -114,9 +445,320 @@ class Dataset:
         with suppress(FileNotFoundError):
             os.remove(self.cache_filepath)
 
-    def prepare(
+        if self.tile_pyramid_filepath is not None:
+            with suppress(FileNotFoundError):
+                os.remove(self.tile_pyramid_filepath)
+
+        self._autoencodings = None
+        with suppress(FileNotFoundError):
+            os.remove(self.autoencodings_filepath)
+
+        self._autoencodings_pyramid = None
+        with suppress(FileNotFoundError):
+            os.remove(self.autoencodings_pyramid_filepath)
+
+    def tiles(self, tile_ids, executor=None):
+        """Get bigWig tiles from the tile pyramid if possible.
+
+        Tiles of zoom levels that are finer than the pyramid's finest zoom level are
+        fetched from the bigWig file, optionally using `executor` to fetch runs of
+        tiles concurrently.
+        """
+        if self.tile_pyramid is None:
+            return bigwig.tiles(
+                self.filepath, tile_ids, self.chromsizes, executor=executor
+            )
+
+        pyramid_tile_ids = []
+        bigwig_tile_ids = []
+        for tile_id in tile_ids:
+            _, zoom_level, _ = bigwig.parse_tile_id(tile_id)
+            if self.tile_pyramid.has_zoom(zoom_level):
+                pyramid_tile_ids.append(tile_id)
+            else:
+                bigwig_tile_ids.append(tile_id)
+
+        tiles = self.tile_pyramid.tiles(pyramid_tile_ids, self.chromsizes)
+
+        if bigwig_tile_ids:
+            tiles += bigwig.tiles(
+                self.filepath, bigwig_tile_ids, self.chromsizes, executor=executor
+            )
+
+        return tiles
+
+    def autoencoding_tiles(self, tile_ids, resolution: int, abs_offset, abs_len):
+        """Get tiles of the autoencodings
+
+        Tiles are cut out of the autoencodings pyramid if possible. Zoom levels
+        finer than the autoencodings' resolution are scaled up from the memory-mapped
+        autoencodings.
+
+        Arguments:
+            tile_ids {list} -- Tile ids
+            resolution {int} -- Number of base pairs per autoencoding value
+            abs_offset {int} -- Absolute position of the first autoencoding value
+            abs_len {int} -- Number of base pairs covered by the autoencodings
+
+        Returns:
+            {list} -- List of `(tile_id, tile_value)` tuples
+        """
+        max_depth = bigwig.get_quadtree_depth(self.chromsizes)
+
+        generated_tiles = []
+        for tile_id in tile_ids:
+            _, zoom_level, tile_pos = bigwig.parse_tile_id(tile_id)
+
+            if (
+                self.autoencodings_pyramid is None
+                or not self.autoencodings_pyramid.has_zoom(zoom_level)
+            ):
+                generated_tiles += vector.tiles(
+                    self.autoencodings,
+                    resolution,
+                    abs_len,
+                    abs_offset,
+                    [tile_id],
+                    self.chromsizes,
+                )
+                continue
+
+            tile_size = bigwig.TILE_SIZE * 2 ** (max_depth - zoom_level)
+            start_pos = tile_pos * tile_size
+            end_pos = start_pos + tile_size
+
+            dense = self.autoencodings_pyramid.get_tile(
+                zoom_level, start_pos, end_pos, self.chromsizes
+            )
+            dense = np.nan_to_num(dense, copy=True)
+
+            generated_tiles += [(tile_id, tile_encoding.get_tile_value(dense))]
+
+        return generated_tiles
+
+    def prepare_autoencodings(
+        self, config, encoder, clear: bool = False, verbose: bool = False
+    ):
+        """Export the autoencodings and build their tile pyramid
+
+        The autoencodings are exported as a flat float32 file next to the cache and
+        the export is redone when the cache is newer. The mean tile pyramid of the
+        autoencodings is built from the exported file and rebuilt when the file is
+        newer, such that coarse autoencoding tiles are never aggregated on request.
+        """
+        if (
+            clear
+            or not os.path.exists(self.autoencodings_filepath)
+            or os.path.getmtime(self.autoencodings_filepath)
+            < os.path.getmtime(self.cache_filepath)
+        ):
+            self.export_autoencodings(verbose=verbose)
+
+        if (
+            not clear
+            and not pyramid.is_outdated(self.autoencodings_pyramid_filepath)
+            and os.path.getmtime(self.autoencodings_pyramid_filepath)
+            >= os.path.getmtime(self.autoencodings_filepath)
+        ):
+            return
+
+        if verbose:
+            print("Build autoencodings pyramid of {}...".format(self.name), flush=True)
+
+        chrom_offsets = np.cumsum(self.chromsizes) - self.chromsizes
+        abs_offset = min(chrom_offsets[chrom] for chrom in config.chroms)
+
+        def fetch(chrom, chromsize, binsize, aggregator):
+            start = chrom_offsets[chrom]
+            return pyramid.bin_vector(
+                self.autoencodings,
+                encoder.resolution,
+                abs_offset,
+                start,
+                start + chromsize,
+                binsize,
+                aggregator=aggregator,
+            )
+
+        self._autoencodings_pyramid = None
+        tmp_filepath = "{}.tmp".format(self.autoencodings_pyramid_filepath)
+
+        try:
+            pyramid.build(
+                tmp_filepath,
+                self.chromsizes,
+                encoder.resolution,
+                fetch,
+                aggregators=("mean",),
+                clear=True,
+                verbose=verbose,
+            )
+            os.replace(tmp_filepath, self.autoencodings_pyramid_filepath)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp_filepath)
+            raise
+
+    def export_autoencodings(self, verbose: bool = False):
+        """Export the autoencodings as a flat float32 file next to the cache
+
+        The file holds the raw values in C order, such that it can be memory-mapped
+        for the life of the server.
+        """
+        if verbose:
+            print("Export autoencodings of {}...".format(self.name), flush=True)
+
+        self._autoencodings = None
+        tmp_filepath = "{}.tmp".format(self.autoencodings_filepath)
+
+        with self.cache() as dsc, open(tmp_filepath, "wb") as f:
+            autoencodings = dsc.autoencodings
+            for start in range(0, autoencodings.shape[0], EXPORT_CHUNK_SIZE):
+                chunk = autoencodings[start : start + EXPORT_CHUNK_SIZE]
+                f.write(np.ascontiguousarray(chunk, dtype=np.float32).tobytes())
+
+        os.replace(tmp_filepath, self.autoencodings_filepath)
+
+    def prepare_tile_pyramid(
         self, config, encoder, clear: bool = False, verbose: bool = False
+    ):
+        """Precompute the min, max, and mean tiles of every zoom level
+
+        The finest zoom level of the pyramid is the highest zoom level whose bin size
+        is at least the encoder's resolution.
+        """
+        if not bigwig.is_bigwig(self.filepath, self.filetype):
+            return
+
+        finest_zoom = pyramid.get_finest_zoom(self.chromsizes, encoder.resolution)
+        binsize = bigwig.get_zoom_resolutions(self.chromsizes)[finest_zoom]
+
+        self._tile_pyramid_filepath = os.path.join(
+            config.cache_dir,
+            "{}_pyramid_r-{}.hdf5".format(os.path.splitext(self.filename)[0], binsize),
+        )
+        self._tile_pyramid = None
+
+        if not pyramid.is_outdated(self.tile_pyramid_filepath) and not clear:
+            return
+
+        if verbose:
+            print("Build tile pyramid for {}...".format(self.name), flush=True)
+
+        available_chroms = bigwig.get_chromsizes(self.filepath)
+
+        def fetch(chrom, chromsize, binsize, aggregator):
+            if chrom not in available_chroms:
+                x = np.zeros(int(np.ceil(chromsize / binsize)))
+                x[:] = np.nan
+                return x
+
+            if aggregator == "coverage":
+                # Fraction of every bin with data
+                cov = bigwig.fetch_chrom(
+                    self.filepath, chrom, chromsize, binsize, summary="cov"
+                )
+                return np.nan_to_num(cov) * binsize
+
+            return bigwig.fetch_chrom(
+                self.filepath, chrom, chromsize, binsize, summary=aggregator
+            )
+
+        pyramid.build(
+            self.tile_pyramid_filepath,
+            self.chromsizes,
+            encoder.resolution,
+            fetch,
+            clear=True,
+            verbose=verbose,
+        )
+
+    def get_normalizer(
+        self,
+        config,
+        encoder,
+        step_size: int,
+        clear: bool = False,
+        executor=None,
+        verbose: bool = False,
+    ):
+        """Get the genome-wide normalization of the windows
+
+        The fitted normalization is stored with the prepared windows. Hence, when
+        the windows are prepared again, e.g., for a new encoder, the parameters are
+        read from the existing cache if the cache was prepared from the same file,
+        chromosomes, and windows. Otherwise, the statistics are collected in one
+        streaming pass over all chromosomes.
+
+        Keyword Arguments:
+            clear {bool} -- If `True` the stored normalization is not reused
+                (default: {False})
+            executor {concurrent.futures.Executor} -- If given, the statistics of the
+                chromosomes are collected concurrently and merged. (default: {None})
+
+        Returns:
+            {utils.Normalizer} -- Fitted normalizer
+        """
+        file_version = http_cache.get_file_version(self.filepath)
+
+        with suppress(OSError, KeyError):
+            with h5py.File(self.cache_filepath, "r") as f:
+                attrs = f["windows"].attrs
+                if (
+                    not clear
+                    and file_version is not None
+                    and attrs["normalization_file_version"] == file_version
+                    and attrs["normalization_chroms"] == ":".join(config.chroms)
+                    and attrs["window_size"] == encoder.window_size
+                    and attrs["resolution"] == encoder.resolution
+                    and attrs["step_size"] == step_size
+                    and attrs["normalization_percentile"] == NORMALIZATION_PERCENTILE
+                ):
+                    return utils.Normalizer().set_params(
+                        percentile=attrs["normalization_percentile"],
+                        cutoff=attrs["normalization_cutoff"],
+                        scale=attrs["normalization_scale"],
+                        min=attrs["normalization_min"],
+                    )
+
+        if verbose:
+            print("Collect normalization statistics...", flush=True)
+
+        args = (self.filepath, encoder.window_size, encoder.resolution, step_size)
+        kwargs = {"percentile": NORMALIZATION_PERCENTILE, "chromsizes": self.chromsizes}
+
+        if executor is None:
+            normalizer = bigwig.get_normalizer(*args, config.chroms, **kwargs)
+        else:
+            # Collect the statistics per chromosome and merge them
+            futures = [
+                executor.submit(bigwig.get_normalizer, *args, [chromosome], **kwargs)
+                for chromosome in config.chroms
+            ]
+            normalizer = futures[0].result()
+            for future in futures[1:]:
+                normalizer.merge(future.result())
+
+        normalizer.fit()
+
+        return normalizer
+
+    def prepare(
+        self,
+        config,
+        encoder,
+        clear: bool = False,
+        verbose: bool = False,
+        executor=None,
     ) -> int:
+        """Extract, encode, and autoencode the windows of all chromosomes
+
+        Keyword Arguments:
+            executor {concurrent.futures.Executor} -- If given, the chromosomes are
+                prepared concurrently. The results are written at the same offsets
+                as in the serial case. The worker processes must be initialized with
+                `init_worker()`. (default: {None})
+        """
         if verbose:
             print("Prepare {}...".format(self.name), flush=True)
 
@@ -129,13 +771,11 @@ class Dataset:
 
         mode = "w" if clear else "w-"
         step_size = encoder.window_size // config.step_freq
-        global_num_bins = None
 
         # Determine number of windows per chromsome
         num_windows_per_chrom = []
         total_num_windows = 0
         res_size_per_chrom = []
-        total_res_sizes = 0
 
         for chromosome in config.chroms:
             num_windows = (
@@ -148,7 +788,6 @@ class Dataset:
             total_num_windows += num_windows
             res_size = int(self.chromsizes[chromosome] // encoder.resolution)
             res_size_per_chrom.append(res_size)
-            total_res_sizes += res_size
 
         chrom_num_windows = pd.Series(
             num_windows_per_chrom, index=config.chroms, dtype=int
@@ -163,132 +802,59 @@ class Dataset:
 
         self._cache_filepath = os.path.join(config.cache_dir, cache_filename)
 
-        ascii_chroms = [n.encode("ascii", "ignore") for n in config.chroms]
+        # The windows of an existing cache are not prepared again, hence, the
+        # normalization is only needed when the cache is written
+        normalizer = None
+        if clear or not os.path.exists(self.cache_filepath):
+            normalizer = self.get_normalizer(
+                config,
+                encoder,
+                step_size,
+                clear=clear,
+                executor=executor,
+                verbose=verbose,
+            )
 
         try:
             with h5py.File(self.cache_filepath, mode) as f:
-                w = f.create_dataset(
-                    "windows",
-                    (total_num_windows, encoder.window_num_bins),
-                    dtype=np.float32,
-                )
-                e = f.create_dataset(
-                    "encodings",
-                    (total_num_windows, encoder.latent_dim),
-                    dtype=np.float32,
+                writer = CacheWriter(
+                    f,
+                    encoder,
+                    config,
+                    step_size,
+                    chrom_num_windows,
+                    chrom_res_sizes,
+                    normalizer,
+                    http_cache.get_file_version(self.filepath),
                 )
 
-                # Metadata
-                w.attrs["window_size"] = encoder.window_size
-                w.attrs["resolution"] = encoder.resolution
-                w.attrs["step_size"] = step_size
-                w.attrs["step_freq"] = config.step_freq
-                w.attrs["chrom_order"] = ascii_chroms
-                w.attrs["chrom_num_windows"] = chrom_num_windows
-                e.attrs["file_name"] = encoder.encoder_filename
-                e.attrs["chrom_num_windows"] = chrom_num_windows
-                e.attrs["chrom_order"] = ascii_chroms
-
-                if hasattr(encoder, "autoencode"):
-                    a = f.create_dataset(
-                        "autoencodings", (total_res_sizes,), dtype=np.float32
-                    )
-                    a.attrs["chrom_num_windows"] = chrom_num_windows
-                    a.attrs["chrom_res_sizes"] = chrom_res_sizes
-                    a.attrs["chrom_order"] = ascii_chroms
-                    a.attrs["file_name"] = encoder.encoder_filename
-
                 if verbose:
                     print("Extract windows for {}".format(self.id), flush=True)
-
-                pos = 0
-                pos_ae = 0
-
-                if verbose:
                     print(
                         "Prepare chromosomes: {}...".format(", ".join(config.chroms)),
                         flush=True,
                     )
 
-                for chromosome in config.chroms:
-                    chr_str = str(chromosome)
-
-                    if verbose:
-                        print("Extract windows...", flush=True)
-
-                    # Extract the windows
-                    windows = bigwig.chunk(
-                        self.filepath,
-                        encoder.window_size,
-                        encoder.resolution,
+                if executor is not None:
+                    self.prepare_chromosomes_concurrently(
+                        config,
+                        encoder,
                         step_size,
-                        [chromosome],
-                        chromsizes=self.chromsizes,
+                        normalizer,
+                        writer.write,
+                        executor,
+                        verbose=verbose,
+                    )
+                else:
+                    self.prepare_chromosomes(
+                        config,
+                        encoder,
+                        step_size,
+                        normalizer,
+                        writer.write,
                         verbose=verbose,
                     )
-                    num_windows, num_bins = windows.shape
-
-                    if global_num_bins is None:
-                        global_num_bins = num_bins
-
-                    assert (
-                        global_num_bins == num_bins
-                    ), "Changing number of bins between chromosomes is not allowed"
-
-                    assert (
-                        encoder.window_num_bins == global_num_bins
-                    ), "Encoder should have the same number of bins as the final data"
-
-                    if encoder.input_dim == 3 and windows.ndim == 2:
-                        # Keras expects 3 input dimensions:
-                        # 1. number of samples (== number of windows)
-                        # 2. sample size (== number of bins per window)
-                        # 3. sample dim  (== 1 because each window just has 1 dim)
-                        windows = windows.reshape(*windows.shape, encoder.channels)
-
-                    if verbose:
-                        print("Encode windows...", flush=True)
-
-                    encoding = encoder.encode(windows)
-
-                    # Data is organized by chromosomes. Currently interchromosomal
-                    # patterns are not allowed
-                    w[pos : pos + num_windows] = np.squeeze(windows)
-                    e[pos : pos + num_windows] = encoding
-
-                    pos += num_windows
-
-                    if hasattr(encoder, "decode"):
-                        if verbose:
-                            print(
-                                "Decode encoded windows, i.e., get the reconstructions...",
-                                flush=True,
-                            )
-
-                        autoencoding = encoder.decode(encoding)
-
-                        if verbose:
-                            print(
-                                "Merge interleaved reconstructed windows...", flush=True
-                            )
-
-                        # Merge interleaved autoencoded windows to one continuous track
-                        autoencoding = utils.merge_interleaved_mat(
-                            autoencoding,
-                            config.step_freq,
-                            utils.get_norm_sym_norm_kernel(
-                                encoder.window_size // encoder.resolution
-                            ),
-                        )
-
-                        a_len = min(chrom_res_sizes[chr_str], autoencoding.shape[0])
-
-                        a[pos_ae : pos_ae + a_len] = autoencoding[:a_len]
-
-                        pos_ae += chrom_res_sizes[chr_str]
 
-                    # Lets write to disk
-                    f.flush()
                 f.flush()
         except OSError as error:
             # When `clear` is `False` and the data is already prepared then we expect to
@@ -311,6 +877,96 @@ class Dataset:
         # For convenience
         return total_num_windows, chrom_num_windows
 
+    def prepare_chromosomes(
+        self,
+        config,
+        encoder,
+        step_size: int,
+        normalizer,
+        write: callable,
+        verbose: bool = False,
+    ):
+        """Prepare the windows of all chromosomes one batch at a time
+
+        Pipeline the batches of windows: while one batch is encoded, the next batch
+        is extracted and the previous one is written. Encoding stays in this thread
+        as Keras models are bound to the thread that loaded them.
+        """
+        batches = utils.prefetch(
+            (
+                (chromosome, start, windows)
+                for chromosome in config.chroms
+                for start, windows in extract_windows(
+                    chromosome,
+                    self.filepath,
+                    self.chromsizes,
+                    encoder,
+                    step_size,
+                    normalizer,
+                    verbose=verbose,
+                )
+            ),
+            max_size=PIPELINE_QUEUE_SIZE,
+        )
+        with utils.BackgroundConsumer(write, max_size=PIPELINE_QUEUE_SIZE) as writer:
+            for chromosome, start, windows in batches:
+                encoded = encode_windows(windows, encoder)
+                writer.put(chromosome, start, windows, *encoded)
+
+    def prepare_chromosomes_concurrently(
+        self,
+        config,
+        encoder,
+        step_size: int,
+        normalizer,
+        write: callable,
+        executor,
+        verbose: bool = False,
+    ):
+        """Prepare the windows of all chromosomes in a process pool
+
+        A bounded number of chromosomes is prepared ahead and the chromosomes are
+        written in order as they finish. See `prepare_chromosome()`.
+        """
+        chroms = iter(config.chroms)
+        pending = deque()
+
+        def submit_next():
+            chromosome = next(chroms, None)
+            if chromosome is not None:
+                future = executor.submit(
+                    prepare_chromosome,
+                    chromosome,
+                    self.filepath,
+                    self.chromsizes,
+                    encoder.model_filepath,
+                    step_size,
+                    normalizer,
+                    "{}.{}.batches.tmp".format(self.cache_filepath, chromosome),
+                    verbose,
+                )
+                pending.append((chromosome, future))
+
+        for _ in range(CHROMOSOMES_IN_FLIGHT * config.prepare_workers):
+            submit_next()
+
+        try:
+            while pending:
+                chromosome, future = pending.popleft()
+                batches_filepath = future.result()
+                try:
+                    for batch in read_batches(batches_filepath):
+                        write(chromosome, *batch)
+                finally:
+                    os.remove(batches_filepath)
+                submit_next()
+        finally:
+            # Clean up after a failure
+            for _, future in pending:
+                if not future.cancel():
+                    with suppress(Exception):
+                        os.remove(future.result())
+
 
 class DatasetCache:
     def __init__(self, cache):
@@ -332,6 +988,10 @@ class DatasetCache:
     def autoencodings(self):
         return self.cache["autoencodings"]
 
+    @property
+    def features(self):
+        return self.cache["features"]
+
     def num_windows_by_chrom(self, chromosome, config):
         chr_str = str(chromosome).encode("ascii", "ignore")
         for index, chrom in enumerate(self.cache["windows"].attrs["chrom_order"]):
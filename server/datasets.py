@@ -11,16 +11,74 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import glob
 import h5py
 import hashlib
+import multiprocessing
 import numpy as np
 import os
-import re
 
-from contextlib import contextmanager, suppress
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, suppress
 from scipy.spatial.distance import cdist
 
-from server import chromsizes, utils
+from server import chromsizes, features, http_cache, utils
+from server.dataset import init_worker
+from server.knn_index import KnnIndex
+
+# Size in bytes of the HDF5 chunks of the combined cache. Windows are read by row
+# ranges while encodings are usually read in full, hence, the larger chunks.
+WINDOWS_CHUNK_BYTES = 2 ** 20
+ENCODINGS_CHUNK_BYTES = 2 ** 22
+
+# Number of rows that are concatenated at once
+CONCAT_BLOCK_SIZE = 2 ** 16
+
+# Suffix of the combined caches, which distinguishes them from the other HDF5 files
+# in the cache directory when looking for a reusable combined cache
+COMBINED_CACHE_SUFFIX = "_combined.hdf5"
+
+
+def get_chunk_shape(num_rows: int, num_cols: int, chunk_bytes: int) -> tuple:
+    """Get the shape of row chunks of a float32 matrix spanning all columns"""
+    num_chunk_rows = max(1, chunk_bytes // (4 * max(1, num_cols)))
+    return (max(1, min(num_rows, num_chunk_rows)), max(1, num_cols))
+
+
+def get_dataset_cache_reader(dataset_cache):
+    """Read row blocks of the windows, encodings, and features of a dataset cache"""
+
+    def read(start: int, end: int):
+        windows = dataset_cache.windows[start:end].reshape(end - start, -1)
+        encodings = dataset_cache.encodings[start:end].reshape(end - start, -1)
+        try:
+            block_features = dataset_cache.features[:, start:end]
+        except KeyError:
+            # Caches prepared before features were introduced
+            block_features = features.compute(windows)
+        return windows, encodings, block_features
+
+    return read
+
+
+def get_combined_cache_reader(f, block: int, window_cols, encoding_cols):
+    """Read row blocks of the columns and features of one block of a combined cache
+
+    Arguments:
+        f {h5py.File} -- Opened combined cache
+        block {int} -- Index of the block
+        window_cols {tuple} -- Start and end column of the block's windows
+        encoding_cols {tuple} -- Start and end column of the block's encodings
+    """
+
+    def read(start: int, end: int):
+        return (
+            f["windows"][start:end, window_cols[0] : window_cols[1]],
+            f["encodings"][start:end, encoding_cols[0] : encoding_cols[1]],
+            f["features"][block, :, start:end],
+        )
+
+    return read
 
 
 class Datasets:
@@ -46,6 +104,18 @@ class Datasets:
     def cache_filepath(self):
         return self._cache_filepath
 
+    @property
+    def knn_index_filepath(self):
+        return "{}.hnsw".format(os.path.splitext(self.cache_filepath)[0])
+
+    @property
+    def quantized_encodings_filepath(self):
+        return "{}_q8.hdf5".format(os.path.splitext(self.cache_filepath)[0])
+
+    @property
+    def encodings_filepath(self):
+        return "{}_encodings.npy".format(os.path.splitext(self.cache_filepath)[0])
+
     @property
     def total_len_windows(self):
         return self._total_len_windows
@@ -139,6 +209,15 @@ class Datasets:
         with suppress(FileNotFoundError):
             os.remove(self.cache_filepath)
 
+        with suppress(FileNotFoundError):
+            os.remove(self.knn_index_filepath)
+
+        with suppress(FileNotFoundError):
+            os.remove(self.quantized_encodings_filepath)
+
+        with suppress(FileNotFoundError):
+            os.remove(self.encodings_filepath)
+
     def compute_encodings_dist(
         self,
         target: np.ndarray,
@@ -182,45 +261,91 @@ class Datasets:
         total_num_windows = None
         chrom_num_windows = None
 
-        for encoder in encoders:
-            try:
-                if verbose:
-                    print("Prepare all datasets just for you...", flush=True)
-
-                for dataset in self.get_by_type(encoder.content_type):
-
-                    ds_total_num_windows, ds_chrom_num_windows = dataset.prepare(
-                        config, encoder, clear=clear, verbose=verbose
-                    )
-
-                    if total_num_windows is None:
-                        total_num_windows = ds_total_num_windows
+        executor = None
+        if config.prepare_workers > 1:
+            # Keras and open bigWig files are not fork-safe
+            executor = ProcessPoolExecutor(
+                max_workers=config.prepare_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(list(encoders),),
+            )
 
-                    if chrom_num_windows is None:
-                        chrom_num_windows = ds_chrom_num_windows
+        def prepare_dataset(dataset, encoder):
+            return dataset.prepare(
+                config, encoder, clear=clear, verbose=verbose, executor=executor
+            )
 
+        try:
+            for encoder in encoders:
+                try:
                     if verbose:
-                        print(
-                            "Make sure that all windows are correctly prepared...",
-                            flush=True,
-                        )
-
-                    # Check that all datasets have the same number of windows
-                    assert (
-                        total_num_windows == ds_total_num_windows
-                    ), "The total number of windows should be the same for all datasets"
-
-                    # Check that all datasets have the same number of windows
-                    assert ds_chrom_num_windows.equals(
-                        chrom_num_windows
-                    ), "The number of windows per chromosome should be the same for all datasets"
-
-            except KeyError:
-                # If there's no data for the encoder we simply continue with our lives
-                # pass
-                raise
+                        print("Prepare all datasets just for you...", flush=True)
+
+                    datasets = self.get_by_type(encoder.content_type)
+
+                    prepared = None
+                    if executor is not None and datasets:
+                        # Prepare the datasets concurrently such that the process pool
+                        # works on the chromosomes of all datasets at once
+                        with ThreadPoolExecutor(max_workers=len(datasets)) as threads:
+                            prepared = list(
+                                threads.map(
+                                    prepare_dataset, datasets, [encoder] * len(datasets)
+                                )
+                            )
+
+                    for i, dataset in enumerate(datasets):
+                        if prepared is None:
+                            prepared_dataset = prepare_dataset(dataset, encoder)
+                        else:
+                            prepared_dataset = prepared[i]
+
+                        ds_total_num_windows, ds_chrom_num_windows = prepared_dataset
+
+                        if total_num_windows is None:
+                            total_num_windows = ds_total_num_windows
+
+                        if chrom_num_windows is None:
+                            chrom_num_windows = ds_chrom_num_windows
+
+                        if verbose:
+                            print(
+                                "Make sure that all windows are correctly prepared...",
+                                flush=True,
+                            )
+
+                        # Check that all datasets have the same number of windows
+                        assert (
+                            total_num_windows == ds_total_num_windows
+                        ), "The total number of windows should be the same for all datasets"
+
+                        if dataset.is_autoencoded:
+                            dataset.prepare_autoencodings(
+                                config, encoder, clear=clear, verbose=verbose
+                            )
+
+                        if config.tile_pyramid:
+                            dataset.prepare_tile_pyramid(
+                                config, encoder, clear=clear, verbose=verbose
+                            )
+
+                        # Check that all datasets have the same number of windows
+                        assert ds_chrom_num_windows.equals(
+                            chrom_num_windows
+                        ), "The number of windows per chromosome should be the same for all datasets"
+
+                except KeyError:
+                    # If there's no data for the encoder we simply continue with our lives
+                    # pass
+                    raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-        self._cache_filename = "{}.hdf5".format(self.createCacheHash(encoders, config))
+        self._cache_filename = "{}{}".format(
+            self.createCacheHash(encoders, config), COMBINED_CACHE_SUFFIX
+        )
         self._cache_filepath = os.path.join(config.cache_dir, self.cache_filename)
 
         self._total_len_windows = 0
@@ -232,117 +357,290 @@ class Datasets:
             self._total_len_encoded += encoder.latent_dim
             self._total_len_windows += int(encoders.window_size // encoder.resolution)
 
-        # Concatenate data
-        mode = "w" if clear else "w-"
+        if clear or not os.path.exists(self.cache_filepath):
+            self.concat(
+                encoders, config, total_num_windows, clear=clear, verbose=verbose
+            )
 
-        try:
-            with h5py.File(self.cache_filepath, mode) as f:
-                if verbose:
-                    print("Concatenate and save windows...")
+        if verbose:
+            print("All datasets have been prepared! Thanks for waiting.")
 
-                w = f.create_dataset(
-                    "windows",
-                    (total_num_windows, self.total_len_windows),
-                    dtype=np.float32,
-                )
-                w_max = f.create_dataset(
-                    "windows_max", (total_num_windows,), dtype=np.float32
-                )
-                w_sum = f.create_dataset(
-                    "windows_sum", (total_num_windows,), dtype=np.float32
-                )
-                w_mean = f.create_dataset(
-                    "windows_mean", (total_num_windows,), dtype=np.float32
-                )
-                e = f.create_dataset(
-                    "encodings",
-                    (total_num_windows, self.total_len_encoded),
-                    dtype=np.float32,
-                )
-                f.create_dataset(
-                    "encodings_dist", (total_num_windows,), dtype=np.float32
-                )
-                e_knn_density = f.create_dataset(
-                    "encodings_knn_density", (total_num_windows,), dtype=np.float32
-                )
+    def get_cache_blocks(self, encoders) -> list:
+        """Identify the column blocks of the combined cache
 
-                # Metadata
-                w.attrs["total_len_windows"] = self._total_len_windows
-                e.attrs["total_len_encoded"] = self._total_len_encoded
+        Every dataset contributes one block of window and encoding columns. A block
+        is identified by the dataset's cache file, including its version, and the
+        encoder, such that blocks of previous combined caches can be reused.
+        """
+        return [
+            "{}:{}:{}".format(
+                os.path.basename(dataset.cache_filepath),
+                http_cache.get_file_version(dataset.cache_filepath),
+                encoders.get(dataset.content_type).encoder_filename,
+            )
+            for dataset in self.datasets
+        ]
 
-                pos_window_from = 0
-                pos_window_to = 0
-                pos_encoded_from = 0
-                pos_encoded_to = 0
+    def find_reusable_cache(
+        self, cache_dir: str, blocks: list, num_windows: int, compression: str = None
+    ):
+        """Find the combined cache sharing the most column blocks
+
+        Blocks are matched by their identity, i.e., they can be at any position in
+        the previous combined cache.
+
+        Returns:
+            {tuple} -- Path to the combined cache and its blocks or `(None, [])` if
+                no combined cache can be reused
+        """
+        reusable_filepath = None
+        reusable_blocks = []
+        num_reusable = 0
+
+        pattern = "*{}".format(COMBINED_CACHE_SUFFIX)
+        for filepath in glob.glob(os.path.join(cache_dir, pattern)):
+            if filepath == self.cache_filepath:
+                continue
+
+            with suppress(OSError, KeyError):
+                with h5py.File(filepath, "r") as f:
+                    prev_blocks = [str(block) for block in f.attrs["blocks"]]
+                    if (
+                        f["windows"].shape[0] != num_windows
+                        or f["windows"].compression != compression
+                        or f["features"].shape[1] != len(features.FEATURES)
+                        or len(f.attrs["block_window_lens"]) != len(prev_blocks)
+                        or len(f.attrs["block_encoding_lens"]) != len(prev_blocks)
+                    ):
+                        continue
+
+                num_shared = len(set(blocks) & set(prev_blocks))
+
+                if num_shared > num_reusable:
+                    reusable_filepath = filepath
+                    reusable_blocks = prev_blocks
+                    num_reusable = num_shared
+
+        return reusable_filepath, reusable_blocks
+
+    def concat(
+        self,
+        encoders,
+        config,
+        total_num_windows: int,
+        clear: bool = False,
+        verbose: bool = False,
+    ):
+        """Concatenate the windows and encodings of all datasets
+
+        The combined cache is assembled incrementally: the columns and features of
+        datasets that are part of a previous combined cache are copied from it and
+        only the datasets' own caches of the other datasets are read. The window
+        statistics follow from the features stored per dataset.
+
+        The columns are streamed in blocks of `CONCAT_BLOCK_SIZE` rows across all
+        datasets, such that no dataset is loaded into memory as a whole.
+        """
+        compression = config.cache_compression
+        blocks = self.get_cache_blocks(encoders)
+        num_blocks = len(blocks)
+        window_lens = [
+            encoders.get(dataset.content_type).window_num_bins
+            for dataset in self.datasets
+        ]
+        encoding_lens = [
+            encoders.get(dataset.content_type).latent_dim for dataset in self.datasets
+        ]
 
-                for dataset in self.datasets:
-                    encoder = encoders.get(dataset.content_type)
+        reusable_filepath, prev_blocks = None, []
+        if not clear:
+            reusable_filepath, prev_blocks = self.find_reusable_cache(
+                config.cache_dir, blocks, total_num_windows, compression=compression
+            )
 
-                    pos_window_to = pos_window_from + encoder.window_num_bins
-                    pos_encoded_to = pos_encoded_from + encoder.latent_dim
+        tmp_filepath = "{}.tmp".format(self.cache_filepath)
 
-                    with dataset.cache() as dataset_cache:
+        with ExitStack() as stack:
+            f = stack.enter_context(h5py.File(tmp_filepath, "w"))
 
-                        w[:, pos_window_from:pos_window_to] = np.squeeze(
-                            dataset_cache.windows
-                        )
+            w = f.create_dataset(
+                "windows",
+                (total_num_windows, self.total_len_windows),
+                chunks=get_chunk_shape(
+                    total_num_windows, self.total_len_windows, WINDOWS_CHUNK_BYTES
+                ),
+                compression=compression,
+                dtype=np.float32,
+            )
+            e = f.create_dataset(
+                "encodings",
+                (total_num_windows, self.total_len_encoded),
+                chunks=get_chunk_shape(
+                    total_num_windows, self.total_len_encoded, ENCODINGS_CHUNK_BYTES
+                ),
+                compression=compression,
+                dtype=np.float32,
+            )
+            # Features of every dataset, i.e., a feature table per dataset
+            ft = f.create_dataset(
+                "features",
+                (num_blocks, len(features.FEATURES), total_num_windows),
+                chunks=(
+                    1,
+                    1,
+                    max(1, min(total_num_windows, WINDOWS_CHUNK_BYTES // 4)),
+                ),
+                dtype=np.float32,
+            )
+            ft.attrs["names"] = features.FEATURES
+            f.create_dataset("windows_max", (total_num_windows,), dtype=np.float32)
+            f.create_dataset("windows_sum", (total_num_windows,), dtype=np.float32)
+            f.create_dataset("windows_mean", (total_num_windows,), dtype=np.float32)
+            f.create_dataset("encodings_dist", (total_num_windows,), dtype=np.float32)
+            f.create_dataset(
+                "encodings_knn_density", (total_num_windows,), dtype=np.float32
+            )
 
-                        e[:, pos_encoded_from:pos_encoded_to] = np.squeeze(
-                            dataset_cache.encodings
+            # Metadata
+            w.attrs["total_len_windows"] = self._total_len_windows
+            e.attrs["total_len_encoded"] = self._total_len_encoded
+
+            readers = []
+            num_reused = 0
+
+            if reusable_filepath is not None:
+                prev = stack.enter_context(h5py.File(reusable_filepath, "r"))
+                prev_window_offsets = np.r_[
+                    0, np.cumsum(prev.attrs["block_window_lens"])
+                ]
+                prev_encoding_offsets = np.r_[
+                    0, np.cumsum(prev.attrs["block_encoding_lens"])
+                ]
+
+            for i, dataset in enumerate(self.datasets):
+                if blocks[i] in prev_blocks:
+                    j = prev_blocks.index(blocks[i])
+                    readers.append(
+                        get_combined_cache_reader(
+                            prev,
+                            j,
+                            prev_window_offsets[j : j + 2],
+                            prev_encoding_offsets[j : j + 2],
                         )
+                    )
+                    num_reused += 1
+                else:
+                    dataset_cache = stack.enter_context(dataset.cache())
+                    readers.append(get_dataset_cache_reader(dataset_cache))
 
-                        # Write to disk
-                        f.flush()
+            if verbose:
+                if num_reused > 0:
+                    print(
+                        "Reuse {} of {} datasets from {}...".format(
+                            num_reused,
+                            num_blocks,
+                            os.path.basename(reusable_filepath),
+                        ),
+                        flush=True,
+                    )
+                print("Concatenate and save windows...")
 
-                    pos_window_from = pos_window_to
-                    pos_encoded_from = pos_encoded_to
+            for start in range(0, total_num_windows, CONCAT_BLOCK_SIZE):
+                end = min(start + CONCAT_BLOCK_SIZE, total_num_windows)
 
-                # Compute simple stats to speed up online calculation down the road
-                pos_chrom_from = 0
-                pos_chrom_to = 0
+                windows = []
+                encodings = []
+                for i, read in enumerate(readers):
+                    block_windows, block_encodings, block_features = read(start, end)
+                    windows.append(block_windows)
+                    encodings.append(block_encodings)
+                    ft[i, :, start:end] = block_features
 
-                if verbose:
-                    print("Compute per-chromosome statistics...")
+                w[start:end] = np.concatenate(windows, axis=1)
+                e[start:end] = np.concatenate(encodings, axis=1)
 
-                for i, chromosome in enumerate(config.chroms):
-                    pos_chrom_to = pos_chrom_from + chrom_num_windows[i]
+                # Write to disk
+                f.flush()
 
-                    w_max[pos_chrom_from:pos_chrom_to] = np.nanmax(
-                        w[pos_chrom_from:pos_chrom_to, :], axis=1
-                    )
-                    w_sum[pos_chrom_from:pos_chrom_to] = np.nansum(
-                        w[pos_chrom_from:pos_chrom_to, :], axis=1
-                    )
-                    w_mean[pos_chrom_from:pos_chrom_to] = np.nanmean(
-                        w[pos_chrom_from:pos_chrom_to, :], axis=1
-                    )
+            if verbose:
+                print("Compute the windows' statistics...")
 
-                    pos_chrom_from = pos_chrom_to
+            # The statistics of the concatenated windows follow from the features of
+            # the datasets
+            f["windows_max"][:] = np.fmax.reduce(
+                ft[:, features.get_index("max")], axis=0
+            )
+            windows_sum = np.sum(ft[:, features.get_index("sum")], axis=0)
+            windows_count = np.sum(ft[:, features.get_index("count")], axis=0)
+            f["windows_sum"][:] = windows_sum
+            with np.errstate(invalid="ignore", divide="ignore"):
+                f["windows_mean"][:] = windows_sum / windows_count
 
-                    # Write to disk
-                    f.flush()
+            if verbose:
+                print("Compute the encoded windows' knn density...")
 
-                if verbose:
-                    print("Compute the encoded windows' knn density...")
-
-                e_knn_density[:] = utils.knn_density(e[:])
-
-        except OSError as error:
-            # When `clear` is `False` and the data is already prepared then we expect to
-            # see error number 17 as we opened the file in `w-` mode.
-            if not clear:
-                # Stupid h5py doesn't populate `error.errno` so we have to parse it out
-                # manually
-                matches = re.search(r"errno = (\d+)", str(error))
-                if matches and int(matches.group(1)) == 17:
-                    pass
-                else:
-                    raise
-            else:
-                raise
+            # The index and the density depend on all encoding columns, hence,
+            # they have to be recomputed whenever a dataset is added or removed
+            encodings = e[:]
+            knn_index = KnnIndex(self.knn_index_filepath, encodings).build(
+                verbose=verbose
+            )
+            f["encodings_knn_density"][:] = utils.knn_density(
+                encodings, index=knn_index
+            )
+
+            f.attrs["blocks"] = blocks
+            f.attrs["block_window_lens"] = window_lens
+            f.attrs["block_encoding_lens"] = encoding_lens
+
+        os.replace(tmp_filepath, self.cache_filepath)
+
+        # Exported after the combined cache is in place as the export is considered
+        # outdated when it's older than the combined cache
+        self.export_encodings(verbose=verbose)
+
+    def export_encodings(self, verbose: bool = False):
+        """Export the combined encodings as a flat file for memory-mapping
 
+        The combined cache might be chunked and compressed, which prevents
+        memory-mapping its encodings. The exported `.npy` file is a plain C-ordered
+        array instead.
+        """
         if verbose:
-            print("All datasets have been prepared! Thanks for waiting.")
+            print("Export the encodings...", flush=True)
+
+        tmp_filepath = "{}.tmp".format(self.encodings_filepath)
+
+        with h5py.File(self.cache_filepath, "r") as f:
+            encodings = f["encodings"]
+            out = np.lib.format.open_memmap(
+                tmp_filepath, mode="w+", dtype=encodings.dtype, shape=encodings.shape
+            )
+            for start in range(0, encodings.shape[0], CONCAT_BLOCK_SIZE):
+                out[start : start + CONCAT_BLOCK_SIZE] = encodings[
+                    start : start + CONCAT_BLOCK_SIZE
+                ]
+            out.flush()
+            del out
+
+        os.replace(tmp_filepath, self.encodings_filepath)
+
+    def load_encodings(self, verbose: bool = False) -> np.ndarray:
+        """Memory-map the combined encodings
+
+        All consumers share the read-only view and several server processes share
+        one copy of the encodings through the page cache. The encodings are
+        exported first if the export does not exist or is outdated.
+
+        Returns:
+            {np.ndarray} -- Read-only memory-mapped encodings
+        """
+        if not os.path.exists(self.encodings_filepath) or os.path.getmtime(
+            self.encodings_filepath
+        ) < os.path.getmtime(self.cache_filepath):
+            self.export_encodings(verbose=verbose)
+
+        return np.load(self.encodings_filepath, mmap_mode="r")
 
     @contextmanager
     def prepared_data(self):
@@ -390,3 +688,15 @@ class DatasetsCache:
     @property
     def encodings_knn_density(self):
         return self.cache["encodings_knn_density"]
+
+    @property
+    def features(self):
+        return self.cache["features"]
+
+    def get_feature(self, name: str) -> np.ndarray:
+        """Get a feature of all windows
+
+        Returns:
+            {np.ndarray} -- Feature of shape `(num_datasets, num_windows)`
+        """
+        return self.cache["features"][:, features.get_index(name)]
@@ -24,6 +24,30 @@ CACHE_DIR = "cache"
 # caching on.
 CACHING = True
 
+# If set to `True` a multi-resolution tile pyramid is precomputed for every bigWig
+# track such that HiGlass tiles do not need to be extracted from the bigWig file.
+TILE_PYRAMID = False
+
+# Memory budget in bytes of the in-process cache for generated HiGlass tiles. Set to
+# `0` to disable tile caching.
+TILE_CACHE_SIZE = 268435456
+
+# Number of threads for generating the tiles of different tilesets concurrently. Set
+# to `1` to generate tiles sequentially.
+TILE_WORKERS = 8
+
+# Number of processes for preparing the chromosomes of all datasets concurrently. Set
+# to `1` to prepare the data sequentially.
+PREPARE_WORKERS = 1
+
+# Compression of the combined windows and encodings. Either `None`, `"lzf"` for fast
+# compression, or `"gzip"` for a higher compression ratio.
+CACHE_COMPRESSION = None
+
+# If `True` the server answers kNN queries by scanning 8-bit quantized encodings
+# instead of loading an HNSW index, which holds a float32 copy of the encodings.
+QUANTIZE_ENCODINGS = False
+
 DB_PATH = "search.db"
 
 COORDS = "hg19"
@@ -40,11 +40,16 @@ class Encoder:
         self._encoder = None
 
     @property
-    def encoder_filename(self):
+    def model_filepath(self):
+        """Path of the model the encoder is loaded from"""
         if self.encoder_filepath is not None:
-            return os.path.basename(self.encoder_filepath)
+            return self.encoder_filepath
         else:
-            return os.path.basename(self.autoencoder_filepath)
+            return self.autoencoder_filepath
+
+    @property
+    def encoder_filename(self):
+        return os.path.basename(self.model_filepath)
 
     @property
     def encoder(self):
@@ -60,6 +65,15 @@ class Encoder:
                 self._encoder = get_encoder(self._autoencoder)
         return self._encoder
 
+    def __getstate__(self):
+        # Loaded models can't be pickled, e.g., for a process pool. They are
+        # loaded lazily again when needed.
+        state = self.__dict__.copy()
+        for key in ("_encoder", "_autoencoder", "_decoder"):
+            if key in state:
+                state[key] = None
+        return state
+
     def encode(self, data: np.ndarray) -> np.ndarray:
         return self.encoder.predict(data)
 
@@ -0,0 +1,79 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+# Normalized bin values of at least this threshold count as peak bins
+PEAK_THRESHOLD = 0.5
+
+# Per-window features. `count` is the number of non-NaN bins.
+FEATURES = (
+    "max",
+    "min",
+    "sum",
+    "mean",
+    "std",
+    "count",
+    "nonzero_fraction",
+    "peak_bins",
+)
+
+
+def get_index(name: str) -> int:
+    try:
+        return FEATURES.index(name)
+    except ValueError:
+        raise KeyError("Unknown feature: {}".format(name))
+
+
+def compute(windows: np.ndarray) -> np.ndarray:
+    """Compute the features of a batch of windows
+
+    Arguments:
+        windows {np.ndarray} -- Windows of shape `(num_windows, num_bins)`
+
+    Returns:
+        {np.ndarray} -- Float32 features of shape `(len(FEATURES), num_windows)`,
+            i.e., one row per feature. The max, min, mean, std, and non-zero
+            fraction of windows without any data are `NaN`.
+    """
+    windows = windows.reshape(windows.shape[0], -1)
+    is_valid = ~np.isnan(windows)
+    count = np.sum(is_valid, axis=1)
+    has_data = count > 0
+
+    out = np.zeros((len(FEATURES), windows.shape[0]), dtype=np.float32)
+    out[:] = np.nan
+
+    total = np.nansum(windows, axis=1)
+    mean = np.zeros(windows.shape[0])
+    mean[:] = np.nan
+    np.divide(total, count, out=mean, where=has_data)
+
+    squared_error = np.nansum((windows - mean.reshape(-1, 1)) ** 2, axis=1)
+    variance = np.zeros(windows.shape[0])
+    variance[:] = np.nan
+    np.divide(squared_error, count, out=variance, where=has_data)
+
+    out[get_index("max")] = np.fmax.reduce(windows, axis=1)
+    out[get_index("min")] = np.fmin.reduce(windows, axis=1)
+    out[get_index("sum")] = total
+    out[get_index("mean")] = mean
+    out[get_index("std")] = np.sqrt(variance)
+    out[get_index("count")] = count
+    out[get_index("nonzero_fraction")][has_data] = (
+        np.sum(is_valid & (windows != 0), axis=1)[has_data] / count[has_data]
+    )
+    out[get_index("peak_bins")] = np.sum(windows >= PEAK_THRESHOLD, axis=1)
+
+    return out
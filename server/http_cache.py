@@ -0,0 +1,85 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import os
+from flask import Response
+
+# For responses that can change, e.g., when a new classifier is trained. Caches may
+# store them but have to revalidate them using the ETag.
+REVALIDATE = "no-cache"
+
+
+def get_file_version(filepath: str) -> str:
+    """Identify a file by its path, size, and modification time
+
+    Returns:
+        {str} -- Version of the file or `None` if the file does not exist
+    """
+    try:
+        stat = os.stat(filepath)
+    except (OSError, TypeError):
+        return None
+
+    return "{}:{:x}:{:x}".format(filepath, stat.st_size, stat.st_mtime_ns)
+
+
+def get_etag(*parts) -> str:
+    """Create an ETag from hashable parts, e.g., versions of the data"""
+    return hashlib.md5("|".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+
+def is_not_modified(request, etag: str) -> bool:
+    """Check if the client's `If-None-Match` header matches the ETag"""
+    return etag is not None and request.if_none_match.contains(etag)
+
+
+def not_modified(etag: str, cache_control: str = REVALIDATE) -> Response:
+    response = Response(status=304)
+    return set_headers(response, etag, cache_control)
+
+
+def set_headers(response: Response, etag: str, cache_control: str = REVALIDATE):
+    if etag is None:
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def respond(request, etag: str, get_response: callable, cache_control=REVALIDATE):
+    """Respond with `304 Not Modified` or create the response
+
+    Arguments:
+        request {flask.Request} -- The current request
+        etag {str} -- ETag of the response. If `None` the response is not cacheable.
+        get_response {callable} -- Function creating the response
+
+    Keyword Arguments:
+        cache_control {str} -- Cache-Control header (default: {REVALIDATE})
+
+    Returns:
+        {flask.Response} -- The response
+    """
+    if is_not_modified(request, etag):
+        return not_modified(etag, cache_control)
+
+    response = get_response()
+
+    if isinstance(response, tuple):
+        # Errors are not cached
+        return response
+
+    return set_headers(response, etag, cache_control)
@@ -0,0 +1,154 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hnswlib
+import numpy as np
+import os
+
+from scipy.spatial.distance import cdist
+
+# Number of bi-directional links per element. Also see
+# https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
+M = 16
+
+
+def get_ef(num_elements: int) -> int:
+    """Size of the dynamic candidate list for construction and search"""
+    return int(np.ceil(20 * np.log2(max(num_elements, 2))))
+
+
+class KnnIndex:
+    """Persisted approximate nearest-neighbor index over the window encodings
+
+    The HNSW index is built once with multithreaded insertion and saved next to
+    the combined cache. The server loads it once at start-up and answers all kNN
+    queries, e.g., the kNN density or the neighborhood of a search target, from
+    the index instead of scanning all encodings.
+
+    Arguments:
+        filepath {str} -- Path of the persisted index
+        data {np.ndarray} -- Encodings of all windows
+
+    Keyword Arguments:
+        num_threads {int} -- Number of threads for building and querying the
+            index. `-1` uses all cores. (default: {-1})
+    """
+
+    def __init__(self, filepath: str, data: np.ndarray, num_threads: int = -1):
+        self.filepath = filepath
+        self.data = data
+        self.num_threads = num_threads
+        self.size, self.dim = data.shape
+        self.index = None
+
+    def build(self, verbose: bool = False):
+        if verbose:
+            print("Build the kNN index of {} windows...".format(self.size), flush=True)
+
+        ef = get_ef(self.size)
+
+        index = hnswlib.Index(space="l2", dim=self.dim)
+        index.init_index(max_elements=self.size, ef_construction=ef, M=M)
+        index.add_items(self.data, np.arange(self.size), num_threads=self.num_threads)
+        index.set_ef(ef)
+
+        tmp_filepath = "{}.tmp".format(self.filepath)
+        index.save_index(tmp_filepath)
+        os.replace(tmp_filepath, self.filepath)
+
+        self.index = index
+
+        return self
+
+    def load(self, verbose: bool = False):
+        """Load the persisted index or build it if it does not exist yet"""
+        if not os.path.exists(self.filepath):
+            return self.build(verbose=verbose)
+
+        index = hnswlib.Index(space="l2", dim=self.dim)
+        index.load_index(self.filepath, max_elements=self.size)
+        index.set_ef(get_ef(self.size))
+
+        if index.get_current_count() != self.size:
+            # The index is outdated
+            return self.build(verbose=verbose)
+
+        self.index = index
+
+        return self
+
+    def query(self, data: np.ndarray, k: int):
+        """Query the approximate `k` nearest windows
+
+        Returns:
+            {tuple} -- Indices and Euclidean distances of the nearest windows of
+                shape `(data.shape[0], k)`
+        """
+        labels, dist = self.index.knn_query(
+            data, k=min(k, self.size), num_threads=self.num_threads
+        )
+        return labels.astype(int), np.sqrt(dist)
+
+    def nearest(self, target: np.ndarray, k: int, selected: np.ndarray = None):
+        """Get the `k` selected windows nearest to the target
+
+        The index is queried with an increasing number of neighbors until `k`
+        selected windows are found. When most windows would have to be queried the
+        distances are computed exactly instead.
+
+        Arguments:
+            target {np.ndarray} -- Encoded target
+            k {int} -- Number of windows
+
+        Keyword Arguments:
+            selected {np.ndarray} -- Boolean mask of the windows to be considered.
+                If `None` all windows are considered. (default: {None})
+
+        Returns:
+            {tuple} -- Indices and Euclidean distances of the windows sorted by
+                distance
+        """
+        target = np.asarray(target, dtype=np.float32).reshape((1, -1))
+
+        num_selected = self.size if selected is None else int(np.sum(selected))
+        k = min(k, num_selected)
+
+        if k == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+
+        # Expected number of neighbors needed to find `k` selected windows
+        num_neighbors = int(np.ceil(k * self.size / num_selected))
+
+        while num_neighbors < self.size // 2:
+            labels, dist = self.query(target, num_neighbors)
+            labels = labels[0]
+            dist = dist[0]
+
+            if selected is not None:
+                is_selected = selected[labels]
+                labels = labels[is_selected]
+                dist = dist[is_selected]
+
+            if labels.size >= k:
+                return labels[:k], dist[:k]
+
+            num_neighbors *= 2
+
+        candidates = np.arange(self.size)
+        if selected is not None:
+            candidates = candidates[selected]
+
+        dist = cdist(self.data[candidates], target).flatten()
+        order = np.argsort(dist)[:k]
+
+        return candidates[order], dist[order]
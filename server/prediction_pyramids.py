@@ -0,0 +1,251 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import glob
+import h5py
+import numpy as np
+import os
+import threading
+from contextlib import suppress
+
+from server import bigwig, http_cache, pyramid, tile_encoding, utils, vector
+
+AGGREGATORS = ("max", "mean")
+
+
+class PredictionPyramids:
+    """Tile pyramids of the predicted probabilities of trained classifiers
+
+    For every trained classifier the merged probability track is computed once and
+    stored together with a max and mean tile pyramid in the cache directory. Tiles
+    are then cut out of the memory-mapped pyramid instead of predicting all windows
+    for every tile request. Zoom levels finer than the track's resolution are
+    scaled up from the memory-mapped track.
+
+    Arguments:
+        encodings {np.ndarray} -- Encodings of all windows
+        chromsizes {pd.Series} -- Chromosome sizes
+        window_size {int} -- Window size in base pairs
+        step_freq {int} -- Step frequency of the windows
+        abs_offset {int} -- Absolute position of the first window
+        abs_len {int} -- Absolute length of the windowed chromosomes
+        cache_dir {str} -- Directory to store the pyramids
+
+    Keyword Arguments:
+        data_version {str} -- Version of the prepared data. Pyramids of other versions
+            are not reused. (default: {None})
+        verbose {bool} -- If `True` print build progress (default: {False})
+    """
+
+    def __init__(
+        self,
+        encodings: np.ndarray,
+        chromsizes,
+        window_size: int,
+        step_freq: int,
+        abs_offset: int,
+        abs_len: int,
+        cache_dir: str,
+        data_version: str = None,
+        verbose: bool = False,
+    ):
+        self.encodings = encodings
+        self.chromsizes = chromsizes
+        self.chrom_offsets = np.cumsum(chromsizes) - chromsizes
+        self.step_freq = step_freq
+        self.resolution = int(window_size / step_freq)
+        self.abs_offset = abs_offset
+        self.abs_len = abs_len
+        self.cache_dir = cache_dir
+        self.data_version = data_version
+        self.verbose = verbose
+
+        self.pyramids = {}
+        self.tracks = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_filepath(self, classifier) -> str:
+        version = http_cache.get_etag(
+            self.data_version,
+            self.step_freq,
+            classifier.search_id,
+            classifier.classifier_id,
+            classifier.created,
+        )
+        return os.path.join(
+            self.cache_dir,
+            "prediction_s{}_c{}_{}.hdf5".format(
+                classifier.search_id, classifier.classifier_id, version[:12]
+            ),
+        )
+
+    def get_lock(self, filepath: str):
+        with self._lock:
+            if filepath not in self._locks:
+                self._locks[filepath] = threading.Lock()
+            return self._locks[filepath]
+
+    def predict(self, classifier) -> np.ndarray:
+        """Predict all windows and merge the interleaved windows"""
+        _, p_y = classifier.predict(self.encodings)
+
+        return utils.merge_interleaved(
+            p_y[:, 1], self.step_freq, aggregator=np.nanmax
+        ).astype(np.float32)
+
+    def build(self, classifier, clear: bool = False):
+        """Build the prediction pyramid of a trained classifier
+
+        The pyramid is written to a temporary file first, such that concurrent tile
+        requests never see a partially written pyramid.
+
+        Returns:
+            {str} -- Path to the pyramid or `None` if the classifier is not trained
+        """
+        if not classifier.is_trained:
+            return None
+
+        filepath = self.get_filepath(classifier)
+
+        with self.get_lock(filepath):
+            if not pyramid.is_outdated(filepath) and not clear:
+                return filepath
+
+            if self.verbose:
+                print(
+                    "Build prediction pyramid for search #{} classifier #{}...".format(
+                        classifier.search_id, classifier.classifier_id
+                    ),
+                    flush=True,
+                )
+
+            track = self.predict(classifier)
+
+            def fetch(chrom, chrom_size, binsize, aggregator):
+                start = self.chrom_offsets[chrom]
+                return pyramid.bin_vector(
+                    track,
+                    self.resolution,
+                    self.abs_offset,
+                    start,
+                    start + chrom_size,
+                    binsize,
+                    aggregator=aggregator,
+                )
+
+            tmp_filepath = "{}.tmp".format(filepath)
+
+            try:
+                pyramid.build(
+                    tmp_filepath,
+                    self.chromsizes,
+                    self.resolution,
+                    fetch,
+                    aggregators=AGGREGATORS,
+                    clear=True,
+                )
+
+                with h5py.File(tmp_filepath, "a") as f:
+                    f.create_dataset("track", data=track)
+
+                os.replace(tmp_filepath, filepath)
+            except BaseException:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp_filepath)
+                raise
+
+        return filepath
+
+    def get(self, classifier):
+        """Get the prediction pyramid and track of a trained classifier
+
+        The pyramid is built if it does not exist yet.
+
+        Returns:
+            {tuple} -- Pyramid and range aggregator of the memory-mapped track or
+                `None` if the classifier is not trained
+        """
+        filepath = self.get_filepath(classifier)
+
+        try:
+            return self.pyramids[filepath], self.tracks[filepath]
+        except KeyError:
+            pass
+
+        if self.build(classifier) is None:
+            return None
+
+        self.tracks[filepath] = vector.RangeAggregator(
+            utils.memmap_hdf5(filepath, "track")
+        )
+        self.pyramids[filepath] = pyramid.Pyramid(filepath)
+
+        return self.pyramids[filepath], self.tracks[filepath]
+
+    def remove(self, search_id: int, classifier_id: int = None):
+        """Remove the prediction pyramids of a search or of one of its classifiers"""
+        pattern = "prediction_s{}_c{}_*.hdf5".format(
+            search_id, "*" if classifier_id is None else classifier_id
+        )
+
+        for filepath in glob.glob(os.path.join(self.cache_dir, pattern)):
+            self.pyramids.pop(filepath, None)
+            self.tracks.pop(filepath, None)
+            with suppress(FileNotFoundError):
+                os.remove(filepath)
+
+    def tiles(self, classifier, tile_ids):
+        """Get prediction tiles of a trained classifier
+
+        Returns:
+            {list} -- List of `(tile_id, tile_value)` tuples or `None` if the
+                classifier is not trained
+        """
+        prediction = self.get(classifier)
+
+        if prediction is None:
+            return None
+
+        prediction_pyramid, track = prediction
+        max_depth = bigwig.get_quadtree_depth(self.chromsizes)
+
+        generated_tiles = []
+        for tile_id in tile_ids:
+            _, zoom_level, tile_pos = bigwig.parse_tile_id(tile_id)
+
+            if not prediction_pyramid.has_zoom(zoom_level):
+                generated_tiles += vector.tiles(
+                    track,
+                    self.resolution,
+                    self.abs_len,
+                    self.abs_offset,
+                    [tile_id],
+                    self.chromsizes,
+                    aggregator=np.max,
+                    scaleup_aggregator=np.median,
+                )
+                continue
+
+            tile_size = bigwig.TILE_SIZE * 2 ** (max_depth - zoom_level)
+            start_pos = tile_pos * tile_size
+            end_pos = start_pos + tile_size
+
+            dense = prediction_pyramid.get_tile(
+                zoom_level, start_pos, end_pos, self.chromsizes, aggregator="max"
+            )
+            dense = np.nan_to_num(dense, copy=True)
+
+            generated_tiles += [(tile_id, tile_encoding.get_tile_value(dense))]
+
+        return generated_tiles
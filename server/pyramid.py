@@ -0,0 +1,317 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import h5py
+import numpy as np
+
+from server import bigwig, tile_encoding, utils
+
+AGGREGATORS = ("mean", "min", "max")
+
+# Version of the pyramid layout. Pyramids of other versions are rebuilt.
+VERSION = 2
+
+
+def reduce_sum(x: np.ndarray) -> np.ndarray:
+    pairs = np.append(x, 0) if x.size % 2 else x
+    return pairs[0::2] + pairs[1::2]
+
+
+def reduce_min(x: np.ndarray) -> np.ndarray:
+    pairs = np.append(x, np.nan) if x.size % 2 else x
+    return np.fmin(pairs[0::2], pairs[1::2])
+
+
+def reduce_max(x: np.ndarray) -> np.ndarray:
+    pairs = np.append(x, np.nan) if x.size % 2 else x
+    return np.fmax(pairs[0::2], pairs[1::2])
+
+
+REDUCERS = {"min": reduce_min, "max": reduce_max}
+
+
+def bin_vector(
+    v: np.ndarray,
+    v_res: int,
+    v_offset_abs: int,
+    start: int,
+    end: int,
+    binsize: int,
+    aggregator: str = "mean",
+) -> np.ndarray:
+    """Bin a genome-wide vector between two absolute positions
+
+    Every bin aggregates the vector entries starting within the bin. Hence, the
+    bin size should be at least as large as the vector's resolution.
+
+    Arguments:
+        v {np.ndarray} -- Vector of values
+        v_res {int} -- Number of base pairs per vector entry
+        v_offset_abs {int} -- Absolute position of the first vector entry
+        start {int} -- Absolute start position of the first bin
+        end {int} -- Absolute end position of the last bin
+        binsize {int} -- Bin size in base pairs
+
+    Keyword Arguments:
+        aggregator {str} -- Either `mean`, `min`, `max`, or `coverage`, i.e., the
+            number of base pairs with data (default: {"mean"})
+
+    Returns:
+        {np.ndarray} -- Binned values. Bins without data are `NaN`.
+    """
+    num_bins = int(np.ceil((end - start) / binsize))
+    out = np.zeros(num_bins, dtype=np.float32)
+    out[:] = np.nan
+
+    # Index of the first vector entry of every bin and the end of the last bin
+    bin_starts = np.append(start + np.arange(num_bins) * binsize, end)
+    edges = np.clip(
+        np.ceil((bin_starts - v_offset_abs) / v_res).astype(int), 0, v.size
+    )
+    non_empty = edges[1:] > edges[:-1]
+
+    if not np.any(non_empty):
+        return out
+
+    # Empty bins are skipped, so every segment ends where the next non-empty starts
+    x = v[: edges[-1]]
+    indices = edges[:-1][non_empty]
+
+    if aggregator == "mean":
+        is_nan = np.isnan(x)
+        sums = np.add.reduceat(np.where(is_nan, 0, x), indices)
+        counts = np.add.reduceat(~is_nan, indices)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[non_empty] = sums / counts
+    elif aggregator == "coverage":
+        out[non_empty] = np.add.reduceat(~np.isnan(x), indices) * v_res
+    elif aggregator == "min":
+        out[non_empty] = np.fmin.reduceat(x, indices)
+    elif aggregator == "max":
+        out[non_empty] = np.fmax.reduceat(x, indices)
+    else:
+        raise ValueError("Unknown aggregator: {}".format(aggregator))
+
+    return out
+
+
+def get_num_bins(chromsizes, binsize: int) -> np.ndarray:
+    """Number of bins per chromosome. The last bin might be smaller than `binsize`"""
+    return np.ceil(chromsizes.values / binsize).astype(int)
+
+
+def get_finest_zoom(chromsizes, min_resolution: int) -> int:
+    """Get the highest zoom level whose bin size is at least `min_resolution`"""
+    resolutions = bigwig.get_zoom_resolutions(chromsizes)
+    zoom_level = 0
+    for z, resolution in enumerate(resolutions):
+        if resolution >= min_resolution:
+            zoom_level = z
+    return zoom_level
+
+
+def build(
+    filepath: str,
+    chromsizes,
+    min_resolution: int,
+    fetch: callable,
+    aggregators: tuple = AGGREGATORS,
+    clear: bool = False,
+    verbose: bool = False,
+):
+    """Build a multi-resolution tile pyramid
+
+    For every HiGlass zoom level from `0` to the finest zoom level whose bin size is
+    at least `min_resolution` the pyramid holds one contiguous array per aggregator.
+    Within a zoom level the bins are aligned to the start of each chromosome and the
+    chromosomes are stored one after another.
+
+    Means are stored as the sum and the number of base pairs with data per bin, such
+    that coarser zoom levels weight the finer bins by their coverage, e.g., the
+    short last bin of a chromosome.
+
+    Arguments:
+        filepath {str} -- Path to the HDF5 file to be created
+        chromsizes {pd.Series} -- Chromosome sizes
+        min_resolution {int} -- Minimum bin size in base pairs
+        fetch {callable} -- Function receiving the chromosome name, its size, the bin
+            size, and the aggregator name and returning the binned values of the
+            entire chromosome. Missing data should be `NaN`. For means, the
+            aggregator `coverage`, i.e., the number of base pairs with data per
+            bin, is fetched as well.
+
+    Keyword Arguments:
+        aggregators {tuple} -- Aggregators to be computed (default: {AGGREGATORS})
+        clear {bool} -- If `True` an existing pyramid is overwritten (default: {False})
+    """
+    resolutions = bigwig.get_zoom_resolutions(chromsizes)
+    finest_zoom = get_finest_zoom(chromsizes, min_resolution)
+
+    with h5py.File(filepath, "w" if clear else "w-") as f:
+        datasets = {}
+        for zoom_level in range(finest_zoom + 1):
+            num_bins = get_num_bins(chromsizes, resolutions[zoom_level])
+            for aggregator in aggregators:
+                names = ("sum", "coverage") if aggregator == "mean" else (aggregator,)
+                for name in names:
+                    datasets[(name, zoom_level)] = f.create_dataset(
+                        "{}/{}".format(name, zoom_level),
+                        (num_bins.sum(),),
+                        dtype=np.float32,
+                    )
+
+        f.attrs["version"] = VERSION
+        f.attrs["aggregators"] = list(aggregators)
+        f.attrs["finest_zoom"] = finest_zoom
+        f.attrs["chrom_order"] = [
+            str(chrom).encode("ascii", "ignore") for chrom in chromsizes.index
+        ]
+        f.attrs["chrom_sizes"] = chromsizes.values.astype(int)
+
+        offsets = {
+            zoom_level: np.r_[
+                0, np.cumsum(get_num_bins(chromsizes, resolutions[zoom_level]))
+            ]
+            for zoom_level in range(finest_zoom + 1)
+        }
+
+        for cid, chrom in enumerate(chromsizes.index):
+            if verbose:
+                print("Build tile pyramid for {}...".format(chrom), flush=True)
+
+            def fetch_finest(aggregator):
+                return np.asarray(
+                    fetch(
+                        chrom,
+                        chromsizes.values[cid],
+                        resolutions[finest_zoom],
+                        aggregator,
+                    ),
+                    dtype=np.float64,
+                )
+
+            for aggregator in aggregators:
+                if aggregator == "mean":
+                    x = fetch_finest("mean")
+                    coverage = np.where(np.isnan(x), 0, fetch_finest("coverage"))
+                    levels = {
+                        "sum": (np.where(coverage > 0, x * coverage, 0), reduce_sum),
+                        "coverage": (coverage, reduce_sum),
+                    }
+                else:
+                    levels = {
+                        aggregator: (fetch_finest(aggregator), REDUCERS[aggregator])
+                    }
+
+                for name, (x, reduce) in levels.items():
+                    # Every zoom level is computed from the next finer zoom level
+                    for zoom_level in range(finest_zoom, -1, -1):
+                        if zoom_level < finest_zoom:
+                            x = reduce(x)
+
+                        start = offsets[zoom_level][cid]
+                        end = offsets[zoom_level][cid + 1]
+
+                        datasets[(name, zoom_level)][start:end] = x[: end - start]
+
+            f.flush()
+
+
+def is_outdated(filepath: str) -> bool:
+    """Check if a pyramid does not exist or was built with another layout"""
+    try:
+        with h5py.File(filepath, "r") as f:
+            return f.attrs.get("version") != VERSION
+    except OSError:
+        return True
+
+
+class Pyramid:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._levels = {}
+
+        with h5py.File(self.filepath, "r") as f:
+            self.finest_zoom = int(f.attrs["finest_zoom"])
+            self.aggregators = tuple(str(name) for name in f.attrs["aggregators"])
+
+    def level(self, zoom_level: int, name: str):
+        key = (name, zoom_level)
+        if key not in self._levels:
+            self._levels[key] = utils.memmap_hdf5(
+                self.filepath, "{}/{}".format(name, zoom_level)
+            )
+        return self._levels[key]
+
+    def read(self, zoom_level: int, aggregator: str, start: int, end: int):
+        """Read the bins `[start, end)` of a zoom level"""
+        if aggregator != "mean":
+            return self.level(zoom_level, aggregator)[start:end]
+
+        sums = self.level(zoom_level, "sum")[start:end]
+        coverage = self.level(zoom_level, "coverage")[start:end]
+        out = np.zeros(sums.shape, dtype=np.float32)
+        out[:] = np.nan
+        np.divide(sums, coverage, out=out, where=coverage > 0)
+        return out
+
+    def has_zoom(self, zoom_level: int) -> bool:
+        return zoom_level <= self.finest_zoom
+
+    def get_tile(
+        self, zoom_level: int, start_pos: int, end_pos: int, chromsizes, aggregator="mean"
+    ):
+        """Get a tile like `bigwig.get_tile()` but from the pyramid
+
+        Since the bins are aligned to the chromosome start, tiles that do not start
+        at a chromosome start are shifted by less than one bin.
+        """
+        binsize = bigwig.get_zoom_resolutions(chromsizes)[zoom_level]
+        offsets = np.r_[0, np.cumsum(get_num_bins(chromsizes, binsize))]
+
+        arrays = []
+        for cid, start, end in bigwig.abs2chr(chromsizes, start_pos, end_pos):
+            n_bins = int(np.ceil((end - start) / binsize))
+            try:
+                clen = chromsizes.values[cid]
+                offset = offsets[cid] + start // binsize
+                x = self.read(zoom_level, aggregator, offset, offset + n_bins)
+
+                # drop the very last bin if it is smaller than the binsize
+                if end == clen and clen % binsize != 0:
+                    x = x[:-1]
+            except IndexError:
+                # beyond the range of the available chromosomes
+                x = np.zeros(n_bins)
+
+            arrays.append(x)
+
+        return np.concatenate(arrays)
+
+    def tiles(self, tile_ids, chromsizes, aggregator="mean"):
+        max_depth = bigwig.get_quadtree_depth(chromsizes)
+
+        generated_tiles = []
+        for tile_id in tile_ids:
+            _, zoom_level, tile_pos = bigwig.parse_tile_id(tile_id)
+            tile_size = bigwig.TILE_SIZE * 2 ** (max_depth - zoom_level)
+            start_pos = tile_pos * tile_size
+            end_pos = start_pos + tile_size
+
+            dense = self.get_tile(
+                zoom_level, start_pos, end_pos, chromsizes, aggregator=aggregator
+            )
+
+            generated_tiles += [(tile_id, tile_encoding.get_tile_value(dense))]
+
+        return generated_tiles
@@ -0,0 +1,165 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import h5py
+import numpy as np
+import os
+
+from scipy.spatial.distance import cdist
+
+from server import utils
+
+# Number of encodings quantized or scanned at once
+BLOCK_SIZE = 2 ** 16
+
+# Number of quantization levels per dimension
+NUM_LEVELS = 256
+
+# Number of approximate nearest neighbors per requested neighbor that are
+# re-ranked with the exact encodings
+RERANK_FACTOR = 4
+
+
+class QuantizedEncodings:
+    """Scalar-quantized encodings with asymmetric distance computation
+
+    Every dimension of the encodings is quantized to 8 bits between its minimum
+    and maximum. The codes are memory-mapped and a quarter of the size of the
+    encodings. They are only used for nearest-neighbor scans: `nearest()` scans
+    the codes with asymmetric distances, i.e., the target is not quantized, and
+    re-ranks the top candidates with the exact float32 encodings.
+
+    Arguments:
+        filepath {str} -- Path of the quantized encodings
+        encodings_filepath {str} -- Path of the exported exact encodings. See
+            `Datasets.export_encodings()`.
+    """
+
+    def __init__(self, filepath: str, encodings_filepath: str):
+        self.filepath = filepath
+        self.encodings_filepath = encodings_filepath
+        self.encodings = None
+        self.codes = None
+        self.scale = None
+        self.offset = None
+
+    def build(self, verbose: bool = False):
+        if verbose:
+            print("Quantize the encodings...", flush=True)
+
+        tmp_filepath = "{}.tmp".format(self.filepath)
+
+        encodings = np.load(self.encodings_filepath, mmap_mode="r")
+
+        with h5py.File(tmp_filepath, "w") as f:
+            num_windows, dim = encodings.shape
+
+            data_min = np.zeros(dim)
+            data_min[:] = np.inf
+            data_max = np.zeros(dim)
+            data_max[:] = -np.inf
+            for start in range(0, num_windows, BLOCK_SIZE):
+                block = encodings[start : start + BLOCK_SIZE]
+                data_min = np.fmin(data_min, np.nanmin(block, axis=0))
+                data_max = np.fmax(data_max, np.nanmax(block, axis=0))
+
+            scale = (data_max - data_min) / (NUM_LEVELS - 1)
+            scale[~(scale > 0)] = 1.0
+            offset = np.nan_to_num(data_min)
+
+            codes = f.create_dataset("codes", (num_windows, dim), dtype=np.uint8)
+            codes.attrs["scale"] = scale
+            codes.attrs["offset"] = offset
+
+            for start in range(0, num_windows, BLOCK_SIZE):
+                block = encodings[start : start + BLOCK_SIZE]
+                codes[start : start + BLOCK_SIZE] = np.clip(
+                    np.round((np.nan_to_num(block) - offset) / scale),
+                    0,
+                    NUM_LEVELS - 1,
+                )
+
+        os.replace(tmp_filepath, self.filepath)
+
+    def load(self, verbose: bool = False):
+        """Load the quantized encodings and quantize them first if needed"""
+        if not os.path.exists(self.filepath) or os.path.getmtime(
+            self.filepath
+        ) < os.path.getmtime(self.encodings_filepath):
+            self.build(verbose=verbose)
+
+        with h5py.File(self.filepath, "r") as f:
+            self.scale = f["codes"].attrs["scale"].astype(np.float32)
+            self.offset = f["codes"].attrs["offset"].astype(np.float32)
+
+        self.codes = utils.memmap_hdf5(self.filepath, "codes")
+        self.encodings = np.load(self.encodings_filepath, mmap_mode="r")
+
+        return self
+
+    def approx_sq_distances(self, target: np.ndarray) -> np.ndarray:
+        """Asymmetric squared distances of all windows to the target
+
+        The squared distance of every code to the target is looked up per dimension
+        and summed up.
+        """
+        target = np.asarray(target, dtype=np.float64).flatten()
+        levels = np.arange(NUM_LEVELS).reshape((1, -1))
+
+        # Lookup table of the squared distance per dimension and code
+        table = (
+            levels * self.scale.reshape((-1, 1))
+            + self.offset.reshape((-1, 1))
+            - target.reshape((-1, 1))
+        ) ** 2
+        dims = np.arange(table.shape[0])
+
+        dist = np.zeros(self.codes.shape[0])
+        for start in range(0, self.codes.shape[0], BLOCK_SIZE):
+            block = self.codes[start : start + BLOCK_SIZE]
+            dist[start : start + BLOCK_SIZE] = table[dims, block].sum(axis=1)
+
+        return dist
+
+    def nearest(self, target: np.ndarray, k: int, selected: np.ndarray = None):
+        """Get the `k` selected windows nearest to the target
+
+        Same as `KnnIndex.nearest()` but with an asymmetric distance scan over the
+        codes and exact re-ranking of the top `k * RERANK_FACTOR` candidates.
+
+        Returns:
+            {tuple} -- Indices and Euclidean distances of the windows sorted by
+                distance
+        """
+        target = np.asarray(target, dtype=np.float32).reshape((1, -1))
+
+        candidates = np.arange(self.codes.shape[0])
+        dist = self.approx_sq_distances(target)
+
+        if selected is not None:
+            candidates = candidates[selected]
+            dist = dist[selected]
+
+        k = min(k, candidates.size)
+
+        if k == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+
+        num_rerank = min(k * RERANK_FACTOR, candidates.size)
+        top = np.argpartition(dist, num_rerank - 1)[:num_rerank]
+
+        candidates = np.sort(candidates[top])
+        dist = cdist(self.encodings[candidates], target).flatten()
+        order = np.argsort(dist)[:k]
+
+        return candidates[order], dist[order]
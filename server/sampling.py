@@ -161,6 +161,11 @@ def seeds_by_dim(
         )
 
 
+def get_dist_density_pool_size(levels: int = 5, initial_level_size: int = 10):
+    """Number of nearest windows considered by `sample_by_dist_density()`"""
+    return initial_level_size * (2 ** levels - 1)
+
+
 def sample_by_dist_density(
     data: np.ndarray,
     selected: np.ndarray,
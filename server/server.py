@@ -18,25 +18,33 @@ import cytoolz as toolz
 import numpy as np
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask
-from flask import request, jsonify, send_from_directory
+from flask import Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from scipy.spatial.distance import cdist
 
 from server import (
+    bigbed,
     bigwig,
     chromsizes,
     projector as projClazz,
+    http_cache,
     sampling,
+    tile_encoding,
     utils,
-    vector,
     view_config,
 )
 from server.classifiers import Classifiers, ClassifierNotFound
 from server.exceptions import LabelsDidNotChange, TooFewLabels
+from server.prediction_pyramids import PredictionPyramids
 from server.progresses import Progresses
 from server.database import DB
+from server.knn_index import KnnIndex
+from server.quantized_encodings import QuantizedEncodings
 from server.projectors import Projectors
+from server.target_distances import TargetDistances
+from server.tile_cache import TileCache
+from server.tilesets import Tilesets
 
 
 def create(
@@ -75,26 +83,102 @@ def create(
             abs_ends, datasets.chromsizes_cum[chrom] + datasets.chromsizes[chrom]
         )
 
-    with datasets.cache() as dsc:
-        # Load all the encodings into memory
-        encodings = dsc.encodings[:]
-
-        # Set up classifiers
-        classifiers = Classifiers(
-            db,
-            encodings,
-            classifier_class=config.classifier,
-            classifier_params=config.classifier_params,
-            window_size=encoders.window_size,
-            abs_offset=abs_offset,
-            min_classifications=config.min_classifications,
+    # Version of the prepared data for HTTP caching
+    data_version = http_cache.get_file_version(datasets.cache_filepath)
+
+    # Memory-map the encodings. All endpoints share this read-only view and server
+    # processes on the same host share the encodings through the page cache.
+    encodings = datasets.load_encodings(verbose=verbose)
+
+    # Set up the prediction tile pyramids
+    prediction_pyramids = PredictionPyramids(
+        encodings,
+        datasets.chromsizes,
+        encoders.window_size,
+        config.step_freq,
+        abs_offset,
+        abs_len,
+        config.cache_dir,
+        data_version=data_version,
+        verbose=verbose,
+    )
+
+    # Set up classifiers
+    classifiers = Classifiers(
+        db,
+        encodings,
+        classifier_class=config.classifier,
+        classifier_params=config.classifier_params,
+        window_size=encoders.window_size,
+        abs_offset=abs_offset,
+        min_classifications=config.min_classifications,
+        on_trained=prediction_pyramids.build,
+    )
+
+    # Set up progresses
+    progresses = Progresses(db, classifiers)
+
+    # Set up projectors
+    projectors = Projectors(db, encodings, encoders.window_size, abs_offset)
+
+    # Set up the per-search distances to the target
+    target_distances = TargetDistances(
+        encodings, config.cache_dir, data_version=data_version
+    )
+
+    if config.quantize_encodings:
+        # The 8-bit quantized encodings are scanned instead of loading the HNSW
+        # index, which would hold another float32 copy of the encodings in memory.
+        # The nearest windows are re-ranked with the exact encodings.
+        knn_index = QuantizedEncodings(
+            datasets.quantized_encodings_filepath, datasets.encodings_filepath
+        ).load(verbose=verbose)
+    else:
+        # Load the kNN index of the encodings
+        knn_index = KnnIndex(datasets.knn_index_filepath, encodings).load(
+            verbose=verbose
         )
 
-        # Set up progresses
-        progresses = Progresses(db, classifiers)
+    # Set up the tileset registry
+    tileset_registry = Tilesets(
+        db, datasets, encoders, config, ext_filetype_handlers=ext_filetype_handlers
+    )
 
-        # Set up projectors
-        projectors = Projectors(db, encodings, encoders.window_size, abs_offset)
+    # Set up the tile cache
+    tile_cache = TileCache(config.tile_cache_size)
+
+    def get_prediction_etag(name: str, search_id, classifier):
+        """Get the ETag of data derived from the predictions of a search
+
+        Returns `None` if the classifier is not trained yet.
+        """
+        search_created = tileset_registry.get_search_created(search_id)
+
+        if search_created is None:
+            return None
+
+        if classifier is None:
+            return http_cache.get_etag(name, data_version, search_id, search_created)
+
+        if not classifier.is_trained:
+            return None
+
+        return http_cache.get_etag(
+            name,
+            data_version,
+            search_id,
+            search_created,
+            classifier.classifier_id,
+            classifier.created,
+        )
+
+    # Set up the thread pools for generating tiles. Tilesets and runs of bigWig tiles
+    # use separate pools as tileset workers wait for the runs of their tileset.
+    tileset_executor = None
+    run_executor = None
+    if config.tile_workers > 1:
+        tileset_executor = ThreadPoolExecutor(max_workers=config.tile_workers)
+        run_executor = ThreadPoolExecutor(max_workers=config.tile_workers)
 
     app = Flask(__name__, static_url_path="", static_folder="../ui/build")
     CORS(app)
@@ -195,12 +279,18 @@ def create(
                 )
 
             new_search = db.create_search(window, config)
+            tileset_registry.add_search(new_search[0], new_search[4])
 
             return jsonify({"info": "New search started", "id": new_search[0]})
 
         elif request.method == "DELETE":
             id = request.args.get("id")
             db.delete_search(id)
+            tileset_registry.remove_search(id)
+            prediction_pyramids.remove(id)
+            target_distances.remove(id)
+            classifiers.latest.pop(str(id), None)
+            tile_cache.invalidate("s{}p".format(id))
             return jsonify({"info": "It's all gone babe! Gone for good."})
 
         return jsonify({"error": "Unsupported action"}), 500
@@ -283,7 +373,7 @@ def create(
                 remove_windows = np.arange(window_from_idx + k, window_to_idx + k)
 
         with datasets.cache() as dsc:
-            num_windows = dsc.encodings.shape[0]
+            num_windows = encodings.shape[0]
 
             # Array determining which data points should be used
             data_selection = np.ones(num_windows).astype(bool)
@@ -308,24 +398,8 @@ def create(
         with datasets.cache() as dsc:
             classifier = classifiers.get(search_id, default=None)
 
-            encodings = dsc.encodings[:]
             encodings_knn_density = dsc.encodings_knn_density[:]
-
-            # Compute distance to target
-            N = encodings.shape[0]
             target = target.reshape((1, -1))
-            batch_size = 10000
-
-            encodings_dist = None
-            for batch_start in np.arange(0, N, batch_size):
-                encodings_batch = encodings[batch_start : batch_start + batch_size]
-
-                batch_dist = cdist(encodings_batch, target, "euclidean").flatten()
-
-                if encodings_dist is None:
-                    encodings_dist = batch_dist
-                else:
-                    encodings_dist = np.concatenate((encodings_dist, batch_dist))
 
             if classifier:
                 _, p_y = classifier.predict(encodings)
@@ -334,6 +408,11 @@ def create(
                 classifications.size >= config.min_classifications
                 and classifier is not None
             ):
+                # The distance of all windows is computed once per search
+                encodings_dist = target_distances.get(
+                    search_id, target, created=info["created"]
+                )
+
                 seeds = sampling.sample_by_uncertainty_dist_density(
                     encodings,
                     data_selection,
@@ -360,6 +439,18 @@ def create(
                 # Remove almost empty windows
                 data_selection[np.where((dsc.windows_max[:] < 0.1))] = False
 
+                # Only the windows nearest to the target are sampled from. Hence, we
+                # look them up in the kNN index instead of computing the distance of
+                # all windows.
+                nearest, nearest_dist = knn_index.nearest(
+                    target,
+                    sampling.get_dist_density_pool_size(),
+                    selected=data_selection,
+                )
+                encodings_dist = np.zeros(num_windows)
+                encodings_dist[:] = np.inf
+                encodings_dist[nearest] = nearest_dist
+
                 seeds = sampling.sample_by_dist_density(
                     encodings, data_selection, encodings_dist, encodings_knn_density
                 )
@@ -398,9 +489,8 @@ def create(
             abs_offset,
         )
 
-        with datasets.cache() as dsc:
-            num_window = dsc.encodings.shape[0]
-            fit_y, p_y = classifier.predict(dsc.encodings)
+        num_window = encodings.shape[0]
+        fit_y, p_y = classifier.predict(encodings)
 
         window_ids = np.arange(num_window)
 
@@ -483,46 +573,61 @@ def create(
         if search_id is None:
             return jsonify({"error": "Search id (`s`) is missing."}), 400
 
-        # Manual classifications
-        classifications = db.get_classifications(search_id)
-
-        # Get search target window IDs
         search = db.get_search(search_id)
-        search_target_windows = utils.get_target_window_idx(
-            search["target_from"],
-            search["target_to"],
-            encoders.window_size,
-            search["config"]["step_freq"],
-            abs_offset,
+
+        if search is None:
+            return jsonify({"error": "Search #{} not found".format(search_id)}), 404
+
+        etag = http_cache.get_etag(
+            "classes",
+            data_version,
+            search_id,
+            search["created"],
+            db.get_classifications_version(search_id),
         )
 
-        with datasets.cache() as dsc:
-            num_windows = dsc.windows.shape[0]
+        def get_classes():
+            # Manual classifications
+            classifications = db.get_classifications(search_id)
+
+            # Get search target window IDs
+            search_target_windows = utils.get_target_window_idx(
+                search["target_from"],
+                search["target_to"],
+                encoders.window_size,
+                search["config"]["step_freq"],
+                abs_offset,
+            )
 
-        classes = np.zeros(num_windows)
+            with datasets.cache() as dsc:
+                num_windows = dsc.windows.shape[0]
 
-        # Manually classified regions
-        for classification in classifications:
-            clazz = 0
-            if classification["classification"] == -1:
-                clazz = 1
-            if classification["classification"] == 1:
-                clazz = 2
+            classes = np.zeros(num_windows)
 
-            classes[classification["windowId"]] = clazz
+            # Manually classified regions
+            for classification in classifications:
+                clazz = 0
+                if classification["classification"] == -1:
+                    clazz = 1
+                if classification["classification"] == 1:
+                    clazz = 2
 
-        # The search target
-        classes[np.arange(*search_target_windows[1])] = 3
+                classes[classification["windowId"]] = clazz
 
-        return jsonify(
-            {
-                "results": base64.b64encode(classes.astype(np.uint8).tobytes()).decode(
-                    "ascii"
-                ),
-                "encoding": "base64",
-                "dtype": "uint8",
-            }
-        )
+            # The search target
+            classes[np.arange(*search_target_windows[1])] = 3
+
+            return jsonify(
+                {
+                    "results": base64.b64encode(
+                        classes.astype(np.uint8).tobytes()
+                    ).decode("ascii"),
+                    "encoding": "base64",
+                    "dtype": "uint8",
+                }
+            )
+
+        return http_cache.respond(request, etag, get_classes)
 
     @app.route("/api/v1/probabilities/", methods=["GET"])
     def view_probabilities():
@@ -534,28 +639,33 @@ def create(
 
         classifier = classifiers.get(search_id, classifier_id, default=None)
 
-        with datasets.cache() as dsc:
-            num_windows = dsc.windows.shape[0]
-            out = np.zeros(num_windows)
+        etag = get_prediction_etag("probabilities", search_id, classifier)
 
-            if classifier is None:
-                out[:] = 0.5
-            else:
-                # Load all encodings into memory. If this gets too slow or infeasible to
-                # to compute we need to start using `warm_start`. See the following:
-                # https://stackoverflow.com/a/30758348/981933
-                fit_y, p_y = classifier.predict(dsc.encodings[:])
-                out[:] = p_y[:, 1]
+        def get_probabilities():
+            with datasets.cache() as dsc:
+                num_windows = dsc.windows.shape[0]
+                out = np.zeros(num_windows)
 
-        return jsonify(
-            {
-                "results": base64.b64encode(out.astype(np.float32).tobytes()).decode(
-                    "ascii"
-                ),
-                "encoding": "base64",
-                "dtype": "float32",
-            }
-        )
+                if classifier is None:
+                    out[:] = 0.5
+                else:
+                    # If this gets too slow or infeasible to to compute we need
+                    # to start using `warm_start`. See the following:
+                    # https://stackoverflow.com/a/30758348/981933
+                    fit_y, p_y = classifier.predict(encodings)
+                    out[:] = p_y[:, 1]
+
+            return jsonify(
+                {
+                    "results": base64.b64encode(
+                        out.astype(np.float32).tobytes()
+                    ).decode("ascii"),
+                    "encoding": "base64",
+                    "dtype": "float32",
+                }
+            )
+
+        return http_cache.respond(request, etag, get_probabilities)
 
     @app.route("/api/v1/progress/", methods=["GET"])
     def view_progress():
@@ -578,6 +688,8 @@ def create(
 
         if request.method == "DELETE":
             classifiers.delete(search_id, classifier_id)
+            prediction_pyramids.remove(search_id, classifier_id)
+            tile_cache.invalidate("s{}p".format(search_id))
             msg = " has" if classifier_id else "s have"
             return jsonify({"info": "Classifier{} been deleted.".format(msg)})
 
@@ -791,10 +903,9 @@ def create(
                 )
 
             with utils.suppress_with_default(AttributeError) as projection:
-                with datasets.cache() as dsc:
-                    projection = base64.b64encode(
-                        projector.project(dsc.encodings[:]).tobytes()
-                    ).decode("ascii")
+                projection = base64.b64encode(
+                    projector.project(encodings).tobytes()
+                ).decode("ascii")
 
             # If the projector is already fitted the following call will do nothing
             projectors.fit(search_id, projector.projector_id)
@@ -1076,76 +1187,25 @@ def create(
     def tileset_info():
         uuids = request.args.getlist("d")
 
-        search_res = db.get_search()
-
-        # Get searches for special tilesets
-        searches = list(
-            map(
-                lambda x: {
-                    "uuid": "s{}p".format(x["id"]),
-                    "search_id": x["id"],
-                    "filetype": "__prediction__",
-                },
-                search_res,
-            )
-        )
-
-        autoencodings = datasets.export(use_uuid=True, autoencodings=True)
-
-        dataset_search_defs = datasets.export(use_uuid=True) + searches + autoencodings
-
         info = {}
         for uuid in uuids:
-            ts = next((ts for ts in dataset_search_defs if ts["uuid"] == uuid), None)
-
-            if ts is not None:
-                info[uuid] = ts.copy()
-
-                # see if there's a filepath provided
-                filetype = info[uuid].get("filetype")
-                filepath = info[uuid].get("filepath")
-
-                if ext_filetype_handlers and filetype in ext_filetype_handlers:
-                    handler = ext_filetype_handlers[filetype]["tileset_info"]
-                    if filepath is not None:
-                        info[uuid].update(handler(filepath))
-                    else:
-                        info[uuid].update(handler())
-                elif bigwig.is_bigwig(filepath, filetype):
-                    info[uuid] = {**bigwig.TILESET_INFO, **info[uuid]}
-                    info[uuid].update(bigwig.tileset_info(ts["filepath"]))
-                elif filetype == "cooler":
-                    info[uuid].update(cooler.tileset_info(ts["filepath"]))
-                elif filetype == "__autoencoding__":
-                    info[uuid] = {**vector.TILESET_INFO, **info[uuid]}
-                    info[uuid].update(
-                        vector.tileset_info(datasets.chromsizes, encoders.resolution)
-                    )
-                elif filetype == "__prediction__":
-                    info[uuid] = {**vector.TILESET_INFO, **info[uuid]}
-                    info[uuid].update(
-                        vector.tileset_info(
-                            datasets.chromsizes, encoders.window_size / config.step_freq
-                        )
-                    )
-                else:
-                    print(
-                        "Unknown filetype:", info[uuid].get("filetype"), file=sys.stderr
-                    )
-            else:
+            info[uuid] = tileset_registry.info(uuid)
+
+            if info[uuid] is None:
                 info[uuid] = {"error": "No such tileset with uid: {}".format(uuid)}
 
-            # Remove coords and chromsizes from the info dictionary
-            if "coords" in info[uuid]:
-                del info[uuid]["coords"]
-            if "chromsizes" in info[uuid]:
-                del info[uuid]["chromsizes"]
+        response = jsonify(info)
+        etag = http_cache.get_etag(response.get_data(as_text=True))
 
-        return jsonify(info)
+        if http_cache.is_not_modified(request, etag):
+            return http_cache.not_modified(etag)
+
+        return http_cache.set_headers(response, etag)
 
     @app.route("/api/v1/tiles/", methods=["GET"])
     def tiles():
         tids_requested = set(request.args.getlist("d"))
+        binary = request.args.get("format") == "binary"
 
         if not tids_requested:
             return jsonify({"error": "No tiles requested"}), 400
@@ -1155,87 +1215,171 @@ def create(
 
         uuids_to_tids = toolz.groupby(extract_uuid, tids_requested)
 
-        search_res = db.get_search()
-
-        # Get searches for special tilesets
-        searches = list(
-            map(
-                lambda x: {
-                    "uuid": "s{}p".format(x["id"]),
-                    "search_id": x["id"],
-                    "filetype": "__prediction__",
-                },
-                search_res,
+        def get_tileset_version(uuid):
+            """Get the version of a tileset's tiles
+
+            The version is `None` if the tiles should not be cached. The tile URLs
+            do not contain the version, hence, the tiles are always revalidated
+            using the ETag.
+            """
+            ts = tileset_registry.get(uuid)
+
+            if ts is None:
+                return None
+
+            filetype = ts.get("filetype")
+            filepath = ts.get("filepath")
+
+            if ext_filetype_handlers and filetype in ext_filetype_handlers:
+                return None
+
+            elif bigwig.is_bigwig(filepath, filetype):
+                version = http_cache.get_file_version(filepath)
+                if version is None:
+                    return None
+                return version, config.tile_pyramid
+
+            elif bigbed.is_bigbed(filepath, filetype):
+                return http_cache.get_file_version(filepath)
+
+            elif filetype == "cooler":
+                return http_cache.get_file_version(filepath)
+
+            elif filetype == "__autoencoding__":
+                dataset = datasets.get(uuid.split("|")[0])
+                return http_cache.get_file_version(dataset.cache_filepath)
+
+            elif filetype == "__prediction__":
+                classifier = classifiers.get(ts["search_id"], default=None)
+                if classifier is None:
+                    return None
+
+                # New classifiers change the tiles
+                return get_prediction_etag("tiles", ts["search_id"], classifier)
+
+            return None
+
+        compression = None
+        if binary:
+            compression = tile_encoding.get_compression(
+                request.headers.get("Accept-Encoding")
             )
-        )
 
-        autoencodings = datasets.export(use_uuid=True, autoencodings=True)
+        tileset_versions = [get_tileset_version(uuid) for uuid in sorted(uuids_to_tids)]
 
-        dataset_search_defs = datasets.export(use_uuid=True) + searches + autoencodings
+        etag = None
+        if all(version is not None for version in tileset_versions):
+            etag = http_cache.get_etag(
+                "tiles", binary, compression, *sorted(tids_requested), *tileset_versions
+            )
 
-        tiles = []
-        for uuid, tids in uuids_to_tids.items():
-            ts = next((ts for ts in dataset_search_defs if ts["uuid"] == uuid), None)
-            if ts is not None:
-                filetype = ts.get("filetype")
-                filepath = ts.get("filepath")
-
-                if ext_filetype_handlers and filetype in ext_filetype_handlers:
-                    handler = ext_filetype_handlers[filetype]["tiles"]
-                    if filepath is not None:
-                        tiles.extend(handler(filepath, tids))
-                    else:
-                        tiles.extend(handler(tids))
-                elif bigwig.is_bigwig(filepath, filetype):
-                    tiles.extend(
-                        bigwig.tiles(filepath, tids, ts.get("chromsizes", None))
-                    )
-                elif filetype == "cooler":
-                    tiles.extend(cooler.tiles(filepath, tids))
-                elif filetype == "__autoencoding__":
-                    dataset = datasets.get(uuid.split("|")[0])
-                    with dataset.cache() as dsc:
-                        tiles.extend(
-                            vector.tiles(
-                                dsc.autoencodings,
-                                encoders.resolution,
-                                abs_len,
-                                abs_offset,
-                                tids,
-                                datasets.chromsizes,
-                            )
-                        )
-                elif filetype == "__prediction__":
-                    classifier = classifiers.get(ts["search_id"])
+        if http_cache.is_not_modified(request, etag):
+            return http_cache.not_modified(etag)
 
-                    if classifier is None:
-                        return jsonify({})
+        def tileset_tiles(uuid, tids):
+            """Generate the tiles of one tileset
 
-                    with datasets.cache() as dsc:
-                        _, p_y = classifier.predict(dsc.encodings[:])
+            Returns `None` if there is no classifier for a prediction tileset.
+            """
+            ts = tileset_registry.get(uuid)
 
-                    p_y_merged = utils.merge_interleaved(
-                        p_y[:, 1], config.step_freq, aggregator=np.nanmax
+            if ts is None:
+                return []
+
+            filetype = ts.get("filetype")
+            filepath = ts.get("filepath")
+
+            if ext_filetype_handlers and filetype in ext_filetype_handlers:
+                handler = ext_filetype_handlers[filetype]["tiles"]
+                if filepath is not None:
+                    return handler(filepath, tids)
+                return handler(tids)
+
+            elif bigwig.is_bigwig(filepath, filetype):
+                dataset = datasets.get(uuid)
+
+                def get_bigwig_tiles(tids):
+                    return dataset.tiles(tids, executor=run_executor)
+
+                return tile_cache.tiles(tids, get_bigwig_tiles)
+
+            elif bigbed.is_bigbed(filepath, filetype):
+                return tile_cache.tiles(
+                    tids, lambda tids: bigbed.tiles(filepath, tids)
+                )
+
+            elif filetype == "cooler":
+                return cooler.tiles(filepath, tids)
+
+            elif filetype == "__autoencoding__":
+                dataset = datasets.get(uuid.split("|")[0])
+
+                def get_autoencoding_tiles(tids):
+                    return dataset.autoencoding_tiles(
+                        tids, encoders.resolution, abs_offset, abs_len
                     )
 
-                    res_merged = int(encoders.window_size / config.step_freq)
-
-                    tiles.extend(
-                        vector.tiles(
-                            p_y_merged,
-                            res_merged,
-                            abs_len,  # Absolute length of the chromosome
-                            abs_offset,
-                            tids,
-                            datasets.chromsizes,
-                            aggregator=np.max,
-                            scaleup_aggregator=np.median,
-                        )
+                return tile_cache.tiles(tids, get_autoencoding_tiles)
+
+            elif filetype == "__prediction__":
+                classifier = classifiers.get(ts["search_id"], default=None)
+
+                if classifier is None:
+                    return None
+
+                def get_prediction_tiles(tids):
+                    return prediction_pyramids.tiles(classifier, tids)
+
+                if classifier.is_trained:
+                    # Prediction tiles are invalidated by newer classifiers
+                    return tile_cache.tiles(
+                        tids, get_prediction_tiles, version=classifier.classifier_id
                     )
-                else:
-                    print("Unknown filetype:", filetype, file=sys.stderr)
 
-        data = {tid: tval for tid, tval in tiles}
-        return jsonify(data)
+                return get_prediction_tiles(tids)
+
+            print("Unknown filetype:", filetype, file=sys.stderr)
+            return []
+
+        # The tilesets are independent, hence, their tiles are generated concurrently
+        if tileset_executor is not None and len(uuids_to_tids) > 1:
+            futures = [
+                tileset_executor.submit(tileset_tiles, uuid, tids)
+                for uuid, tids in uuids_to_tids.items()
+            ]
+            tileset_results = [future.result() for future in futures]
+        else:
+            tileset_results = [
+                tileset_tiles(uuid, tids) for uuid, tids in uuids_to_tids.items()
+            ]
+
+        tiles = []
+        for tileset_result in tileset_results:
+            if tileset_result is None:
+                return jsonify({})
+            tiles.extend(tileset_result)
+
+        if binary:
+            response = Response(
+                tile_encoding.compress(tile_encoding.to_binary(tiles), compression),
+                mimetype="application/octet-stream",
+            )
+            if compression is not None:
+                response.headers["Content-Encoding"] = compression
+            response.headers["Vary"] = "Accept-Encoding"
+        else:
+            response = jsonify(
+                {tid: tile_encoding.to_json(tval) for tid, tval in tiles}
+            )
+
+        return http_cache.set_headers(response, etag)
+
+    @app.route("/api/v1/tile-cache/", methods=["GET", "DELETE"])
+    def view_tile_cache():
+        if request.method == "DELETE":
+            tile_cache.clear()
+            return jsonify({"info": "Tile cache has been cleared."})
+
+        return jsonify(tile_cache.export())
 
     return app
@@ -0,0 +1,128 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import glob
+import numpy as np
+import os
+import threading
+from contextlib import suppress
+
+from server import http_cache
+
+# Number of encodings converted to float64 at once
+BLOCK_SIZE = 2 ** 16
+
+
+class TargetDistances:
+    """Euclidean distances of all encoded windows to the target of a search
+
+    The distance vector of a search is computed once from the squared norms of the
+    encodings and a BLAS matrix-vector product with the encoded target. It's kept
+    in memory and stored in the cache directory, such that subsequent requests do
+    not pay any distance cost, even after a restart.
+
+    Arguments:
+        encodings {np.ndarray} -- Encodings of all windows
+        cache_dir {str} -- Directory to store the distance vectors
+
+    Keyword Arguments:
+        data_version {str} -- Version of the prepared data. Distance vectors of
+            other versions are not reused. (default: {None})
+    """
+
+    def __init__(self, encodings: np.ndarray, cache_dir: str, data_version: str = None):
+        self.encodings = encodings
+        self.cache_dir = cache_dir
+        self.data_version = data_version
+
+        self.distances = {}
+        self._sq_norms = None
+        self._lock = threading.Lock()
+
+    @property
+    def sq_norms(self) -> np.ndarray:
+        if self._sq_norms is None:
+            self._sq_norms = np.zeros(self.encodings.shape[0])
+            for start in range(0, self.encodings.shape[0], BLOCK_SIZE):
+                block = self.encodings[start : start + BLOCK_SIZE].astype(np.float64)
+                self._sq_norms[start : start + BLOCK_SIZE] = np.einsum(
+                    "ij,ij->i", block, block
+                )
+        return self._sq_norms
+
+    def get_filepath(self, search_id: int, created: str = None) -> str:
+        version = http_cache.get_etag(self.data_version, search_id, created)
+        return os.path.join(
+            self.cache_dir, "target_dist_s{}_{}.npy".format(search_id, version[:12])
+        )
+
+    def compute(self, target: np.ndarray) -> np.ndarray:
+        """Compute the distance of all windows to the target"""
+        target = target.astype(np.float64).flatten()
+
+        # ||x - t||^2 = ||x||^2 - 2 x.t + ||t||^2
+        dist = np.zeros(self.encodings.shape[0])
+        for start in range(0, self.encodings.shape[0], BLOCK_SIZE):
+            block = self.encodings[start : start + BLOCK_SIZE].astype(np.float64)
+            dist[start : start + BLOCK_SIZE] = block @ target
+
+        dist *= -2
+        dist += self.sq_norms
+        dist += target @ target
+
+        # Rounding errors might result in slightly negative squared distances
+        np.maximum(dist, 0, out=dist)
+
+        return np.sqrt(dist, out=dist)
+
+    def get(self, search_id: int, target: np.ndarray, created: str = None):
+        """Get the distance of all windows to the target of a search
+
+        Arguments:
+            search_id {int} -- Search ID
+            target {np.ndarray} -- Encoded search target
+
+        Keyword Arguments:
+            created {str} -- Creation date of the search to distinguish searches
+                that reuse the ID of a deleted search (default: {None})
+
+        Returns:
+            {np.ndarray} -- Read-only distances of all windows
+        """
+        filepath = self.get_filepath(search_id, created)
+
+        try:
+            return self.distances[filepath]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if filepath not in self.distances:
+                if not os.path.exists(filepath):
+                    tmp_filepath = "{}.tmp".format(filepath)
+                    with open(tmp_filepath, "wb") as f:
+                        np.save(f, self.compute(target))
+                    os.replace(tmp_filepath, filepath)
+
+                self.distances[filepath] = np.load(filepath, mmap_mode="r")
+
+        return self.distances[filepath]
+
+    def remove(self, search_id: int):
+        """Remove the distance vectors of a search"""
+        pattern = "target_dist_s{}_*.npy".format(search_id)
+
+        for filepath in glob.glob(os.path.join(self.cache_dir, pattern)):
+            self.distances.pop(filepath, None)
+            with suppress(FileNotFoundError):
+                os.remove(filepath)
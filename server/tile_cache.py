@@ -0,0 +1,206 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+import sys
+import threading
+from collections import OrderedDict
+
+from server import bigwig
+from server.defaults import TILE_CACHE_SIZE
+
+
+def get_size(tile_value) -> int:
+    """Approximate the memory footprint of a tile value in bytes"""
+    if isinstance(tile_value, np.ndarray):
+        return tile_value.nbytes
+
+    size = sys.getsizeof(tile_value)
+
+    if isinstance(tile_value, dict):
+        for key, value in tile_value.items():
+            size += sys.getsizeof(key) + get_size(value)
+
+    elif isinstance(tile_value, (list, tuple)):
+        for value in tile_value:
+            size += get_size(value)
+
+    return size
+
+
+class TileCache:
+    """Least-recently-used cache for generated HiGlass tiles
+
+    Tiles are keyed by the tileset uuid, zoom level, tile position, and a data version.
+    Static tilesets, like bigWig tracks, always use the same version. Dynamic tilesets,
+    like the predictions of a search, use a new version whenever their data changes,
+    e.g., the classifier id. All tiles of an outdated version are dropped as soon as a
+    tile of a newer version is requested.
+
+    Keyword Arguments:
+        max_size {int} -- Memory budget in bytes. `0` disables the cache.
+            (default: {TILE_CACHE_SIZE})
+    """
+
+    def __init__(self, max_size: int = TILE_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._tiles = OrderedDict()
+        self._versions = {}
+        self._keys_by_uuid = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _key(self, tile_id: str, version):
+        uuid, zoom_level, tile_pos = bigwig.parse_tile_id(tile_id)
+        return (uuid, zoom_level, tile_pos, version)
+
+    def _remove(self, key):
+        tile_id, tile_value, size = self._tiles.pop(key)
+        self.size -= size
+        self._keys_by_uuid[key[0]].discard(key)
+
+    def _set_version(self, uuid: str, version):
+        if self._versions.get(uuid, version) != version:
+            for key in list(self._keys_by_uuid.get(uuid, ())):
+                self._remove(key)
+        self._versions[uuid] = version
+
+    def get(self, tile_id: str, version=None):
+        """Get a cached tile
+
+        Arguments:
+            tile_id {str} -- HiGlass tile id, e.g., `uuid.zoom.pos`
+
+        Keyword Arguments:
+            version {hashable} -- Data version of the tileset (default: {None})
+
+        Returns:
+            {dict} -- Tile value or `None` if the tile is not cached
+        """
+        if not self.enabled:
+            return None
+
+        key = self._key(tile_id, version)
+
+        with self._lock:
+            self._set_version(key[0], version)
+
+            try:
+                self._tiles.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._tiles[key][1]
+
+    def set(self, tile_id: str, tile_value: dict, version=None):
+        """Cache a tile and evict the least-recently-used tiles if necessary
+
+        Arguments:
+            tile_id {str} -- HiGlass tile id, e.g., `uuid.zoom.pos`
+            tile_value {dict|list} -- Tile value
+
+        Keyword Arguments:
+            version {hashable} -- Data version of the tileset (default: {None})
+        """
+        if not self.enabled:
+            return
+
+        key = self._key(tile_id, version)
+        size = get_size(tile_value)
+
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            self._set_version(key[0], version)
+
+            if key in self._tiles:
+                self._remove(key)
+
+            self._tiles[key] = (tile_id, tile_value, size)
+            self._keys_by_uuid.setdefault(key[0], set()).add(key)
+            self.size += size
+
+            while self.size > self.max_size:
+                self._remove(next(iter(self._tiles)))
+                self.evictions += 1
+
+    def invalidate(self, uuid: str):
+        """Remove all cached tiles of a tileset"""
+        with self._lock:
+            for key in list(self._keys_by_uuid.get(uuid, ())):
+                self._remove(key)
+            self._versions.pop(uuid, None)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._versions.clear()
+            self._keys_by_uuid.clear()
+            self.size = 0
+
+    def tiles(self, tile_ids, get_tiles: callable, version=None):
+        """Get tiles from the cache and generate the missing ones
+
+        Arguments:
+            tile_ids {list} -- HiGlass tile ids of one tileset
+            get_tiles {callable} -- Function generating a list of `(tile_id, value)`
+                tuples for a list of tile ids
+
+        Keyword Arguments:
+            version {hashable} -- Data version of the tileset (default: {None})
+
+        Returns:
+            {list} -- List of `(tile_id, tile_value)` tuples
+        """
+        cached_tiles = []
+        missing_tile_ids = []
+        for tile_id in tile_ids:
+            tile_value = self.get(tile_id, version)
+            if tile_value is None:
+                missing_tile_ids.append(tile_id)
+            else:
+                cached_tiles.append((tile_id, tile_value))
+
+        if not missing_tile_ids:
+            return cached_tiles
+
+        generated_tiles = get_tiles(missing_tile_ids)
+
+        for tile_id, tile_value in generated_tiles:
+            self.set(tile_id, tile_value, version)
+
+        return cached_tiles + generated_tiles
+
+    def export(self):
+        return {
+            "size": self.size,
+            "maxSize": self.max_size,
+            "numTiles": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
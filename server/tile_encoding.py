@@ -0,0 +1,213 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import base64
+import json
+import struct
+import zlib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIN_F16 = np.finfo("float16").min
+MAX_F16 = np.finfo("float16").max
+
+# Binary tile format:
+#   header: MAGIC, uint32 number of tiles
+#   frame:  uint16 tile id length, tile id (utf-8), uint8 dtype code,
+#           uint32 payload length, payload
+# All integers are little endian. Payloads of dense tiles are the raw array buffers
+# while other tile values (e.g., intervals or errors) are JSON-encoded.
+MAGIC = b"PXT1"
+
+DTYPE_CODES = {"json": 0, "float16": 1, "float32": 2, "uint8": 3}
+
+HEADER = struct.Struct("<4sI")
+FRAME_ID = struct.Struct("<H")
+FRAME_PAYLOAD = struct.Struct("<BI")
+
+COMPRESSIONS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+
+def get_dtype(dense: np.ndarray, allow_uint8: bool = False) -> str:
+    """Get the smallest dtype representing a dense tile without noticeable loss
+
+    Arguments:
+        dense {np.ndarray} -- Dense tile data
+
+    Keyword Arguments:
+        allow_uint8 {bool} -- If `True` integer data between 0 and 255 is encoded as
+            `uint8`. HiGlass' JSON tiles only support float16 and float32.
+            (default: {False})
+
+    Returns:
+        {str} -- Name of the dtype
+    """
+    if not dense.size:
+        return "float16"
+
+    # `min()` and `max()` propagate NaNs and the comparisons are `False` for NaNs,
+    # hence, this implicitly checks for NaNs as well.
+    min_dense = dense.min()
+    max_dense = dense.max()
+
+    if allow_uint8 and min_dense >= 0 and max_dense <= 255:
+        if np.array_equal(dense, np.floor(dense)):
+            return "uint8"
+
+    if min_dense > MIN_F16 and max_dense < MAX_F16:
+        return "float16"
+
+    return "float32"
+
+
+def get_tile_value(dense: np.ndarray, allow_uint8: bool = False) -> dict:
+    """Create a tile value holding the raw dense array in the smallest dtype
+
+    Use `to_json()` or `to_binary()` to serialize the tile value.
+    """
+    dense = np.asarray(dense)
+    dtype = get_dtype(dense, allow_uint8=allow_uint8)
+    return {"dense": dense.astype(dtype, copy=False), "dtype": dtype}
+
+
+def to_json(tile_value: dict) -> dict:
+    """Base64-encode the dense array of a tile value for HiGlass' JSON tiles
+
+    Tile values that are already encoded, e.g., from an external filetype handler,
+    are returned as is.
+    """
+    if not isinstance(tile_value, dict):
+        # E.g., lists of intervals
+        return tile_value
+
+    dense = tile_value.get("dense")
+
+    if not isinstance(dense, np.ndarray):
+        return tile_value
+
+    if dense.dtype == np.uint8:
+        # JSON tiles do not support uint8
+        dense = dense.astype(np.float16)
+
+    return {
+        **tile_value,
+        "dense": base64.b64encode(np.ascontiguousarray(dense)).decode("utf-8"),
+        "dtype": str(dense.dtype),
+    }
+
+
+def get_frame(tile_id: str, tile_value) -> list:
+    dense = None
+    dtype = None
+    if isinstance(tile_value, dict):
+        dense = tile_value.get("dense")
+        dtype = tile_value.get("dtype")
+
+    if isinstance(dense, str) and dtype in DTYPE_CODES:
+        payload = memoryview(base64.b64decode(dense))
+    elif isinstance(dense, np.ndarray) and str(dense.dtype) in DTYPE_CODES:
+        # Binary tiles support uint8, which is lossless for small integer data
+        dtype = get_dtype(dense, allow_uint8=True)
+        if dtype != "uint8":
+            dtype = str(dense.dtype)
+        dense = dense.astype(dtype, copy=False)
+        payload = memoryview(np.ascontiguousarray(dense)).cast("B")
+    else:
+        dtype = "json"
+        payload = memoryview(json.dumps(to_json(tile_value)).encode("utf-8"))
+
+    tile_id = tile_id.encode("utf-8")
+
+    return [
+        FRAME_ID.pack(len(tile_id)),
+        tile_id,
+        FRAME_PAYLOAD.pack(DTYPE_CODES[dtype], payload.nbytes),
+        payload,
+    ]
+
+
+def to_binary(tiles: list) -> bytes:
+    """Serialize tiles into length-prefixed binary frames
+
+    Arguments:
+        tiles {list} -- List of `(tile_id, tile_value)` tuples
+
+    Returns:
+        {bytes} -- Serialized tiles. See `MAGIC` for the format.
+    """
+    buffers = [HEADER.pack(MAGIC, len(tiles))]
+    for tile_id, tile_value in tiles:
+        buffers.extend(get_frame(tile_id, tile_value))
+
+    # `join()` consumes the memoryviews directly, i.e., the array buffers are only
+    # copied once into the response
+    return b"".join(buffers)
+
+
+def from_binary(data: bytes) -> list:
+    """Deserialize binary tiles. This is the inverse of `to_binary()`"""
+    dtypes = {code: dtype for dtype, code in DTYPE_CODES.items()}
+    data = memoryview(data)
+
+    magic, num_tiles = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Unknown binary tile format")
+
+    offset = HEADER.size
+    tiles = []
+    for _ in range(num_tiles):
+        (id_len,) = FRAME_ID.unpack_from(data, offset)
+        offset += FRAME_ID.size
+        tile_id = bytes(data[offset : offset + id_len]).decode("utf-8")
+        offset += id_len
+        dtype_code, payload_len = FRAME_PAYLOAD.unpack_from(data, offset)
+        offset += FRAME_PAYLOAD.size
+        payload = data[offset : offset + payload_len]
+        offset += payload_len
+
+        dtype = dtypes[dtype_code]
+        if dtype == "json":
+            tiles.append((tile_id, json.loads(bytes(payload).decode("utf-8"))))
+        else:
+            tiles.append(
+                (tile_id, {"dense": np.frombuffer(payload, dtype=dtype), "dtype": dtype})
+            )
+
+    return tiles
+
+
+def get_compression(accept_encoding: str) -> str:
+    """Pick the best supported compression given an `Accept-Encoding` header"""
+    accepted = {
+        encoding.split(";")[0].strip().lower()
+        for encoding in (accept_encoding or "").split(",")
+    }
+    for compression in COMPRESSIONS:
+        if compression in accepted:
+            return compression
+    return None
+
+
+def compress(data: bytes, compression: str = None, level: int = 3) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    if compression == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    return data
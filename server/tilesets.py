@@ -0,0 +1,156 @@
+"""
+Copyright 2018 Novartis Institutes for BioMedical Research Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import cooler
+import sys
+import threading
+
+from server import bigbed, bigwig, vector
+
+
+def get_prediction_uuid(search_id) -> str:
+    return "s{}p".format(search_id)
+
+
+class Tilesets:
+    """In-memory registry of all tilesets keyed by their uuid
+
+    The registry holds the tileset definitions of the datasets, their autoencodings,
+    and the predictions of every search. Datasets and autoencodings are fixed once
+    the server started and searches are only added or removed via `add_search()`
+    and `remove_search()`. Hence, looking up a tileset never touches the database.
+    The tileset info of every tileset is computed only once.
+
+    Arguments:
+        db {DB} -- Database
+        datasets {Datasets} -- Datasets
+        encoders {Encoders} -- Encoders
+        config {Config} -- Config
+
+    Keyword Arguments:
+        ext_filetype_handlers {dict} -- External filetype handlers (default: {None})
+    """
+
+    def __init__(self, db, datasets, encoders, config, ext_filetype_handlers=None):
+        self.db = db
+        self.datasets = datasets
+        self.encoders = encoders
+        self.config = config
+        self.ext_filetype_handlers = ext_filetype_handlers
+
+        self.tilesets = {}
+        self.infos = {}
+        self._lock = threading.Lock()
+
+        for ts in datasets.export(use_uuid=True) + datasets.export(
+            use_uuid=True, autoencodings=True
+        ):
+            self.tilesets[ts["uuid"]] = ts
+
+        for search in db.get_search():
+            self.add_search(search["id"], search["created"])
+
+    def __contains__(self, uuid: str):
+        return uuid in self.tilesets
+
+    def get(self, uuid: str):
+        """Get the tileset definition or `None` if the tileset does not exist"""
+        return self.tilesets.get(uuid)
+
+    def add_search(self, search_id: int, created: str = None):
+        uuid = get_prediction_uuid(search_id)
+        with self._lock:
+            self.tilesets[uuid] = {
+                "uuid": uuid,
+                "search_id": search_id,
+                "filetype": "__prediction__",
+                "created": created,
+            }
+            self.infos.pop(uuid, None)
+
+    def remove_search(self, search_id: int):
+        uuid = get_prediction_uuid(search_id)
+        with self._lock:
+            self.tilesets.pop(uuid, None)
+            self.infos.pop(uuid, None)
+
+    def get_search_created(self, search_id: int):
+        ts = self.get(get_prediction_uuid(search_id))
+        return None if ts is None else ts["created"]
+
+    def compute_info(self, ts: dict) -> dict:
+        info = ts.copy()
+
+        # see if there's a filepath provided
+        filetype = info.get("filetype")
+        filepath = info.get("filepath")
+
+        if self.ext_filetype_handlers and filetype in self.ext_filetype_handlers:
+            handler = self.ext_filetype_handlers[filetype]["tileset_info"]
+            if filepath is not None:
+                info.update(handler(filepath))
+            else:
+                info.update(handler())
+        elif bigwig.is_bigwig(filepath, filetype):
+            info = {**bigwig.TILESET_INFO, **info}
+            info.update(bigwig.tileset_info(filepath))
+        elif bigbed.is_bigbed(filepath, filetype):
+            info = {**bigbed.TILESET_INFO, **info}
+            info.update(bigbed.tileset_info(filepath))
+        elif filetype == "cooler":
+            info.update(cooler.tileset_info(filepath))
+        elif filetype == "__autoencoding__":
+            info = {**vector.TILESET_INFO, **info}
+            info.update(
+                vector.tileset_info(self.datasets.chromsizes, self.encoders.resolution)
+            )
+        elif filetype == "__prediction__":
+            info = {**vector.TILESET_INFO, **info}
+            info.update(
+                vector.tileset_info(
+                    self.datasets.chromsizes,
+                    self.encoders.window_size / self.config.step_freq,
+                )
+            )
+            del info["created"]
+        else:
+            print("Unknown filetype:", info.get("filetype"), file=sys.stderr)
+
+        # Remove coords and chromsizes from the info dictionary
+        if "coords" in info:
+            del info["coords"]
+        if "chromsizes" in info:
+            del info["chromsizes"]
+
+        return info
+
+    def info(self, uuid: str) -> dict:
+        """Get the tileset info or `None` if the tileset does not exist"""
+        try:
+            return self.infos[uuid]
+        except KeyError:
+            pass
+
+        ts = self.get(uuid)
+
+        if ts is None:
+            return None
+
+        info = self.compute_info(ts)
+
+        with self._lock:
+            # The tileset might have been removed in the meantime
+            if uuid in self.tilesets:
+                self.infos[uuid] = info
+
+        return info
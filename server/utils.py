@@ -11,15 +11,18 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import h5py
 import hnswlib
 import numpy as np
 import itertools
 import operator
 import os
+import queue
 import sys
+import threading
 import warnings
 
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
 
 from scipy.ndimage.interpolation import zoom
 from scipy.stats import norm
@@ -122,6 +125,196 @@ def normalize(data, percentile: float = 99.9):
     return MinMaxScaler().fit_transform(data_norm)
 
 
+# Relative accuracy of the quantile sketch used for the normalization cutoff
+SKETCH_ACCURACY = 0.001
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with a bounded relative error
+
+    Values are counted in logarithmically sized buckets (DDSketch), such that every
+    quantile is estimated within a relative error of `relative_accuracy`. Sketches
+    of different batches, e.g., of different chromosomes, can be merged.
+
+    Keyword Arguments:
+        relative_accuracy {float} -- Maximum relative error of the estimated
+            quantiles (default: {SKETCH_ACCURACY})
+    """
+
+    def __init__(self, relative_accuracy: float = SKETCH_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def get_keys(self, x: np.ndarray) -> np.ndarray:
+        return np.ceil(np.log(x) / self.log_gamma).astype(np.int64)
+
+    def get_values(self, keys: np.ndarray) -> np.ndarray:
+        return 2 * self.gamma ** keys / (self.gamma + 1)
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+
+        if values.size == 0:
+            return
+
+        self.count += values.size
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.zero_count += int(np.count_nonzero(values == 0))
+
+        for store, x in (
+            (self.positive, values[values > 0]),
+            (self.negative, -values[values < 0]),
+        ):
+            keys, counts = np.unique(self.get_keys(x), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                store[key] = store.get(key, 0) + count
+
+    def merge(self, other):
+        assert (
+            self.relative_accuracy == other.relative_accuracy
+        ), "Only sketches of the same accuracy can be merged"
+
+        for store, other_store in (
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Estimate the `q`-th quantile like `np.quantile()`
+
+        Returns:
+            {float} -- Estimated quantile or `NaN` if the sketch is empty
+        """
+        if self.count == 0:
+            return np.nan
+
+        rank = q * (self.count - 1)
+
+        # The extremes are known exactly
+        if rank <= 0:
+            return float(self.min)
+        if rank >= self.count - 1:
+            return float(self.max)
+
+        neg_keys = np.array(sorted(self.negative, reverse=True), dtype=np.int64)
+        pos_keys = np.array(sorted(self.positive), dtype=np.int64)
+
+        values = np.concatenate(
+            (-self.get_values(neg_keys), [0.0], self.get_values(pos_keys))
+        )
+        counts = np.concatenate(
+            (
+                [self.negative[key] for key in neg_keys.tolist()],
+                [self.zero_count],
+                [self.positive[key] for key in pos_keys.tolist()],
+            )
+        )
+
+        i = np.searchsorted(np.cumsum(counts), rank, side="right")
+
+        return float(np.clip(values[min(i, values.size - 1)], self.min, self.max))
+
+
+class Normalizer:
+    """Streaming and mergeable variant of `normalize()`
+
+    First, `update()` with all batches to collect the column-wise min and max and a
+    quantile sketch of the values, then, `fit()` to estimate the upper cutoff, and
+    finally `transform()` the batches in place. Normalizers of different batches
+    can be combined with `merge()` before fitting. The fitted parameters can be
+    stored with `get_params()` and restored with `set_params()`.
+
+    Keyword Arguments:
+        percentile {float} -- Percentile of the upper cutoff (default: {99.9})
+        relative_accuracy {float} -- Relative accuracy of the cutoff
+            (default: {SKETCH_ACCURACY})
+    """
+
+    def __init__(
+        self, percentile: float = 99.9, relative_accuracy: float = SKETCH_ACCURACY
+    ):
+        self.percentile = percentile
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.data_min = None
+        self.data_max = None
+        self.cutoff = None
+        self.scale = None
+        self.min = None
+
+    def update(self, batch: np.ndarray):
+        self.sketch.add(batch)
+        self.merge_min_max(np.nanmin(batch, axis=0), np.nanmax(batch, axis=0))
+
+    def merge_min_max(self, data_min: np.ndarray, data_max: np.ndarray):
+        if self.data_min is None:
+            self.data_min = data_min
+            self.data_max = data_max
+        else:
+            self.data_min = np.fmin(self.data_min, data_min)
+            self.data_max = np.fmax(self.data_max, data_max)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        if other.data_min is not None:
+            self.merge_min_max(other.data_min, other.data_max)
+
+    def fit(self):
+        self.cutoff = self.sketch.quantile(self.percentile / 100)
+
+        data_min = self.data_min
+        data_max = self.data_max
+        if not np.isnan(self.cutoff):
+            # Clipping is monotonic, hence, the clipped min and max are the clipped
+            # min and max. The lower cutoff is the minimum, i.e., a no-op.
+            data_min = np.minimum(data_min, self.cutoff)
+            data_max = np.minimum(data_max, self.cutoff)
+
+        # Same as `MinMaxScaler`
+        data_range = data_max - data_min
+        data_range[data_range < 10 * np.finfo(data_range.dtype).eps] = 1.0
+        self.scale = 1.0 / data_range
+        self.min = 0 - data_min * self.scale
+
+    def transform(self, batch: np.ndarray) -> np.ndarray:
+        """Clip and scale a batch in place"""
+        if not np.isnan(self.cutoff):
+            np.minimum(batch, self.cutoff, out=batch)
+        batch *= self.scale
+        batch += self.min
+        return batch
+
+    def get_params(self) -> dict:
+        return {
+            "percentile": self.percentile,
+            "cutoff": self.cutoff,
+            "scale": self.scale,
+            "min": self.min,
+        }
+
+    def set_params(self, percentile: float, cutoff: float, scale, min):
+        self.percentile = percentile
+        self.cutoff = cutoff
+        self.scale = np.asarray(scale)
+        self.min = np.asarray(min)
+        return self
+
+
 def normalize_simple(data: np.ndarray):
     data -= np.min(data)
     return data / np.max(data)
@@ -316,6 +509,98 @@ def merge_interleaved(v, step_freq, aggregator=np.nanmean):
     return aggregator(blowup, axis=1)
 
 
+class InterleavedMerger:
+    """Streaming equivalent of `merge_interleaved_mat()`
+
+    Windows are added in batches with `add()`, which returns the merged values that
+    are complete, i.e., that do not depend on later windows. The result is identical
+    to merging all windows at once.
+
+    Arguments:
+        num_windows {int} -- Total number of windows
+        window_len {int} -- Number of values per window
+        step_freq {int} -- Step frequency of the windows
+
+    Keyword Arguments:
+        kernel {np.ndarray} -- Weights of the values of a window. By default the mean
+            of the interleaved values is taken. (default: {None})
+    """
+
+    def __init__(
+        self,
+        num_windows: int,
+        window_len: int,
+        step_freq: int,
+        kernel: np.ndarray = None,
+    ):
+        self.num_windows = num_windows
+        self.window_len = window_len
+        self.step_freq = step_freq
+        self.kernel = np.ones(window_len) if kernel is None else kernel
+        # Step size and output length as in `merge_interleaved_mat()`
+        self.step = int(window_len / step_freq)
+        self.out_len = int(num_windows / step_freq) * window_len
+        self.buffer = np.zeros((0, window_len))
+        self.buffer_start = 0  # Index of the first buffered window
+        self.pos = 0  # Index of the first incomplete output value
+
+    def get_ready_pos(self, num_added: int) -> int:
+        """Get the end of the output values that only depend on added windows"""
+        if num_added >= self.num_windows:
+            return self.out_len
+
+        ready = self.out_len
+        for i in range(self.step_freq):
+            # Number of windows of stream `i` that were added
+            num_stream = max(0, int(np.ceil((num_added - i) / self.step_freq)))
+            ready = min(ready, num_stream * self.window_len + i * self.step)
+        return ready
+
+    def add(self, windows: np.ndarray) -> np.ndarray:
+        """Add the next windows and get the newly completed output values"""
+        self.buffer = np.concatenate((self.buffer, windows))
+        num_added = self.buffer_start + self.buffer.shape[0]
+        end = self.get_ready_pos(num_added)
+
+        if end <= self.pos:
+            return np.zeros(0)
+
+        # Output values and their kernel weights per stream, i.e., the same matrices
+        # `merge_interleaved_mat()` builds but only for the complete output values.
+        positions = np.arange(self.pos, end)
+        o = np.zeros((positions.size, self.step_freq))
+        o[:] = np.nan
+        k = np.zeros((positions.size, self.step_freq))
+        k[:] = np.nan
+
+        for i in range(self.step_freq):
+            offsets = positions - i * self.step
+            valid = offsets >= 0
+            offsets = offsets[valid]
+            windows_idx = i + self.step_freq * (offsets // self.window_len)
+            values_idx = offsets % self.window_len
+            o[valid, i] = self.buffer[windows_idx - self.buffer_start, values_idx]
+            k[valid, i] = self.kernel[values_idx]
+
+        # Normalize kernels
+        k /= np.nansum(k, axis=1).reshape(k.shape[0], -1)
+        merged = np.nansum(o * k, axis=1)
+
+        self.pos = end
+
+        # Drop windows that are not needed anymore
+        first_needed = num_added
+        for i in range(self.step_freq):
+            offset = max(0, self.pos - i * self.step)
+            first_needed = min(
+                first_needed, i + self.step_freq * (offset // self.window_len)
+            )
+        self.buffer = self.buffer[first_needed - self.buffer_start :]
+        self.buffer_start = first_needed
+
+        return merged
+
+
 def get_norm_sym_norm_kernel(size):
     half_a = np.ceil(size / 2).astype(int)
     half_b = np.floor(size / 2).astype(int)
@@ -454,10 +739,19 @@ def knn_density(
     k: int = 5,
     dist_metric: str = "euclidean",
     summary: Callable[[np.ndarray], np.float64] = np.mean,
+    index=None,
 ):
+    """Average distance of every data point to its `k` nearest neighbors
+
+    Keyword Arguments:
+        index {KnnIndex} -- Approximate kNN index of `data`. For large data it's
+            queried instead of building a temporary index. (default: {None})
+    """
     n, dim = data.shape
 
-    if (n > 100000):
+    if n > 100000 and index is not None:
+        _, dist = index.query(data, k)
+    elif (n > 100000):
         # Declaring index
         p = hnswlib.Index(space='l2', dim=dim)
 
@@ -475,6 +769,9 @@ def knn_density(
 
         _, dist = p.knn_query(data, k = k)
 
+        # hnswlib's l2 space returns squared distances
+        dist = np.sqrt(dist)
+
         # Delete the index
         del p
     else:
@@ -490,6 +787,39 @@ def knn_density(
         return out
 
 
+def memmap_hdf5(filepath: str, name: str):
+    """Memory-map a contiguous HDF5 dataset
+
+    Contiguous (i.e., not chunked and not compressed) HDF5 datasets are stored as
+    plain C-ordered arrays in the file. Hence, we can memory-map them directly and
+    slice them without going through h5py.
+
+    Arguments:
+        filepath {str} -- Path to the HDF5 file
+        name {str} -- Name of the dataset
+
+    Returns:
+        {np.ndarray} -- Read-only memory-mapped array. If the dataset cannot be
+            memory-mapped it is loaded into memory instead.
+    """
+    with h5py.File(filepath, "r") as f:
+        dataset = f[name]
+        offset = dataset.id.get_offset()
+
+        if (
+            offset is None
+            or dataset.chunks is not None
+            or dataset.compression is not None
+            or dataset.size == 0
+        ):
+            return dataset[:]
+
+        dtype = dataset.dtype
+        shape = dataset.shape
+
+    return np.memmap(filepath, mode="r", dtype=dtype, offset=offset, shape=shape)
+
+
 @contextmanager
 def suppress_with_default(*exceptions, **kwargs):
     """Like contextlib.suppress but with a default value on exception
@@ -514,3 +844,101 @@ def get_c(target_c: list, bg_c: list, opacity: float):
     target = np.array(target_c) / 255
     bg = np.array(bg_c) / 255
     return ((target * (1 / opacity) - bg * ((1 - opacity) / opacity)) * 255).astype(int)
+
+
+_DONE = object()
+
+
+def prefetch(iterable, max_size: int = 1):
+    """Iterate over an iterable in a background thread
+
+    Up to `max_size` items are produced ahead of the consumer, which bounds the
+    memory. Exceptions of the producer are re-raised in the consumer.
+
+    Arguments:
+        iterable {iterable} -- Items to be produced
+
+    Keyword Arguments:
+        max_size {int} -- Maximum number of prefetched items (default: {1})
+
+    Yields:
+        any -- Items of the iterable in order
+    """
+    items = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put((item, None))
+            items.put((_DONE, None))
+        except Exception as error:
+            items.put((_DONE, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer if it waits for a free slot
+        with suppress(queue.Empty):
+            items.get_nowait()
+
+
+class BackgroundConsumer:
+    """Consume items in a background thread with a bounded queue
+
+    Use it as a context manager. Leaving the context waits until all items have been
+    consumed. Exceptions of the consumer are re-raised on the next `put()` or when
+    leaving the context.
+
+    Arguments:
+        consume {callable} -- Function called with the arguments of every `put()`
+
+    Keyword Arguments:
+        max_size {int} -- Maximum number of waiting items (default: {1})
+    """
+
+    def __init__(self, consume: callable, max_size: int = 1):
+        self.consume = consume
+        self.items = queue.Queue(maxsize=max_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while True:
+            args = self.items.get()
+            if args is _DONE:
+                return
+            if self.error is not None:
+                # Drain the queue after an error
+                continue
+            try:
+                self.consume(*args)
+            except Exception as error:
+                self.error = error
+
+    def put(self, *args):
+        if self.error is not None:
+            raise self.error
+        self.items.put(args)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.items.put(_DONE)
+        self.thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
@@ -11,11 +11,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import base64
 import numpy as np
+import threading
 from typing import Callable, List
 
-from server import bigwig, utils
+from server import bigwig, tile_encoding
 
 Vector = List[float]
 
@@ -29,8 +29,216 @@ TILESET_INFO = {
 }
 
 
+AGGREGATOR_NAMES = {
+    np.mean: "mean",
+    np.nanmean: "mean",
+    np.sum: "sum",
+    np.nansum: "sum",
+    np.max: "max",
+    np.nanmax: "max",
+    np.min: "min",
+    np.nanmin: "min",
+    np.median: "median",
+    np.nanmedian: "median",
+}
+
+
+def get_aggregator_name(aggregator) -> str:
+    """Get the name of a NumPy aggregator like `np.mean`"""
+    if isinstance(aggregator, str):
+        name = aggregator
+    else:
+        name = AGGREGATOR_NAMES.get(aggregator)
+
+    if name not in ("mean", "sum", "max", "min", "median"):
+        raise ValueError("Unsupported aggregator: {}".format(aggregator))
+
+    return name
+
+
+class RangeAggregator:
+    """Aggregate arbitrary ranges of a vector exactly without temporary blowups
+
+    Sums and means are computed from cumulative sums and maxima and minima from
+    segment trees, hence, aggregating `n` ranges takes `O(n)` or `O(n log(len(v)))`
+    time independent of the length of the ranges. The data structures are built
+    lazily the first time an aggregator is used. `NaN`s are ignored and empty
+    ranges or ranges without data are `NaN`.
+
+    Arguments:
+        v {np.ndarray} -- Vector of values
+    """
+
+    def __init__(self, v: np.ndarray):
+        self.v = np.asarray(v)
+        self.size = self.v.shape[0]
+        self._cumsums = None
+        self._trees = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cumsums(self):
+        if self._cumsums is None:
+            with self._lock:
+                if self._cumsums is None:
+                    is_nan = np.isnan(self.v)
+                    sums = np.r_[0, np.cumsum(np.where(is_nan, 0, self.v), dtype=float)]
+                    counts = None
+                    if np.any(is_nan):
+                        counts = np.r_[0, np.cumsum(~is_nan, dtype=np.int64)]
+                    self._cumsums = (sums, counts)
+        return self._cumsums
+
+    def get_tree(self, aggregator: str):
+        if aggregator not in self._trees:
+            with self._lock:
+                if aggregator not in self._trees:
+                    op = np.fmax if aggregator == "max" else np.fmin
+                    num_leaves = 1 << max(0, int(self.size - 1).bit_length())
+                    tree = np.zeros(2 * num_leaves, dtype=self.v.dtype)
+                    tree[:] = np.nan
+                    tree[num_leaves : num_leaves + self.size] = self.v
+                    # Node `i` holds the aggregate of its children `2i` and `2i + 1`
+                    level = num_leaves
+                    while level > 1:
+                        tree[level // 2 : level] = op(
+                            tree[level : 2 * level : 2], tree[level + 1 : 2 * level : 2]
+                        )
+                        level //= 2
+                    self._trees[aggregator] = (num_leaves, tree)
+        return self._trees[aggregator]
+
+    def query_tree(self, starts, ends, aggregator: str):
+        op = np.fmax if aggregator == "max" else np.fmin
+        num_leaves, tree = self.get_tree(aggregator)
+
+        out = np.zeros(starts.size, dtype=float)
+        out[:] = np.nan
+        lo = starts + num_leaves
+        hi = ends + num_leaves
+
+        # Bottom-up segment tree query for all ranges at once
+        while True:
+            active = lo < hi
+            if not np.any(active):
+                break
+            left = active & (lo % 2 == 1)
+            out[left] = op(out[left], tree[lo[left]])
+            lo[left] += 1
+            right = active & (hi % 2 == 1)
+            hi[right] -= 1
+            out[right] = op(out[right], tree[hi[right]])
+            lo //= 2
+            hi //= 2
+
+        return out
+
+    def query(self, starts, ends, aggregator="mean") -> np.ndarray:
+        """Aggregate the ranges `v[starts[i]:ends[i]]`
+
+        Arguments:
+            starts {np.ndarray} -- Start indices
+            ends {np.ndarray} -- End indices (exclusive)
+
+        Keyword Arguments:
+            aggregator {str|callable} -- Either `mean`, `sum`, `max`, `min`,
+                `median` or the equivalent NumPy function (default: {"mean"})
+
+        Returns:
+            {np.ndarray} -- Aggregated values
+        """
+        aggregator = get_aggregator_name(aggregator)
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, self.size)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), starts, self.size)
+
+        if aggregator in ("max", "min"):
+            return self.query_tree(starts, ends, aggregator)
+
+        if aggregator == "median":
+            # There is no sublinear data structure for the median
+            out = np.zeros(starts.size, dtype=float)
+            out[:] = np.nan
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                x = self.v[start:end]
+                if np.any(~np.isnan(x)):
+                    out[i] = np.nanmedian(x)
+            return out
+
+        sums, counts = self.cumsums
+        range_sums = sums[ends] - sums[starts]
+        range_counts = ends - starts if counts is None else counts[ends] - counts[starts]
+
+        out = np.zeros(starts.size, dtype=float)
+        out[:] = np.nan
+        has_data = range_counts > 0
+
+        if aggregator == "sum":
+            out[has_data] = range_sums[has_data]
+        else:
+            out[has_data] = range_sums[has_data] / range_counts[has_data]
+
+        return out
+
+    def scaleup(self, starts, ends, v_res: int, aggregator="mean") -> np.ndarray:
+        """Aggregate ranges that are smaller than a vector entry
+
+        Every range overlaps with at most two vector entries. The mean is weighted by
+        the overlap and the median is the entry overlapping the most with the range,
+        which is equivalent to repeating each entry by its number of base pairs.
+
+        Arguments:
+            starts {np.ndarray} -- Start positions relative to the first vector
+                entry in base pairs
+            ends {np.ndarray} -- End positions relative to the first vector entry
+                in base pairs
+            v_res {int} -- Number of base pairs per vector entry
+
+        Keyword Arguments:
+            aggregator {str|callable} -- Aggregator (default: {"mean"})
+
+        Returns:
+            {np.ndarray} -- Aggregated values
+        """
+        aggregator = get_aggregator_name(aggregator)
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+
+        first = np.clip(starts // v_res, 0, self.size - 1).astype(np.int64)
+        last = np.clip((ends - 1) // v_res, 0, self.size - 1).astype(np.int64)
+        x_first = self.v[first].astype(float)
+        x_last = self.v[last].astype(float)
+
+        if aggregator == "max":
+            return np.fmax(x_first, x_last)
+
+        if aggregator == "min":
+            return np.fmin(x_first, x_last)
+
+        # Number of base pairs overlapping with the first and the last entry
+        w_first = np.minimum(ends, (first + 1) * v_res) - starts
+        w_last = np.where(last > first, ends - last * v_res, 0)
+
+        if aggregator == "median":
+            return np.where(
+                np.isnan(x_last) | (w_first >= w_last) & ~np.isnan(x_first),
+                x_first,
+                x_last,
+            )
+
+        w_first = np.where(np.isnan(x_first), 0, w_first)
+        w_last = np.where(np.isnan(x_last), 0, w_last)
+        weights = w_first + w_last
+        sums = np.nan_to_num(x_first) * w_first + np.nan_to_num(x_last) * w_last
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if aggregator == "sum":
+                # Every entry is spread evenly across its base pairs
+                return np.where(weights > 0, sums / v_res, np.nan)
+            return np.where(weights > 0, sums / weights, np.nan)
+
+
 def get_values(
-    v: Vector,
+    v,
     v_res: int,
     v_len_abs: int,
     v_offset_abs: int,
@@ -43,70 +251,65 @@ def get_values(
     aggregator: Callable = np.mean,
     scaleup_aggregator: Callable = np.mean,
 ) -> Vector:
-    abs_start = offset + start
-    abs_end = offset + end
+    """Get binned values of the vector for a region of one chromosome
+
+    Arguments:
+        v {np.ndarray|RangeAggregator} -- Vector of values
+        v_res {int} -- Number of base pairs per vector entry
+        v_len_abs {int} -- Number of base pairs covered by the vector
+        v_offset_abs {int} -- Absolute position of the first vector entry
+        offset {int} -- Absolute position of the chromosome
+        start {int} -- Start of the region relative to the chromosome
+        end {int} -- End of the region relative to the chromosome
+        bins {int} -- Number of bins
+        res {int} -- Number of base pairs per bin
+
+    Keyword Arguments:
+        missing {float} -- Value of bins without data (default: {np.nan})
+        aggregator {callable} -- Aggregator for bins covering several vector
+            entries (default: {np.mean})
+        scaleup_aggregator {callable} -- Aggregator for bins smaller than a vector
+            entry (default: {np.mean})
 
-    rel_start = max(abs_start, v_offset_abs)
-    rel_end = min(abs_end, v_offset_abs + v_len_abs)
+    Returns:
+        {np.ndarray} -- Binned values
+    """
+    if not isinstance(v, RangeAggregator):
+        v = RangeAggregator(v)
 
     out = np.zeros(bins)
     out[:] = missing
 
-    # Imaging:
-    # - RS = relative start
-    # - RE = relative end
-    # - AS = absolute start
-    # - AE = absolute end
-    # - ____ region to be cut out
-    # - **** availabe data
-    # |---RS___RE---AS******AE---RS___RE---|
-    if rel_start >= abs_end or rel_end <= abs_start:
-        # interval is outside
-        return out
+    # Absolute bin boundaries clipped to the region covered by the vector
+    bin_starts = offset + start + np.arange(bins) * res
+    bin_ends = np.minimum(bin_starts + res, offset + end)
+    data_start = v_offset_abs
+    data_end = v_offset_abs + min(v_len_abs, v.size * v_res)
+    bin_starts = np.clip(bin_starts, data_start, data_end) - v_offset_abs
+    bin_ends = np.clip(bin_ends, data_start, data_end) - v_offset_abs
 
-    else:
-        # Either the start or the end lies within the available data vector:
-        # start_res and end_res correspond to the indices of the data vector
-        # associated the start and end of the requested tiles
-        start_res = np.floor((rel_start - v_offset_abs) / v_res).astype(int)
-        end_res = np.ceil((rel_end - v_offset_abs) / v_res).astype(int)
-
-        res_ratio = v_res / res
-        data = np.zeros(bins)
-        data[:] = missing
-
-        if res_ratio < 1:
-            # output resolution is greater (e.g., 10 kb) than the data resolution
-            # (e.g., 1 kb), hence, we need to aggregate the data
-            data = utils.zoom_array(
-                v[start_res:end_res], (bins,), aggregator=aggregator
-            )
+    has_data = bin_ends > bin_starts
 
-        elif res_ratio > 1:
-            data = utils.scaleup_vector(
-                v[start_res:end_res], bins, aggregator=scaleup_aggregator
-            )
+    if not np.any(has_data):
+        return out
 
-        if rel_end < abs_end:
-            # Intervals overlaps with the start
-            # ^ = Start; $ = end
-            # Tile req. (abs): ----------^=======$----
-            # Data           : -------^=======$-------
-            # Rel            : ----------^====$-------
-            out[: data.size] = data
-
-        elif rel_start > abs_start:
-            # Intervals overlaps with the end
-            # ^ = Start; $ = end;
-            # Tile req. (abs): ----^=======$----------
-            # Data           : -------^=======$-------
-            # Rel            : -------^====$----------
-            out[out.size - data.size :] = data
+    if res < v_res:
+        values = v.scaleup(
+            bin_starts[has_data],
+            bin_ends[has_data],
+            v_res,
+            aggregator=scaleup_aggregator,
+        )
+    else:
+        values = v.query(
+            bin_starts[has_data] // v_res,
+            -(-bin_ends[has_data] // v_res),
+            aggregator=aggregator,
+        )
 
-        else:
-            out = data
+    out[has_data] = np.where(np.isnan(values), missing, values)
 
-        return out
+    return out
 
 
 def get_tile(
@@ -171,34 +374,36 @@ def tiles(
     aggregator=np.mean,
     scaleup_aggregator=np.mean,
 ):
-    """[summary].
-
-    [description]
-
-    Args:
-        v: np.ndarray: [description]
-        v_res: int: [description]
-        v_len_abs: int: [description]
-        v_offset_abs: int: [description]
-        tile_ids: [description]
-        chrom_sizes: [description]
+    """Generate tiles of a genome-wide vector
+
+    Arguments:
+        v {np.ndarray|RangeAggregator} -- Vector of values. Pass a
+            `RangeAggregator` to reuse its data structures across requests.
+        v_res {int} -- Number of base pairs per vector entry
+        v_len_abs {int} -- Number of base pairs covered by the vector
+        v_offset_abs {int} -- Absolute position of the first vector entry
+        tile_ids {list} -- Tile ids
+        chrom_sizes {pd.Series} -- Chromosome sizes
+
+    Keyword Arguments:
+        aggregator {callable} -- Aggregator for bins covering several vector
+            entries (default: {np.mean})
+        scaleup_aggregator {callable} -- Aggregator for bins smaller than a vector
+            entry (default: {np.mean})
 
     Returns:
-        [description]
-        [type]
+        {list} -- List of `(tile_id, tile_value)` tuples
     """
+    if not isinstance(v, RangeAggregator):
+        v = RangeAggregator(v)
+
+    chrom_offsets = np.cumsum(chrom_sizes) - chrom_sizes
+    max_depth = bigwig.get_quadtree_depth(chrom_sizes)
 
     generated_tiles = []
     for tile_id in tile_ids:
-        tile_id_parts = tile_id.split(".")
-        tile_position = list(map(int, tile_id_parts[1:3]))
-        zoom_level = tile_position[0]
-        tile_pos = tile_position[1]
-
-        # this doesn't combine multiple consequetive ids, which
-        # would speed things up
-        chrom_offsets = np.cumsum(chrom_sizes) - chrom_sizes
-        max_depth = bigwig.get_quadtree_depth(chrom_sizes)
+        _, zoom_level, tile_pos = bigwig.parse_tile_id(tile_id)
+
         tile_size = TILE_SIZE * 2 ** (max_depth - zoom_level)
         start_pos = tile_pos * tile_size
         end_pos = start_pos + tile_size
@@ -219,34 +424,7 @@ def tiles(
 
         dense[np.isnan(dense)] = 0.0
 
-        if len(dense):
-            max_dense = max(dense)
-            min_dense = min(dense)
-        else:
-            max_dense = 0
-            min_dense = 0
-
-        min_f16 = np.finfo("float16").min
-        max_f16 = np.finfo("float16").max
-
-        has_nan = len([d for d in dense if np.isnan(d)]) > 0
-
-        if (
-            not has_nan
-            and max_dense > min_f16
-            and max_dense < max_f16
-            and min_dense > min_f16
-            and min_dense < max_f16
-        ):
-            tile_value = {
-                "dense": base64.b64encode(dense.astype("float16")).decode("utf-8"),
-                "dtype": "float16",
-            }
-        else:
-            tile_value = {
-                "dense": base64.b64encode(dense.astype("float32")).decode("utf-8"),
-                "dtype": "float32",
-            }
+        tile_value = tile_encoding.get_tile_value(dense)
 
         generated_tiles += [(tile_id, tile_value)]
 
@@ -19,75 +19,112 @@ import os
 import sys
 
 
-parser = argparse.ArgumentParser(description="Peak Explorer CLI")
-parser.add_argument(
-    "-c", "--config", help="path to your JSON config file", default="config.json"
-)
-parser.add_argument(
-    "--clear", action="store_true", help="clears the cache and database on startup"
-)
-parser.add_argument(
-    "--clear-cache", action="store_true", help="clears the cache on startup"
-)
-parser.add_argument(
-    "--clear-cache-at-exit", action="store_true", help="clear the cache on shutdown"
-)
-parser.add_argument(
-    "--clear-db", action="store_true", help="clears the database on startup"
-)
-parser.add_argument("-d", "--debug", action="store_true", help="turn on debug mode")
-parser.add_argument("--host", help="customize the hostname", default="localhost")
-parser.add_argument("--port", help="customize the port", default=5000)
-parser.add_argument(
-    "-v", "--verbose", action="store_true", help="turn verbose logging on"
-)
-
-try:
-    args = parser.parse_args()
-except SystemExit as err:
-    if err.code == 0:
-        sys.exit(0)
-    if err.code == 2:
-        parser.print_help()
-        sys.exit(0)
-    raise
-
-from server import server
-from server.config import Config
-
-try:
-    with open(args.config, "r") as f:
-        config_file = json.load(f)
-except FileNotFoundError:
-    print(
-        "You need to either provide a config file via `--config` or "
-        "have it as `config.json` in the root directory of Peax"
-    )
-    raise
-
-verbose = args.verbose or args.debug
-
-# Create a config object
-config = Config(config_file)
-
-clear_cache = args.clear or args.clear_cache
-clear_db = args.clear or args.clear_db
-
-# Turn off clearing as Werkzeug is calling this script the second time
-if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-    clear_cache = False
-    clear_db = False
-
-# Create app instance
-app = server.create(config, clear_cache=clear_cache, clear_db=clear_db, verbose=verbose)
-
-
 def remove_cache(config):
     config.datasets.remove_cache()
 
 
-if args.clear_cache_at_exit:
-    atexit.register(remove_cache, config)
+def main():
+    parser = argparse.ArgumentParser(description="Peak Explorer CLI")
+    parser.add_argument(
+        "-c", "--config", help="path to your JSON config file", default="config.json"
+    )
+    parser.add_argument(
+        "--clear", action="store_true", help="clears the cache and database on startup"
+    )
+    parser.add_argument(
+        "--clear-cache", action="store_true", help="clears the cache on startup"
+    )
+    parser.add_argument(
+        "--clear-cache-at-exit", action="store_true", help="clear the cache on shutdown"
+    )
+    parser.add_argument(
+        "--clear-db", action="store_true", help="clears the database on startup"
+    )
+    parser.add_argument(
+        "-d", "--debug", action="store_true", help="turn on debug mode"
+    )
+    parser.add_argument(
+        "--asgi",
+        action="store_true",
+        help="serve the app asynchronously via ASGI (requires uvicorn)",
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of threads per request pool when serving via ASGI",
+        type=int,
+        default=16,
+    )
+    parser.add_argument("--host", help="customize the hostname", default="localhost")
+    parser.add_argument("--port", help="customize the port", default=5000)
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="turn verbose logging on"
+    )
+
+    try:
+        args = parser.parse_args()
+    except SystemExit as err:
+        if err.code == 0:
+            sys.exit(0)
+        if err.code == 2:
+            parser.print_help()
+            sys.exit(0)
+        raise
+
+    from server import server
+    from server.config import Config
+
+    try:
+        with open(args.config, "r") as f:
+            config_file = json.load(f)
+    except FileNotFoundError:
+        print(
+            "You need to either provide a config file via `--config` or "
+            "have it as `config.json` in the root directory of Peax"
+        )
+        raise
+
+    verbose = args.verbose or args.debug
+
+    # Create a config object
+    config = Config(config_file)
+
+    clear_cache = args.clear or args.clear_cache
+    clear_db = args.clear or args.clear_db
+
+    # Turn off clearing as Werkzeug is calling this script the second time
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        clear_cache = False
+        clear_db = False
+
+    # Create app instance
+    app = server.create(
+        config, clear_cache=clear_cache, clear_db=clear_db, verbose=verbose
+    )
 
-# Run the instance
-app.run(debug=args.debug, host=args.host, port=args.port)
+    if args.clear_cache_at_exit:
+        atexit.register(remove_cache, config)
+
+    # Run the instance
+    if args.asgi:
+        try:
+            import uvicorn
+        except ImportError:
+            print("Serving via ASGI requires uvicorn: `pip install uvicorn`")
+            raise
+
+        from server import asgi
+
+        uvicorn.run(
+            asgi.create(app, max_workers=args.workers, max_tile_workers=args.workers),
+            host=args.host,
+            port=int(args.port),
+            log_level="debug" if args.debug else "info",
+        )
+    else:
+        app.run(debug=args.debug, host=args.host, port=args.port)
+
+
+# The guard is required as the data preparation spawns worker processes, which
+# import this module again
+if __name__ == "__main__":
+    main()